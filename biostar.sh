@@ -20,6 +20,10 @@ if [ $# == 0 ]; then
     echo '  writer-dev          - invoke manage.py for writer with dev settings'
     echo '  writer-prod         - invoke manage.py for writer with prod settings'
     echo ''
+    echo '  Writer workers, run each one separately:'
+    echo '    writer-prod process_tasks --queue queue-1         - invoices, node probes and archive'
+    echo '    writer-prod process_tasks --queue queue-payouts   - bounty award payouts'
+    echo ''
     echo '  init-dev            - initializes a local database for testing'
     echo '  init-reader-prod    - initializes static files'
     echo '  init-writer-prod    - initializes database'
@@ -5,5 +5,6 @@ from lner.models import LightningNode
 
 l = LightningNode.objects.get(node_name="bl3")
 l.enabled = False
+l.qos_disabled = False  # disabled by hand, lner.qos does not enable it again
 l.save()
 EOF
@@ -5,5 +5,6 @@ from lner.models import LightningNode
 
 l = LightningNode.objects.get(node_name="l1")
 l.enabled = True
+l.qos_disabled = False
 l.save()
 EOF
@@ -1,10 +1,11 @@
 # Create your views here.
 import re
 import json
+import time
 import langdetect
 
 from django.shortcuts import render_to_response
-from django.views.generic import TemplateView, DetailView, ListView, FormView, UpdateView
+from django.views.generic import TemplateView, DetailView, ListView, FormView, UpdateView, View
 from django import forms
 from django.core.urlresolvers import reverse
 from crispy_forms.helper import FormHelper
@@ -1084,3 +1085,21 @@ class VotePublishView(TemplateView):
             return view_helpers.post_redirect(pid=post_id, request=request, permanent=False)
 
         return super(VotePublishView, self).get(request, *args, **kwargs)
+
+
+class MemoStartView(View):
+    """
+    Vote and accept buttons link here with a memo whose time is rounded down to the hour, see
+    bucketed_memo_url. Every invoice needs its own memo, so the memo gets the current time before
+    redirecting to the invoice or signature page.
+    """
+
+    target_url_name = None
+
+    def get(self, request, *args, **kwargs):
+        memo = validators.validate_memo(
+            json_util.deserialize_memo(kwargs["memo"])
+        )
+        memo["unixtime"] = int(time.time())
+
+        return HttpResponseRedirect(reverse(self.target_url_name, kwargs=dict(memo=json_util.serialize_memo(memo))))
@@ -1,15 +1,54 @@
+import copy
+import time
 import logging
+import threading
 import requests
 
+from requests.adapters import HTTPAdapter
 from django.conf import settings
 
 from common.log import logger
+from common import signmessage
+from common import metrics
+from common.circuitbreaker import CircuitBreaker
+from common.circuitbreaker import CircuitOpenError
 
 
 CHECKPOINT_DONE = 1
 CHECKPOINT_WAIT = 2
 CHECKPOINT_ERROR = 3
 
+# Extra time for the HTTP request of wait_payment and payaward_status on top of the time the writer waits
+WAIT_PAYMENT_HTTP_MARGIN = 5
+
+CONNECT_TIMEOUT = 3
+READ_TIMEOUT = 10
+ADDINVOICE_READ_TIMEOUT = 20  # the writer runs lncli addinvoice, up to 3 tries of 5 seconds
+
+# Requests that failed to connect are re-sent, they never reached the writer. addinvoice is idempotent per memo.
+MAX_RETRIES = 2
+RETRY_SLEEP_SECONDS = 0.1
+
+POOL_MAXSIZE = 10
+
+# The node list only changes when nodes are enabled or disabled, within this many seconds it is served
+# from the process cache, after that it is revalidated with If-None-Match
+NODES_LIST_TTL = 60
+
+# requests < 2.4 takes a single timeout that applies to both connecting and reading
+SPLIT_TIMEOUTS = tuple(int(v) for v in requests.__version__.split(".")[:2]) >= (2, 4)
+
+ENDPOINT_SECONDS = metrics.histogram(
+    "reader_writer_request_seconds", "Latency of reader to writer API calls", ["endpoint", "outcome"])
+
+session = requests.Session()
+session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=POOL_MAXSIZE))
+
+writer_circuit = CircuitBreaker("writer-api", failure_threshold=5, reset_timeout=30)
+
+nodes_list_cache = {"nodes": None, "etag": None, "fetched_at": 0}
+nodes_list_lock = threading.Lock()
+
 
 class CheckResponce(object):
     def __init__(self):
@@ -18,23 +57,71 @@ class CheckResponce(object):
 class LNUtilError(Exception):
     pass
 
-def call_endpoint(path, args={}, as_post=False):
+def call_endpoint(path, args={}, as_post=False, timeout=READ_TIMEOUT, extra_headers={}):
+    """
+    Call the writer API over a pooled keep-alive session
+
+    Connection errors are retried up to MAX_RETRIES times, timeouts are not. Any exception and 5xx responses
+    count as failures of the writer_circuit, while it is open calls fail right away.
+    """
     if settings.READER_TO_WRITER_AUTH_TOKEN is not None:
         headers = {'Authorization': 'Token {}'.format(settings.READER_TO_WRITER_AUTH_TOKEN)}
     else:
         headers = {}
 
+    headers.update(extra_headers)
+
     full_path = 'http://{}:8000/{}.json'.format(settings.WRITER_HOST, path)
+    request_timeout = (CONNECT_TIMEOUT, timeout) if SPLIT_TIMEOUTS else timeout
+
     try:
-        if as_post:
-            return requests.post(full_path, headers=headers, data=args)
-        else:
-            return requests.get(full_path, headers=headers, params=args)
+        writer_circuit.before_call()
+    except CircuitOpenError as e:
+        ENDPOINT_SECONDS.observe(0, endpoint=path, outcome="circuit_open")
+        raise LNUtilError("{} when connecting to {}".format(e, full_path))
+
+    start_time = time.time()
+    try:
+        for try_num in range(MAX_RETRIES + 1):
+            try:
+                if as_post:
+                    response = session.post(full_path, headers=headers, data=args, timeout=request_timeout)
+                else:
+                    response = session.get(full_path, headers=headers, params=args, timeout=request_timeout)
+                break
+
+            except requests.exceptions.ConnectionError as e:
+                if try_num == MAX_RETRIES:
+                    raise
+
+                logger.error("ConnectionError on try {} when connecting to {}: {}".format(try_num + 1, full_path, e))
+                time.sleep(RETRY_SLEEP_SECONDS)
 
     except requests.exceptions.ConnectionError as e:
         logger.exception(e)
+        writer_circuit.record_failure()
+        ENDPOINT_SECONDS.observe(time.time() - start_time, endpoint=path, outcome="connection_error")
         raise LNUtilError("ConnectionError when connecting to {}".format(full_path))
 
+    except requests.exceptions.Timeout as e:
+        logger.exception(e)
+        writer_circuit.record_failure()
+        ENDPOINT_SECONDS.observe(time.time() - start_time, endpoint=path, outcome="timeout")
+        raise LNUtilError("Timeout after {} seconds when connecting to {}".format(timeout, full_path))
+
+    except Exception:
+        writer_circuit.record_failure()
+        ENDPOINT_SECONDS.observe(time.time() - start_time, endpoint=path, outcome="error")
+        raise
+
+    if response.status_code >= 500:
+        writer_circuit.record_failure()
+    else:
+        writer_circuit.record_success()
+
+    ENDPOINT_SECONDS.observe(time.time() - start_time, endpoint=path, outcome=str(response.status_code))
+    return response
+
 
 def check_expected_key(response, expected_key, is_list=True):
     try:
@@ -78,28 +165,59 @@ def by_name(x):
     return x["node_name"]
 
 
+def fetch_nodes_list(etag=None):
+    """
+    Returns (nodes, etag), nodes is None if the writer answered 304 Not Modified
+    """
+    response = call_endpoint('ln/list', extra_headers={"If-None-Match": etag} if etag else {})
+    if response.status_code == 304:
+        return None, etag
+
+    check_expected_key(response, "node_name")
+
+    return_list = [
+        n for n in response.json() if n["enabled"] == True
+    ]
+
+    # reader does not need to know the rpcserver
+    for n in return_list:
+        del n["rpcserver"]
+
+    return sorted(return_list, key=by_name), response.headers.get("ETag")
+
+
 def get_nodes_list():
-    try:
-        response = call_endpoint('ln/list')
-        check_expected_key(response, "node_name")
+    """
+    Enabled nodes sorted by name, cached for NODES_LIST_TTL seconds
 
-    except LNUtilError:
-        return []
+    If the writer can not be reached the last known list is served, or [] if there is none.
+    """
+    with nodes_list_lock:
+        now = time.time()
+        if nodes_list_cache["nodes"] is None or now - nodes_list_cache["fetched_at"] >= NODES_LIST_TTL:
+            try:
+                nodes, etag = fetch_nodes_list(nodes_list_cache["etag"] if nodes_list_cache["nodes"] is not None else None)
 
-    else:
-        return_list = [
-            n for n in response.json() if n["enabled"] == True
-        ]
+            except LNUtilError:
+                if nodes_list_cache["nodes"] is None:
+                    return []
 
-        # reader does not need to know the rpcserver
-        for n in return_list:
-            del n["rpcserver"]
+                logger.error("Could not refresh the node list, serving the cached one")
 
-        return sorted(return_list, key=by_name)
+            else:
+                if nodes is not None:
+                    nodes_list_cache["nodes"] = nodes
+                    nodes_list_cache["etag"] = etag
+
+            nodes_list_cache["fetched_at"] = now
+
+        # callers may modify the node dicts
+        return copy.deepcopy(nodes_list_cache["nodes"])
 
 
 def add_invoice(memo, node_id):
-    response = call_endpoint('ln/addinvoice', args={"memo": memo, "node_id": node_id}, as_post=True)
+    response = call_endpoint(
+        'ln/addinvoice', args={"memo": memo, "node_id": node_id}, as_post=True, timeout=ADDINVOICE_READ_TIMEOUT)
 
     check_expected_key(response, "pay_req", is_list=False)
 
@@ -124,6 +242,23 @@ def gen_check_conclusion(checkpoint_value, node_id, memo):
 
 def check_payment(memo, node_id):
     response = call_endpoint('ln/check', args={"memo": memo, "node_id": node_id})
+    return parse_check_response(response, memo, node_id)
+
+
+def wait_payment(memo, node_id, timeout, checkpoint_value="no_checkpoint"):
+    """
+    Like check_payment, but the writer holds the request until the checkpoint is no longer checkpoint_value,
+    or timeout seconds pass
+    """
+    response = call_endpoint(
+        'ln/waitcheck',
+        args={"memo": memo, "node_id": node_id, "checkpoint_value": checkpoint_value, "timeout": timeout},
+        timeout=timeout + WAIT_PAYMENT_HTTP_MARGIN
+    )
+    return parse_check_response(response, memo, node_id)
+
+
+def parse_check_response(response, memo, node_id):
     if response.status_code != 200:
         error_msg = (
             "Got API error when looking up checkpoint, http_status={},node={},memo={}".format(
@@ -143,6 +278,10 @@ def check_payment(memo, node_id):
 
 
 def verifymessage(memo, sig):
+    if settings.LOCAL_VERIFYMESSAGE:
+        result = signmessage.verifymessage(memo, sig)
+        return {"memo": memo, "valid": result["valid"], "identity_pubkey": result["pubkey"]}
+
     response = call_endpoint('ln/verifymessage', args={"memo": memo, "sig": sig})
     if response.status_code != 200:
         error_msg = (
@@ -162,8 +301,15 @@ def verifymessage(memo, sig):
     response_parsed = response.json()[0]
     return response_parsed
 
-def payaward(node_id, award_id, invoice, sig):
-    response = call_endpoint('ln/payaward', args={"node_id": node_id, "award_id": award_id, "invoice": invoice, "sig": sig})
+def submit_payaward(node_id, award_id, invoice, sig):
+    """
+    Schedule the payout on the writer, returns the job right away, see payaward_status
+    """
+    response = call_endpoint(
+        'ln/payaward',
+        args={"node_id": node_id, "award_id": award_id, "invoice": invoice, "sig": sig},
+        as_post=True
+    )
     if response.status_code != 200:
         error_msg = (
             "Got API error when calling payaward, http_status={},node_id={},award_id={},invoice={},sig={}".format(
@@ -178,5 +324,30 @@ def payaward(node_id, award_id, invoice, sig):
         logger.error(error_msg)
         raise LNUtilError(error_msg)
 
+    check_expected_key(response, "status", is_list=False)
+
+    return response.json()
+
+
+def payaward_status(job_id, timeout):
+    """
+    Status of a payout job, the writer holds the request until the job is finished or timeout seconds pass
+    """
+    response = call_endpoint(
+        'ln/payawardstatus',
+        args={"job_id": job_id, "timeout": timeout},
+        timeout=timeout + WAIT_PAYMENT_HTTP_MARGIN
+    )
+    if response.status_code != 200:
+        error_msg = "Got API error when looking up payout job, http_status={},job_id={}".format(
+            response.status_code,
+            job_id
+        )
+
+        logger.error(error_msg)
+        raise LNUtilError(error_msg)
+
+    check_expected_key(response, "status", is_list=True)
+
     response_parsed = response.json()[0]
     return response_parsed
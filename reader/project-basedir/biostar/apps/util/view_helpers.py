@@ -4,6 +4,8 @@ from django.core.urlresolvers import reverse
 
 from biostar.apps.util import ln
 from biostar.apps.posts.models import Post
+from biostar.server import sidebar
+from biostar.server import pagecache
 
 from common import json_util
 from common.log import logger
@@ -81,6 +83,8 @@ def check_invoice(memo, node_id):
     checkpoint_value = result["checkpoint_value"]
     conclusion = ln.gen_check_conclusion(checkpoint_value, node_id=node_id, memo=memo)
     if conclusion == ln.CHECKPOINT_DONE:
+        sidebar.invalidate()
+        pagecache.bump_version()
         post_id = result["performed_action_id"]
         return post_id
 
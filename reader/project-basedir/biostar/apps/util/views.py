@@ -1,7 +1,6 @@
 # Create your views here.
 import os
 import io
-import time
 
 from crispy_forms.helper import FormHelper
 from crispy_forms.layout import Layout, Field, Fieldset, Div, Submit, ButtonHolder
@@ -12,10 +11,13 @@ from django.http import Http404
 from django.conf import settings
 from django.core.urlresolvers import reverse
 from django.shortcuts import render
+from django.shortcuts import redirect
 
 from biostar.apps.util import ln
 from biostar.apps.posts.models import Post
 from biostar.apps.bounty.models import Bounty, BountyAward
+from biostar.server import sidebar
+from biostar.server import pagecache
 
 import qrcode
 import qrcode.image.svg
@@ -52,30 +54,26 @@ class PaymentCheck(TemplateView):
 
     template_name = "payment_check.svg"
 
+    # The writer holds the request until the payment is processed, at most this long
+    MAX_WAIT_SECONDS = 10
+
     def get_context_data(self, **kwargs):
         context = super(PaymentCheck, self).get_context_data(**kwargs)
         memo = context["memo"]
         node_id = context["node_id"]
 
-        count = 0
-        while True:
-            result = ln.check_payment(memo, node_id=node_id)
-            checkpoint_value = result["checkpoint_value"]
-            conclusion = ln.gen_check_conclusion(checkpoint_value, node_id=node_id, memo=memo)
-
-            if conclusion != ln.CHECKPOINT_WAIT:
-                break
+        result = ln.wait_payment(memo, node_id=node_id, timeout=PaymentCheck.MAX_WAIT_SECONDS)
+        checkpoint_value = result["checkpoint_value"]
+        conclusion = ln.gen_check_conclusion(checkpoint_value, node_id=node_id, memo=memo)
 
-            # TODO: shutdown if sigterm is caught
-
-            time.sleep(1)
-            count += 1
-            if count > 10:
-                raise Http404("Max time exceeded")
+        if conclusion == ln.CHECKPOINT_WAIT:
+            raise Http404("Max time exceeded")
 
         dwg = svgwrite.Drawing(size=(500, 2000))
 
         if conclusion == ln.CHECKPOINT_DONE:
+            sidebar.invalidate()
+            pagecache.bump_version()
             post_id = result["performed_action_id"]
             print(post_id)
 
@@ -363,27 +361,46 @@ class TakeCustodyView(TemplateView):
             context['sign_form'] = form2
             context['invoice'] = invoice_pre_validation
 
-            error_summary_list = []
-
             if not form2.is_valid():
                 context['errors_detected'] = True
             else:
-                # make API call and report back the results, potentially populating error_summary_list
+                # make API call, the payment runs in the background on the writer and PayoutStatusView waits for it
                 award_id = int(context["award_id"])
                 node_id = int(context["node_id"])
 
-                result = ln.payaward(node_id=node_id, award_id=award_id, invoice=invoice_pre_validation, sig=sign_pre_validation)
+                job = ln.submit_payaward(node_id=node_id, award_id=award_id, invoice=invoice_pre_validation, sig=sign_pre_validation)
 
-                if result["payment_successful"] == True:
-                    return render(request, "payment_successful.html", context)
-                else:
-                    error_summary_list.append("Payment failed: {}".format(result["failure_message"]))
-
-                    context['errors_detected'] = True
-                    context["show_error_summary"] = True
-                    context["error_summary_list"] = error_summary_list
+                return redirect("payout-status", job_id=job["id"])
 
         else:
             raise ln.LNUtilError("Invalid state")
 
         return render(request, self.template_name, context)
+
+
+class PayoutStatusView(TemplateView):
+    """
+    Shows the status of a payout job, the page reloads itself until the job is finished
+    """
+
+    template_name = "payout_status.html"
+
+    # The writer holds the request until the job is finished, at most this long
+    MAX_WAIT_SECONDS = 10
+
+    def get(self, request, *args, **kwargs):
+        context = self.get_context_data(**kwargs)
+        job = ln.payaward_status(int(context["job_id"]), timeout=PayoutStatusView.MAX_WAIT_SECONDS)
+
+        if job["status"] == "succeeded":
+            pagecache.bump_version()  # the bounty is payed
+            return render(request, "payment_successful.html", context)
+
+        context["job"] = job
+        context["finished"] = (job["status"] == "failed")
+        context["take_custody_url"] = reverse("take-custody", kwargs={"award_id": job["award_id"]})
+        if context["finished"]:
+            context["errors_detected"] = True
+            context["error_summary_list"] = ["Payment failed: {}".format(job["failure_message"])]
+
+        return render(request, self.template_name, context)
@@ -1,10 +1,12 @@
 import json
+import hashlib
 from datetime import datetime, timedelta
 from calendar import timegm
 from os.path import join, normpath, isfile, exists
 from os import makedirs
 
-from django.http import HttpResponse
+from django.http import HttpResponse, HttpResponseNotModified
+from django.utils.http import parse_etags, quote_etag
 from django.conf import settings
 
 from ..apps.users.models import User
@@ -14,27 +16,77 @@ from ..apps.posts.models import Vote, Post
 from common.log import logger
 
 
-def json_response(f):
+def json_response(f=None, stamp=None):
     """
     Converts any functions which returns a dictionary to a proper HttpResponse with json content.
+
+    stamp(request, *args, **kwargs) returns a cheap version of what f returns, or None if there is nothing.
+    The ETag is computed from it before f runs, so repeat requests get 304 Not Modified without calling f.
     """
     # TODO: This decorator might be moved to util/json.py. We will see later on, when we
     # TODO: introduce django-rest-framework.
+    if f is None:
+        return lambda f: json_response(f, stamp=stamp)
+
     def to_json(request, *args, **kwargs):
         """
         Creates the actual HttpResponse with json content.
         """
+        etag = None
+        if stamp is not None:
+            version = stamp(request, *args, **kwargs)
+            if version is not None:
+                etag = hashlib.md5(repr((request.path, version)).encode("utf-8")).hexdigest()
+
+        if etag and etag in parse_etags(request.META.get("HTTP_IF_NONE_MATCH", "")):
+            response = HttpResponseNotModified()
+            response["ETag"] = quote_etag(etag)
+            return response
+
         data = f(request, *args, **kwargs)
-        response = HttpResponse(json.dumps(data, sort_keys=True, indent=4),
-                                content_type="application/json")
+        content = json.dumps(data, sort_keys=True, indent=4)
+
+        response = HttpResponse(content, content_type="application/json")
         if not data:
             response.status_code = 404
             response.reason_phrase = 'Not found'
+        elif etag:
+            response["ETag"] = quote_etag(etag)
         return response
     return to_json
 
 
-@json_response
+def first_row(query):
+    rows = list(query[:1])
+    return rows[0] if rows else None
+
+
+def user_stamp(request, id):
+    profile = first_row(User.objects.filter(pk=id).values_list("profile__date_joined", "profile__last_login", "pubkey"))
+    if profile is None:
+        return None
+
+    return profile, Vote.objects.filter(author_id=id).count()
+
+
+def post_stamp(request, id):
+    return first_row(Post.objects.filter(pk=id).values_list(
+        "lastedit_date", "lastedit_user_id", "status", "vote_count", "thread_score", "rank", "view_count",
+        "reply_count", "comment_count", "book_count", "subs_count", "has_accepted", "root__reply_count",
+    ))
+
+
+def vote_stamp(request, id):
+    # votes do not change once they are created
+    return first_row(Vote.objects.filter(pk=id).values_list("id", "type"))
+
+
+def stats_stamp(request, *args):
+    # the stats of a past day do not change, they are also kept in a stats file
+    return args
+
+
+@json_response(stamp=user_stamp)
 def user_details(request, id):
     """
     Details for a user.
@@ -59,7 +111,7 @@ def user_details(request, id):
     return data
 
 
-@json_response
+@json_response(stamp=post_stamp)
 def post_details(request, id):
     """
     Details for a post.
@@ -103,7 +155,7 @@ def post_details(request, id):
     return data
 
 
-@json_response
+@json_response(stamp=vote_stamp)
 def vote_details(request, id):
     """
     Details for a vote.
@@ -128,7 +180,7 @@ def vote_details(request, id):
     return data
 
 
-@json_response
+@json_response(stamp=stats_stamp)
 def daily_stats_on_day(request, day):
     """
     Statistics about this website for the given day.
@@ -145,7 +197,7 @@ def daily_stats_on_day(request, day):
     return compute_stats(date)
 
 
-@json_response
+@json_response(stamp=stats_stamp)
 def daily_stats_on_date(request, year, month, day):
     """
     Statistics about this website for the given date.
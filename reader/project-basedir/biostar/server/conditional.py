@@ -0,0 +1,73 @@
+"""
+Conditional GET for threads and feeds, the other cached pages get their ETag from pagecache
+
+Each view gets an ETag from a cheap version stamp of what the page shows, and Django's condition decorator
+answers 304 Not Modified when it matches If-None-Match, before the view renders anything.
+
+    thread -- the thread version of threadcache, which follows the last edit, votes and accepted answer
+              of every post, plus the state of the active bounties
+    feed   -- the last edit of the posts in the feed
+
+A stamp that cannot be computed leaves the response without an ETag, the view then handles the request.
+"""
+import hashlib
+
+from django.utils import timezone
+from django.views.decorators.http import condition
+
+from biostar.apps.posts.models import Post
+from biostar.apps.bounty.models import Bounty
+from biostar.server import threadcache
+
+from common.log import logger
+
+
+def digest(*parts):
+    return hashlib.md5(repr(parts).encode("utf-8")).hexdigest()
+
+
+def thread_etag(request, pk, **kwargs):
+    root_ids = list(Post.objects.filter(pk=pk).values_list("root_id", flat=True))
+    if len(root_ids) == 0:
+        return None
+
+    root = Post(id=root_ids[0])
+
+    # a bounty shows a candidate award until award_time passes, then the award
+    now = timezone.now()
+    bounties = [
+        (bounty_id, award_time is not None and award_time <= now)
+        for bounty_id, award_time in Bounty.objects.filter(
+            post_id=root.id, is_active=True, is_payed=False
+        ).values_list("id", "award_time")
+    ]
+
+    return digest(pk, threadcache.thread_version(root), bounties)
+
+
+def feed_etag(feed):
+    def etag(request, *args, **kwargs):
+        try:
+            obj = feed.get_object(request, *args, **kwargs)
+
+            # the same check as Feed, items takes the object only if it has a second argument
+            if feed.items.__func__.__code__.co_argcount == 2:
+                items = feed.items(obj)
+            else:
+                items = feed.items()
+
+            return digest(request.path, [(post.id, post.lastedit_date) for post in items])
+
+        except Exception as e:
+            logger.error("Could not compute the ETag of feed {}: {}".format(request.path, e))
+            return None
+
+    return etag
+
+
+def conditional_thread(view):
+    return condition(etag_func=thread_etag)(view)
+
+
+def conditional_feed(feed):
+    return condition(etag_func=feed_etag(feed))(feed)
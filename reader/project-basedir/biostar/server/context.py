@@ -1,10 +1,8 @@
 __author__ = 'ialbert'
 from django.conf import settings
 from django.core.cache import cache
-from biostar.apps.users.models import User
-from biostar.apps.posts.models import Post, Vote
-from biostar.apps.badges.models import Award
 from biostar.apps import util
+from biostar.server import sidebar
 
 from common import const
 from biostar import VERSION
@@ -17,50 +15,6 @@ LOG2 = log(2)
 CACHE_TIMEOUT = settings.CACHE_TIMEOUT
 
 
-def get_recent_votes():
-    # TODO: this should be done in the background and periodic intervals, not for every request
-
-    votes = Vote.objects.filter(post__status=Post.OPEN)
-
-    # Hide test data
-    votes = votes.exclude(is_fake_test_data=True)
-
-    votes = votes.select_related("post").order_by("post__id")
-
-    # poor man's DISTINCT ON (because it's only supported in PostgreSQL)
-    distinct_votes = []
-    prev_vote = None
-    for v in votes:
-        if prev_vote and v.post.id != prev_vote.post.id:
-            distinct_votes.append(v)
-        prev_vote = v
-
-    distinct_votes.sort(key=lambda x: x.date, reverse=True)
-
-    return distinct_votes[:settings.RECENT_VOTE_COUNT]
-
-
-
-def get_recent_users():
-    users = User.objects.all().select_related("profile").order_by("-profile__last_login")[:settings.RECENT_USER_COUNT]
-    return users
-
-
-def get_recent_awards():
-    awards = Award.objects.all().select_related("user", "badge")
-    awards = awards.exclude(is_fake_test_data=True)  # Hide test data
-    awards = awards.order_by("-date")[:6]
-    return awards
-
-
-def get_recent_replies():
-    posts = Post.objects.filter(type__in=(Post.ANSWER, Post.COMMENT), root__status=Post.OPEN).select_related(("author"))
-    posts = posts.exclude(is_fake_test_data=True)  # Hide test data
-    posts = posts.order_by("-creation_date")
-    posts = posts[:settings.RECENT_POST_COUNT]
-    return posts
-
-
 TRAFFIC_KEY = "traffic"
 
 
@@ -82,6 +36,7 @@ def banner_trigger(request, half=settings.HALF_LIFE):
 def shortcuts(request):
     # These values will be added to each context
 
+    snapshot = sidebar.get_snapshot()
     context = {
         "SITE_STYLE_CSS": settings.SITE_STYLE_CSS,
         "SITE_LOGO": settings.SITE_LOGO,
@@ -91,10 +46,10 @@ def shortcuts(request):
         "BUILD_TIME": VERSION['build_time'],
         "SERVER_START_TIME": VERSION['server_start_time'],
         "TRAFFIC": get_traffic(),
-        'RECENT_REPLIES': get_recent_replies(),
-        'RECENT_VOTES': get_recent_votes(),
-        "RECENT_USERS": get_recent_users(),
-        "RECENT_AWARDS": get_recent_awards(),
+        'RECENT_REPLIES': sidebar.recent_replies(snapshot),
+        'RECENT_VOTES': sidebar.recent_votes(snapshot),
+        "RECENT_USERS": sidebar.recent_users(snapshot),
+        "RECENT_AWARDS": sidebar.recent_awards(snapshot),
         'USE_COMPRESSOR': settings.USE_COMPRESSOR,
         'SITE_ADMINS': settings.ADMINS,
         'TOP_BANNER': settings.TOP_BANNER,
@@ -12,6 +12,7 @@ from biostar.apps.messages.models import Message
 from collections import defaultdict
 from biostar.awards import create_user_award
 
+from common import metrics
 from common.log import logger
 
 
@@ -33,3 +34,12 @@ class Visit(object):
     def process_request(self, request, weeks=settings.COUNT_INTERVAL_WEEKS):
         global ANON_USER
         pass
+
+
+class MetricsSnapshot(object):
+    """
+    Makes sure this worker writes its metrics snapshot, see common.metrics.start_snapshot_thread
+    """
+
+    def process_request(self, request):
+        metrics.start_snapshot_thread(settings.METRICS_SNAPSHOT_DIR, "web", settings.METRICS_SNAPSHOT_SECONDS)
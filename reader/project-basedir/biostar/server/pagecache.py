@@ -0,0 +1,115 @@
+"""
+Full page cache for the public pages, shared by all workers through the default cache backend
+
+The site has no sessions or cookies, so a GET of a post list or a thread is the same for every visitor.
+Responses are cached by path and the query parameters that change the page, prefixed with a version stamp.
+Changing the stamp (bump_version) retires every cached page at once: it happens when a post, vote or award
+is saved in this process, and when the writer confirms a payment. Pages also expire after
+PAGE_CACHE_TIMEOUT, which bounds how late changes that the reader never sees show up.
+
+A hit costs two cache lookups and no database queries. Cached pages carry an ETag of their content, so a
+repeat request with a matching If-None-Match gets 304 Not Modified at the same cost.
+"""
+import time
+import uuid
+import hashlib
+
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models.signals import post_save, post_delete
+from django.http import HttpResponseNotModified
+from django.utils.http import urlencode, parse_etags, quote_etag
+
+from biostar.apps.posts.models import Post, Vote
+from biostar.apps.badges.models import Award
+
+from common import metrics
+
+
+VERSION_KEY = "page-cache-version"
+VERSION_TIMEOUT = 30 * 24 * 3600
+
+# Query parameters that change the page, any other parameter is left out of the key
+CACHED_PARAMS = ("sort", "limit", "page", "q")
+
+REQUESTS = metrics.counter("reader_page_cache_requests_total", "Page cache lookups", ["view", "result"])
+
+
+def bump_version(*args, **kwargs):
+    """
+    Retire all cached pages, also used as a signal receiver
+    """
+    cache.set(VERSION_KEY, "{}-{}".format(int(time.time()), uuid.uuid4().hex[:8]), VERSION_TIMEOUT)
+
+
+def get_version():
+    version = cache.get(VERSION_KEY)
+    if version is None:
+        bump_version()
+        version = cache.get(VERSION_KEY)
+
+    return version
+
+
+def page_key(request, version):
+    params = sorted((name, request.GET[name]) for name in CACHED_PARAMS if name in request.GET)
+    url = u"{}?{}".format(request.path, urlencode(params))
+    return "page:{}:{}".format(version, hashlib.md5(url.encode("utf-8")).hexdigest())
+
+
+def not_modified(request, response):
+    etag = response.get("ETag")
+    if etag is None or etag.strip('"') not in parse_etags(request.META.get("HTTP_IF_NONE_MATCH", "")):
+        return None
+
+    not_modified_response = HttpResponseNotModified()
+    not_modified_response["ETag"] = etag
+    return not_modified_response
+
+
+def cache_page(view, etag=True):
+    """
+        url(r'^$', pagecache.cache_page(views.PostList.as_view()), name="home"),
+
+    With etag=False the cached pages get no ETag, for views that are wrapped in a cheaper conditional check.
+    """
+    view_name = getattr(view, "__name__", "view")
+
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        if request.method not in ("GET", "HEAD"):
+            return view(request, *args, **kwargs)
+
+        key = page_key(request, get_version())
+        response = cache.get(key)
+        if response is not None:
+            REQUESTS.inc(view=view_name, result="hit")
+            return not_modified(request, response) or response
+
+        REQUESTS.inc(view=view_name, result="miss")
+        response = view(request, *args, **kwargs)
+        if response.status_code != 200 or response.cookies or getattr(response, "streaming", False):
+            return response
+
+        def store(rendered):
+            if etag:
+                rendered["ETag"] = quote_etag(hashlib.md5(rendered.content).hexdigest())
+
+            cache.set(key, rendered, settings.PAGE_CACHE_TIMEOUT)
+            return not_modified(request, rendered)
+
+        # TemplateResponse is rendered after the view returns, a callback can replace the response
+        if hasattr(response, "render") and callable(response.render):
+            response.add_post_render_callback(store)
+            return response
+
+        return store(response) or response
+
+    return wrapper
+
+
+for model in (Post, Vote, Award):
+    post_save.connect(bump_version, sender=model, dispatch_uid="pagecache-save-{}".format(model.__name__))
+    post_delete.connect(bump_version, sender=model, dispatch_uid="pagecache-delete-{}".format(model.__name__))
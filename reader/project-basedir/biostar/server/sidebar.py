@@ -0,0 +1,113 @@
+"""
+Snapshot of the sidebar lists: recent votes, replies, users and awards
+
+The lists are computed by a few set-based queries and only their ids are kept in the cache, so a page
+costs one cache lookup plus primary key lookups of a handful of rows, and only if it renders the sidebar.
+The snapshot is recomputed after SIDEBAR_REFRESH_SECONDS by a single request while the others keep
+serving the previous one, and marked stale when the writer reports a confirmed payment (see invalidate).
+"""
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Max
+
+from biostar.apps.users.models import User
+from biostar.apps.posts.models import Post, Vote
+from biostar.apps.badges.models import Award
+
+from common.log import logger
+
+
+SNAPSHOT_KEY = "sidebar-snapshot"
+REFRESH_LOCK_KEY = "sidebar-snapshot-refresh"
+
+# The snapshot outlives its refresh interval, so a stale one can be served while it is recomputed
+SNAPSHOT_TIMEOUT = 10 * settings.SIDEBAR_REFRESH_SECONDS
+REFRESH_LOCK_TIMEOUT = 10
+
+RECENT_AWARD_COUNT = 6
+
+
+def recent_vote_ids():
+    # The latest vote of each open post, most recently voted posts first
+    votes = Vote.objects.filter(post__status=Post.OPEN)
+    votes = votes.exclude(is_fake_test_data=True)  # Hide test data
+    latest = votes.values("post_id").annotate(vote_id=Max("id"), vote_date=Max("date"))
+    latest = latest.order_by("-vote_date")[:settings.RECENT_VOTE_COUNT]
+    return [row["vote_id"] for row in latest]
+
+
+def recent_reply_ids():
+    posts = Post.objects.filter(type__in=(Post.ANSWER, Post.COMMENT), root__status=Post.OPEN)
+    posts = posts.exclude(is_fake_test_data=True)  # Hide test data
+    posts = posts.order_by("-creation_date")
+    return list(posts.values_list("id", flat=True)[:settings.RECENT_POST_COUNT])
+
+
+def recent_user_ids():
+    users = User.objects.order_by("-profile__last_login")
+    return list(users.values_list("id", flat=True)[:settings.RECENT_USER_COUNT])
+
+
+def recent_award_ids():
+    awards = Award.objects.exclude(is_fake_test_data=True)  # Hide test data
+    awards = awards.order_by("-date")
+    return list(awards.values_list("id", flat=True)[:RECENT_AWARD_COUNT])
+
+
+def compute():
+    start_time = time.time()
+    snapshot = {
+        "votes": recent_vote_ids(),
+        "replies": recent_reply_ids(),
+        "users": recent_user_ids(),
+        "awards": recent_award_ids(),
+        "computed_at": time.time(),
+    }
+    cache.set(SNAPSHOT_KEY, snapshot, SNAPSHOT_TIMEOUT)
+    logger.info("Computed the sidebar snapshot in {:.3f} seconds".format(time.time() - start_time))
+
+    return snapshot
+
+
+def get_snapshot():
+    snapshot = cache.get(SNAPSHOT_KEY)
+    if snapshot is None:
+        return compute()
+
+    if time.time() - snapshot["computed_at"] >= settings.SIDEBAR_REFRESH_SECONDS:
+        # only the request that gets the lock refreshes, the others serve the stale snapshot
+        if cache.add(REFRESH_LOCK_KEY, 1, REFRESH_LOCK_TIMEOUT):
+            try:
+                snapshot = compute()
+            finally:
+                cache.delete(REFRESH_LOCK_KEY)
+
+    return snapshot
+
+
+def invalidate():
+    """
+    New activity, e.g. a confirmed vote or reply, the next page recomputes the snapshot
+    """
+    snapshot = cache.get(SNAPSHOT_KEY)
+    if snapshot is not None:
+        snapshot["computed_at"] = 0
+        cache.set(SNAPSHOT_KEY, snapshot, SNAPSHOT_TIMEOUT)
+
+
+def recent_votes(snapshot):
+    return Vote.objects.filter(id__in=snapshot["votes"]).select_related("post").order_by("-date")
+
+
+def recent_replies(snapshot):
+    return Post.objects.filter(id__in=snapshot["replies"]).select_related("author").order_by("-creation_date")
+
+
+def recent_users(snapshot):
+    return User.objects.filter(id__in=snapshot["users"]).select_related("profile").order_by("-profile__last_login")
+
+
+def recent_awards(snapshot):
+    return Award.objects.filter(id__in=snapshot["awards"]).select_related("user", "badge").order_by("-date")
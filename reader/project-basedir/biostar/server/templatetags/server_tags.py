@@ -18,6 +18,7 @@ from common import general_util
 from common import json_util
 from biostar.server.views import LATEST
 from biostar.apps.posts.models import PostPreview
+from biostar.server import threadcache
 
 import coolname as coolname_lib
 
@@ -372,7 +373,7 @@ def render_comments(request, post, tree):
         # reload the template to get changes
         COMMENT_BODY = template.loader.get_template(COMMENT_TEMPLATE)
     if post.id in tree:
-        text = traverse_comments(request=request, post=post, tree=tree)
+        text = threadcache.get_comments(post, lambda: traverse_comments(request=request, post=post, tree=tree))
     else:
         text = ''
     return text
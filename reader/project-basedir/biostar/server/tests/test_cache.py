@@ -0,0 +1,174 @@
+import logging
+from datetime import timedelta
+
+from django.core.cache import get_cache
+from django.db.models import F
+from django.http import HttpResponse
+from django.test import TestCase
+from django.test.client import RequestFactory
+
+from biostar.apps.posts.models import Post, Vote
+from biostar.apps.users.models import User
+from biostar.apps.badges.models import Badge, Award
+from biostar.server import pagecache
+from biostar.server import threadcache
+from biostar.server import sidebar
+from biostar.server import conditional
+
+from common import general_util
+
+
+logging.disable(logging.WARNING)
+haystack_logger = logging.getLogger('haystack')
+
+
+class CacheTestCase(TestCase):
+    """
+    The test settings use the dummy cache, the cached modules get a local memory cache instead
+    """
+    cached_modules = (pagecache, threadcache, sidebar)
+
+    def setUp(self):
+        # Disable haystack logger (testing will raise errors on more_like_this field in templates).
+        haystack_logger.setLevel(logging.CRITICAL)
+
+        self.cache = get_cache('django.core.cache.backends.locmem.LocMemCache', LOCATION='biostar-tests')
+        self.cache.clear()
+        self.dummy_caches = [module.cache for module in self.cached_modules]
+        for module in self.cached_modules:
+            module.cache = self.cache
+
+        self.factory = RequestFactory()
+        self.user = User.objects.create(pubkey='test@test.com')
+        self.post = Post(title="Post 1, title needs to be sufficiently long", content="Body of the question",
+                         tag_val="tag_val", author=self.user, type=Post.QUESTION)
+        self.post.save()
+
+    def tearDown(self):
+        for module, dummy_cache in zip(self.cached_modules, self.dummy_caches):
+            module.cache = dummy_cache
+
+
+class PageCacheTest(CacheTestCase):
+    def setUp(self):
+        super(PageCacheTest, self).setUp()
+        self.renders = []
+
+        def view(request):
+            self.renders.append(request.path)
+            return HttpResponse("page {}".format(len(self.renders)))
+
+        self.view = pagecache.cache_page(view)
+
+    def test_version_is_bumped_on_save(self):
+        versions = [pagecache.get_version()]
+
+        self.post.content = "Edited body of the question"
+        self.post.save()
+        versions.append(pagecache.get_version())
+
+        Vote.objects.create(author=self.user, post=self.post, type=Vote.UP)
+        versions.append(pagecache.get_version())
+
+        badge = Badge.objects.create(name="Badge")
+        Award.objects.create(badge=badge, user=self.user, date=general_util.now())
+        versions.append(pagecache.get_version())
+
+        self.assertEqual(len(set(versions)), 4)
+
+    def test_save_retires_cached_pages(self):
+        self.view(self.factory.get("/"))
+        self.view(self.factory.get("/"))
+        self.assertEqual(len(self.renders), 1)
+
+        Vote.objects.create(author=self.user, post=self.post, type=Vote.UP)
+        self.view(self.factory.get("/"))
+        self.assertEqual(len(self.renders), 2)
+
+    def test_hit_makes_no_queries(self):
+        self.view(self.factory.get("/", {"sort": "votes", "utm_source": "feed"}))
+
+        with self.assertNumQueries(0):
+            response = self.view(self.factory.get("/", {"sort": "votes"}))
+
+        self.assertEqual(response.content, b"page 1")
+        self.assertEqual(len(self.renders), 1)
+
+    def test_not_modified(self):
+        etag = self.view(self.factory.get("/"))["ETag"]
+
+        response = self.view(self.factory.get("/", HTTP_IF_NONE_MATCH=etag))
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response["ETag"], etag)
+
+        # the next page is rendered again and has other content
+        pagecache.bump_version()
+        response = self.view(self.factory.get("/", HTTP_IF_NONE_MATCH=etag))
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+
+
+class ThreadCacheTest(CacheTestCase):
+    def test_version_changes_on_vote_and_edit(self):
+        versions = [threadcache.thread_version(self.post)]
+
+        # the writer applies a paid upvote by updating the counts
+        Post.objects.filter(pk=self.post.id).update(vote_count=F("vote_count") + 1)
+        versions.append(threadcache.thread_version(self.post))
+
+        self.post.content = "Edited body of the question"
+        self.post.lastedit_date = self.post.lastedit_date + timedelta(seconds=1)
+        self.post.save()
+        versions.append(threadcache.thread_version(self.post))
+
+        self.assertEqual(len(set(versions)), 3)
+
+    def test_comments_are_cached_per_version(self):
+        renders = []
+
+        def render():
+            renders.append(1)
+            return "comments {}".format(len(renders))
+
+        self.post.thread_version = threadcache.thread_version(self.post)
+        self.assertEqual(threadcache.get_comments(self.post, render), "comments 1")
+        self.assertEqual(threadcache.get_comments(self.post, render), "comments 1")
+
+        Post.objects.filter(pk=self.post.id).update(vote_count=F("vote_count") + 1)
+        self.post.thread_version = threadcache.thread_version(self.post)
+        self.assertEqual(threadcache.get_comments(self.post, render), "comments 2")
+
+
+class ConditionalThreadTest(CacheTestCase):
+    def setUp(self):
+        super(ConditionalThreadTest, self).setUp()
+        self.view = conditional.conditional_thread(lambda request, pk: HttpResponse("thread"))
+
+    def get(self, **headers):
+        return self.view(self.factory.get("/{}/".format(self.post.id), **headers), pk=self.post.id)
+
+    def test_not_modified_until_vote(self):
+        etag = self.get()["ETag"]
+
+        response = self.get(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        Post.objects.filter(pk=self.post.id).update(vote_count=F("vote_count") + 1)
+        response = self.get(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+
+
+class SidebarTest(CacheTestCase):
+    def test_invalidate_recomputes_snapshot(self):
+        snapshot = sidebar.get_snapshot()
+        self.assertEqual(snapshot["votes"], [])
+
+        vote = Vote.objects.create(author=self.user, post=self.post, type=Vote.UP)
+        Post.objects.filter(pk=self.post.id).update(status=Post.OPEN)
+
+        # served from the cache until the writer reports a payment
+        self.assertEqual(sidebar.get_snapshot()["votes"], [])
+
+        sidebar.invalidate()
+        self.assertEqual(sidebar.get_snapshot()["votes"], [vote.id])
@@ -0,0 +1,77 @@
+"""
+Cached threads for PostDetails and render_comments
+
+The thread version is a digest of what the page shows for each post of the thread: status, vote count,
+accepted answer and last edit. It is one narrow query, and every new or deleted reply, edit, vote or
+accept changes it, so cached entries never need to be invalidated and simply expire once unused.
+
+Two things are cached per thread version: the posts of the thread, already marked with has_upvote and
+has_bookmark, and the rendered comments under each post. The vote urls in the comments only change once an
+hour and older ones keep working, see MemoStartView.
+"""
+import hashlib
+
+from django.core.cache import cache
+
+from biostar.apps.posts.models import Post, Vote
+from biostar.apps.posts.auth import post_permissions
+
+
+THREAD_TIMEOUT = 3600
+
+
+def thread_version(root):
+    rows = Post.objects.filter(root_id=root.id).order_by("id").values_list(
+        "id", "status", "vote_count", "has_accepted", "lastedit_date")
+    return hashlib.md5(repr(list(rows)).encode("utf-8")).hexdigest()
+
+
+def load_thread(request, root, version):
+    thread = [post_permissions(request=request, post=post) for post in Post.objects.get_thread(root)]
+
+    store = {Vote.UP: set(), Vote.BOOKMARK: set()}
+
+    pids = [p.id for p in thread]
+    votes = Vote.objects.filter(post_id__in=pids).values_list("post_id", "type")
+
+    for post_id, vote_type in votes:
+        store.setdefault(vote_type, set()).add(post_id)
+
+    for post in thread:
+        post.has_bookmark = post.id in store[Vote.BOOKMARK]
+        post.has_upvote = post.id in store[Vote.UP]
+        post.thread_version = version
+
+    return thread
+
+
+def get_thread(request, root):
+    """
+    The posts of the thread in display order, with has_upvote, has_bookmark and thread_version set
+    """
+    version = thread_version(root)
+    key = "thread:{}:{}".format(root.id, version)
+
+    thread = cache.get(key)
+    if thread is None:
+        thread = load_thread(request, root, version)
+        cache.set(key, thread, THREAD_TIMEOUT)
+
+    return thread
+
+
+def get_comments(post, render):
+    """
+    The comments under post rendered by render(), served from the cache when post came from get_thread
+    """
+    version = getattr(post, "thread_version", None)
+    if version is None:
+        return render()
+
+    key = "comments:{}:{}".format(post.id, version)
+    html = cache.get(key)
+    if html is None:
+        html = render()
+        cache.set(key, html, THREAD_TIMEOUT)
+
+    return html
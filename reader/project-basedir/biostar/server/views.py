@@ -9,6 +9,7 @@ from django.conf import settings
 from django.core.cache import cache
 from django.core.cache import cache
 from django import shortcuts
+from django.http import HttpResponse
 from django.http import HttpResponseRedirect
 from django.core.paginator import Paginator
 from django.http import Http404
@@ -29,12 +30,14 @@ from biostar.apps.posts.auth import post_permissions
 from biostar.apps.util import ln
 from biostar.apps.util.email_reply_parser import EmailReplyParser
 from biostar.apps.bounty.models import Bounty, BountyAward
+from biostar.server import threadcache
 
 from common import general_util
 from common import html_util
 from common import json_util
 from common.const import OrderedDict
 from common import const
+from common import metrics
 from common import validators
 from common.log import logger
 
@@ -336,8 +339,8 @@ class PostDetails(DetailView):
             return obj
 
         # Populate the object to build a tree that contains all posts in the thread.
-        # Answers sorted before comments.
-        thread = [post_permissions(request=self.request, post=post) for post in Post.objects.get_thread(obj)]
+        # Answers sorted before comments. Cached per thread version, see threadcache.
+        thread = threadcache.get_thread(self.request, obj)
 
         # Do a little preprocessing.
         answers = [p for p in thread if p.type == Post.ANSWER and not p.is_fake_test_data]
@@ -347,24 +350,17 @@ class PostDetails(DetailView):
             if post.type == Post.COMMENT:
                 tree.setdefault(post.parent_id, []).append(post)
 
-        store = {Vote.UP: set(), Vote.BOOKMARK: set()}
-
-        pids = [p.id for p in thread]
-        votes = Vote.objects.filter(post_id__in=pids).values_list("post_id", "type")
-
-        for post_id, vote_type in votes:
-            store.setdefault(vote_type, set()).add(post_id)
-
-        # Shortcuts to each storage.
-        bookmarks = store[Vote.BOOKMARK]
-        upvotes = store[Vote.UP]
+        # The top level post is part of the thread
+        for post in thread:
+            if post.id == obj.id:
+                obj.has_bookmark = post.has_bookmark
+                obj.has_upvote = post.has_upvote
+                obj.thread_version = post.thread_version
 
         # Can the current user accept answers
         can_accept = True
 
         def decorate(post):
-            post.has_bookmark = post.id in bookmarks
-            post.has_upvote = post.id in upvotes
             post.can_accept = can_accept or post.has_accepted
 
         # Add attributes by mutating the objects
@@ -600,3 +596,16 @@ def tag_redirect(request, tag):
     except Exception, exc:
         logger.error("Unable to redirect: %s, '%s'", exc, request)
         return shortcuts.redirect("/")
+
+
+class MetricsView(View):
+    """
+    Reader metrics in the Prometheus text format, merged from the snapshots of the live web workers
+    """
+
+    def get(self, request, *args, **kwargs):
+        snapshots = metrics.read_snapshots(settings.METRICS_SNAPSHOT_DIR, max_age=settings.METRICS_SNAPSHOT_MAX_AGE)
+        return HttpResponse(
+            metrics.render(metrics.merge_snapshots(snapshots)),
+            content_type="text/plain; version=0.0.4; charset=utf-8"
+        )
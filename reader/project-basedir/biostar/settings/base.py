@@ -235,6 +235,7 @@ MIDDLEWARE_CLASSES = (
     'django.middleware.common.CommonMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     'biostar.server.middleware.Visit',
+    'biostar.server.middleware.MetricsSnapshot',
 )
 
 ROOT_URLCONF = 'biostar.urls'
@@ -365,6 +366,9 @@ RECENT_VOTE_COUNT = 7
 RECENT_USER_COUNT = 7
 RECENT_POST_COUNT = 12
 
+# The sidebar lists are recomputed at most this often, or sooner after a payment is confirmed.
+SIDEBAR_REFRESH_SECONDS = 30
+
 # Time between two accesses from the same IP to qualify as a different view.
 POST_VIEW_MINUTES = 5
 
@@ -376,11 +380,24 @@ COMPRESS_OFFLINE_CONTEXT = {
     'SITE_STYLE_CSS': SITE_STYLE_CSS,
 }
 
+# Full pages are cached for anonymous GETs, see biostar.server.pagecache
+PAGE_CACHE_TIMEOUT = CACHE_TIMEOUT
+
+# Every web worker writes its metrics here, local/metrics merges the snapshots of the live workers and
+# deletes the ones of exited workers
+METRICS_SNAPSHOT_DIR = abspath(LIVE_DIR, "metrics")
+METRICS_SNAPSHOT_SECONDS = 15
+METRICS_SNAPSHOT_MAX_AGE = 120
+
 # The cache mechanism is deployment dependent. Override it externally.
+# The file based cache is shared by all gunicorn workers on the host.
 CACHES = {
     'default': {
-        'BACKEND': 'django.core.cache.backends.dummy.DummyCache' if DEBUG else 'django.core.cache.backends.locmem.LocMemCache',
-        'LOCATION': 'unique-snowflake'
+        'BACKEND': 'django.core.cache.backends.dummy.DummyCache' if DEBUG else 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': abspath(LIVE_DIR, 'cache'),
+        'OPTIONS': {
+            'MAX_ENTRIES': 10000,
+        },
     }
 }
 
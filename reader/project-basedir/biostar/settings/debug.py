@@ -18,6 +18,9 @@ if TOOLBAR:
 # We load the debug toolbar as well
 INSTALLED_APPS = list(INSTALLED_APPS)
 
+# The dev writer mocks lnd and accepts any signature, so let it do the checking
+LOCAL_VERIFYMESSAGE = False
+
 # Reader users the writers database
 DATABASE_NAME = abspath(HOME_DIR, '..', '..', 'writer', 'project-basedir', 'live', 'db.sqlite3')
 DATABASES = {
@@ -6,10 +6,10 @@ from django.contrib import admin
 admin.autodiscover()
 
 from django.views.generic import TemplateView
-from biostar.server import views, ajax, search, moderate, api
-from biostar.apps.posts.views import NewAnswer, NewPost, EditPost, PostPreviewView, VotePublishView, PostPublishView, AcceptPreviewView
+from biostar.server import views, ajax, search, moderate, api, pagecache, conditional
+from biostar.apps.posts.views import NewAnswer, NewPost, EditPost, PostPreviewView, VotePublishView, PostPublishView, AcceptPreviewView, MemoStartView
 from biostar.apps.users.views import DigestManager
-from biostar.apps.util.views import QRCode, PaymentCheck, ChannelOpenView, TakeCustodyView
+from biostar.apps.util.views import QRCode, PaymentCheck, ChannelOpenView, TakeCustodyView, PayoutStatusView
 from biostar.apps.bounty.views import BountyFormView, BountyPublishView
 import biostar.apps.info.views as info
 
@@ -18,19 +18,19 @@ from common.const import MEMO_RE
 urlpatterns = [
 
     # Post listing.
-    url(r'^$', views.PostList.as_view(), name="home"),
+    url(r'^$', pagecache.cache_page(views.PostList.as_view()), name="home"),
 
     # Listing of all tags.
-    url(r'^t/$', views.TagList.as_view(), name="tag-list"),
+    url(r'^t/$', pagecache.cache_page(views.TagList.as_view()), name="tag-list"),
 
     # Badge view details.
     url(r'^b/(?P<pk>\d+)/$', views.BadgeView.as_view(), name="badge-view"),
 
     # Badge list details.
-    url(r'^b/list/$', views.BadgeList.as_view(), name="badge-list"),
+    url(r'^b/list/$', pagecache.cache_page(views.BadgeList.as_view()), name="badge-list"),
 
     # Topic listing.
-    url(r'^t/(?P<topic>.+)/$', views.PostList.as_view(), name="topic-list"),
+    url(r'^t/(?P<topic>.+)/$', pagecache.cache_page(views.PostList.as_view()), name="topic-list"),
 
 
     # ==============================
@@ -61,7 +61,7 @@ urlpatterns = [
     # ==============================
 
     # The list of users.
-    url(r'^user/list/$', views.UserList.as_view(), name="user-list"),
+    url(r'^user/list/$', pagecache.cache_page(views.UserList.as_view()), name="user-list"),
 
     # User details.
     url(r'^u/(?P<pk>\d+)/$', views.UserDetails.as_view(), name="user-details"),
@@ -76,7 +76,7 @@ urlpatterns = [
 
     # Post details.
     # NOTICE: just the domain name followed by a forward slash and a number
-    url(r'^(?P<pk>\d+)/$', views.PostDetails.as_view(), name="post-details"),
+    url(r'^(?P<pk>\d+)/$', conditional.conditional_thread(pagecache.cache_page(views.PostDetails.as_view(), etag=False)), name="post-details"),
 
     # New post / answer / comment
     url(r'^x/new/post/$', views.NewPost.as_view(), name="new-post"),
@@ -90,6 +90,10 @@ urlpatterns = [
     url(r'^x/preview/accept/best_node/(?P<memo>{})/$'.format(MEMO_RE), AcceptPreviewView.as_view(), name="accept-preview"),
     url(r'^x/preview/accept/(?P<node_id>\d+)/(?P<memo>{})/$'.format(MEMO_RE), AcceptPreviewView.as_view(), name="accept-preview-node-selected"),
 
+    # Vote and accept buttons, the memo gets the current time, see MemoStartView
+    url(r'^x/start/vote/(?P<memo>{})/$'.format(MEMO_RE), MemoStartView.as_view(target_url_name="vote-publish"), name="vote-start"),
+    url(r'^x/start/accept/(?P<memo>{})/$'.format(MEMO_RE), MemoStartView.as_view(target_url_name="accept-preview"), name="accept-start"),
+
     # Publish (QR code Invoice)
     url(r'^x/publish/post/best_node/(?P<memo>{})/$'.format(MEMO_RE), PostPublishView.as_view(), name="post-publish"),
     url(r'^x/publish/post/(?P<node_id>\d+)/(?P<memo>{})/$'.format(MEMO_RE), PostPublishView.as_view(), name="post-publish-node-selected"),
@@ -106,6 +110,7 @@ urlpatterns = [
     # Take Custody
     url(r'^x/take/custody/best_node/(?P<award_id>\d+)/$', TakeCustodyView.as_view(), name="take-custody"),
     url(r'^x/take/custody/(?P<node_id>\d+)/(?P<award_id>\d+)/$', TakeCustodyView.as_view(), name="take-custody-node-selected"),
+    url(r'^x/take/custody/status/(?P<job_id>\d+)/$', PayoutStatusView.as_view(), name="payout-status"),
 
     # # Edit an existing post. (Not implemented)
     # url(r'^x/edit/(?P<pk>\d+)/$', EditPost.as_view(), name="post-edit"),
@@ -134,6 +139,9 @@ urlpatterns = [
      # Returns suggested tags
     url(r'^local/search/tags/', search.suggest_tags, name="suggest-tags"),
 
+    # Prometheus metrics of the web workers.
+    url(r'^local/metrics/$', views.MetricsView.as_view(), name="metrics"),
+
     # Local robots.txt.
     url(r'^robots\.txt$', TemplateView.as_view(template_name="robots.txt", content_type='text/plain'), name='robots'),
 
@@ -150,12 +158,12 @@ from biostar.server.feeds import LatestFeed, TagFeed, UserFeed, PostFeed, PostTy
 urlpatterns += [
 
     # RSS feeds
-    url(r'^feeds/latest/$', LatestFeed(), name='latest-feed'),
+    url(r'^feeds/latest/$', conditional.conditional_feed(LatestFeed()), name='latest-feed'),
 
-    url(r'^feeds/tag/(?P<text>[\w\-_\+!]+)/$', TagFeed(), name='tag-feed'),
-    url(r'^feeds/user/(?P<text>[\w\-_\+!]+)/$', UserFeed(), name='user-feed'),
-    url(r'^feeds/post/(?P<text>[\w\-_\+!]+)/$', PostFeed(), name='post-feed' ),
-    url(r'^feeds/type/(?P<text>[\w\-_\+!]+)/$', PostTypeFeed(), name='post-type'),
+    url(r'^feeds/tag/(?P<text>[\w\-_\+!]+)/$', conditional.conditional_feed(TagFeed()), name='tag-feed'),
+    url(r'^feeds/user/(?P<text>[\w\-_\+!]+)/$', conditional.conditional_feed(UserFeed()), name='user-feed'),
+    url(r'^feeds/post/(?P<text>[\w\-_\+!]+)/$', conditional.conditional_feed(PostFeed()), name='post-feed' ),
+    url(r'^feeds/type/(?P<text>[\w\-_\+!]+)/$', conditional.conditional_feed(PostTypeFeed()), name='post-type'),
 ]
 
 urlpatterns += [
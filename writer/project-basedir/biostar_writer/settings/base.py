@@ -85,6 +85,8 @@ MIDDLEWARE = [
     'django.contrib.sessions.middleware.SessionMiddleware',  # required for auth
     'django.contrib.auth.middleware.AuthenticationMiddleware',  # required for auth
     'django.middleware.csrf.CsrfViewMiddleware',  # useful, enabled by sessions
+
+    'lner.middleware.MetricsSnapshotMiddleware',
 ]
 
 ROOT_URLCONF = 'biostar_writer.urls'
@@ -176,3 +178,22 @@ SITE_DOMAIN = get_env("SITE_DOMAIN", __DEFAULT_SITE_DOMAIN)
 
 # biostar-ln specific config
 MOCK_LN_CLIENT = False
+
+# rpcservers that the gRPC client (rpc_client=grpc) connects to without TLS and macaroon, e.g. run_fake_lnd
+LNRPC_INSECURE_RPCSERVERS = []
+
+# Process invoices of rpc_client=grpc nodes with "manage.py stream_invoices" (SubscribeInvoices) instead of run_many
+STREAM_INVOICES = False
+STREAM_RECONCILE_SECONDS = 60  # listinvoices pass for expiry and global checkpoint, then resubscribe
+
+# Longest time ln/waitcheck holds a request while waiting for a checkpoint
+LONG_POLL_MAX_SECONDS = 25
+
+# A payout job that is still running after this long is failed, e.g. its queue-payouts worker crashed
+PAYOUT_JOB_TIMEOUT = 900
+
+# run_many, stream_invoices and every web worker write their metrics here, ln/metrics merges the snapshots
+# that were rewritten within METRICS_SNAPSHOT_MAX_AGE and deletes the older ones
+METRICS_SNAPSHOT_DIR = os.path.join(BASE_DIR, "live", "metrics")
+METRICS_SNAPSHOT_SECONDS = 15  # how often web workers write theirs, None to not write them
+METRICS_SNAPSHOT_MAX_AGE = 300
@@ -20,3 +20,8 @@ INVOICE_RETENTION = timedelta(weeks=1)  # how long to keep invoice requests and
 AWARD_TIMEDELTA = timedelta(days=3)
 AWARD_TIMEDELTA = timedelta(seconds=30)
 CLAIM_TIMEDELTA = timedelta(days=7)
+
+# Verify lnd signmessage signatures in-process (common.signmessage) instead of calling lnd's verifymessage
+LOCAL_VERIFYMESSAGE = True
+# Also for the author of a new post, which accepts keys that are not in lnd's channel graph
+LOCAL_VERIFYMESSAGE_NEW_AUTHORS = False
@@ -25,8 +25,11 @@ router = routers.DefaultRouter()
 router.register(r'ln/list', lner.views.LightningNodeViewSet)
 router.register(r'ln/addinvoice', lner.views.CreateInvoiceViewSet, basename='invoice')
 router.register(r'ln/check', lner.views.CheckPaymentViewSet, basename='check')
+router.register(r'ln/waitcheck', lner.views.WaitPaymentViewSet, basename='waitcheck')
 router.register(r'ln/verifymessage', lner.views.VerifyMessageViewSet, basename='verifymessage')
 router.register(r'ln/payaward', lner.views.PayAwardViewSet, basename='payaward')
+router.register(r'ln/payawardstatus', lner.views.PayAwardStatusViewSet, basename='payawardstatus')
+router.register(r'ln/metrics', lner.views.MetricsViewSet, basename='metrics')
 
 urlpatterns = []
 
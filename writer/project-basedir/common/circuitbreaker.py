@@ -0,0 +1,79 @@
+"""
+Circuit breaker for calls to a dependency that can go down
+
+Shared by the reader (Python 2) and the writer (Python 3).
+"""
+import time
+import threading
+
+from common.log import logger
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class CircuitBreaker(object):
+    """
+    After failure_threshold consecutive failures the circuit opens and calls fail fast with CircuitOpenError.
+    Once reset_timeout seconds pass one trial call is let through (half-open), if it succeeds the circuit
+    closes again, if it fails the circuit stays open for another reset_timeout. A trial call that does not
+    report back within reset_timeout counts as failed, and the next call becomes the trial.
+
+        breaker.before_call()  # raises CircuitOpenError
+        ... make the call, then breaker.record_success() or breaker.record_failure()
+
+    Every call that gets through has to report back, including the ones that raise an unexpected exception.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=30):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+
+        self.lock = threading.Lock()
+        self.state = CircuitBreaker.CLOSED
+        self.failures = 0
+        self.opened_at = None
+
+    def before_call(self):
+        with self.lock:
+            if self.state == CircuitBreaker.CLOSED:
+                return
+
+            if self.state == CircuitBreaker.HALF_OPEN and time.time() - self.opened_at >= self.reset_timeout:
+                logger.error("Circuit {} trial call did not report back, opening again".format(self.name))
+                self.state = CircuitBreaker.OPEN
+
+            if self.state == CircuitBreaker.OPEN and time.time() - self.opened_at >= self.reset_timeout:
+                logger.info("Circuit {} is half-open, letting one trial call through".format(self.name))
+                self.state = CircuitBreaker.HALF_OPEN
+                self.opened_at = time.time()
+                return
+
+            raise CircuitOpenError(
+                "Circuit {} is {}, failing fast after {} consecutive failures".format(self.name, self.state, self.failures)
+            )
+
+    def record_success(self):
+        with self.lock:
+            if self.state != CircuitBreaker.CLOSED:
+                logger.info("Circuit {} is closed again".format(self.name))
+
+            self.state = CircuitBreaker.CLOSED
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == CircuitBreaker.HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != CircuitBreaker.OPEN:
+                    logger.error("Circuit {} opened after {} consecutive failures".format(self.name, self.failures))
+
+                self.state = CircuitBreaker.OPEN
+                self.opened_at = time.time()
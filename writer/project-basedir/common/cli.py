@@ -1,10 +1,27 @@
+import os
 import time
+import threading
 
 import datetime
 import json
 import subprocess
 
+from contextlib import contextmanager
+
 from common.log import logger
+from common import metrics
+
+
+RETRIES = metrics.counter("cli_run_retries_total", "Failed cli.run attempts", ["command"])
+TIMEOUTS = metrics.counter("cli_run_timeouts_total", "cli.run attempts killed by the timeout", ["command"])
+SLOT_WAIT_SECONDS = metrics.histogram(
+    "cli_run_slot_wait_seconds", "Time cli.run waited for a free slot of the rpcserver", ["rpcserver"])
+
+# At most this many commands run against one rpcserver at a time, the others wait for a free slot
+MAX_CONCURRENT_PER_RPCSERVER = 4
+
+_slots = {}  # Dict[str, threading.BoundedSemaphore] where str is rpcserver
+_slots_lock = threading.Lock()
 
 
 class RunCommandException(Exception):
@@ -22,6 +39,65 @@ def h(cmd):
 
 	return "\n".join(results)
 
+
+def command_name(cmd):
+    """
+    Binary and sub-command, e.g. "lncli listinvoices", skipping "--flag value" pairs in between
+    """
+    skip_next = False
+    for arg in cmd[1:]:
+        if skip_next:
+            skip_next = False
+        elif arg.startswith("-"):
+            skip_next = "=" not in arg
+        else:
+            return "{} {}".format(os.path.basename(cmd[0]), arg)
+
+    return os.path.basename(cmd[0])
+
+
+def rpcserver_of(cmd):
+    """
+    Value of the --rpcserver flag, or None
+    """
+    for pos, arg in enumerate(cmd):
+        if arg == "--rpcserver" and pos + 1 < len(cmd):
+            return cmd[pos + 1]
+        if arg.startswith("--rpcserver="):
+            return arg.split("=", 1)[1]
+
+    return None
+
+
+@contextmanager
+def rpcserver_slot(rpcserver, timeout):
+    """
+    Hold one of the MAX_CONCURRENT_PER_RPCSERVER slots of rpcserver, raises subprocess.TimeoutExpired
+    if none is free within timeout seconds
+    """
+    if rpcserver is None:
+        yield
+        return
+
+    with _slots_lock:
+        slot = _slots.get(rpcserver)
+        if slot is None:
+            slot = threading.BoundedSemaphore(MAX_CONCURRENT_PER_RPCSERVER)
+            _slots[rpcserver] = slot
+
+    start_time = time.time()
+    acquired = slot.acquire(timeout=timeout)
+    SLOT_WAIT_SECONDS.observe(time.time() - start_time, rpcserver=rpcserver)
+    if not acquired:
+        logger.error("No free slot for rpcserver {} after {} seconds".format(rpcserver, timeout))
+        raise subprocess.TimeoutExpired("slot of {}".format(rpcserver), timeout)
+
+    try:
+        yield
+    finally:
+        slot.release()
+
+
 def run(cmd, timeout=5, try_num=3, run_try_sleep=1, log_cmd=True, return_stderr_on_fail=False):
     if log_cmd:
         logger.info("Running command: {}".format(h(cmd)))
@@ -34,15 +110,19 @@ def run(cmd, timeout=5, try_num=3, run_try_sleep=1, log_cmd=True, return_stderr_
             kwargs["stderr"] = subprocess.STDOUT
 
         try:
-            raw = subprocess.check_output(
-                   cmd,
-                   timeout=timeout,
-                   shell=False,
-                   **kwargs
-                ).decode("utf-8")
+            with rpcserver_slot(rpcserver_of(cmd), timeout):
+                raw = subprocess.check_output(
+                       cmd,
+                       timeout=timeout,
+                       shell=False,
+                       **kwargs
+                    ).decode("utf-8")
             break
         except Exception as e:
             logger.exception(e)
+            RETRIES.inc(command=command_name(cmd))
+            if isinstance(e, subprocess.TimeoutExpired):
+                TIMEOUTS.inc(command=command_name(cmd))
 
             raw = e.output
             logger.error("Command output was: {}".format(raw))
@@ -0,0 +1,99 @@
+"""
+Hedged calls for requests that any node can answer, e.g. verifymessage and decodepayreq
+
+The first node is called right away. If it has not answered within the hedge delay the same request
+goes to the next node, and the first accepted reply wins. The hedge delay is the p95 latency of recent
+calls, so only the slowest few percent of calls cost a second request.
+"""
+import time
+import threading
+
+from collections import deque
+from concurrent import futures
+
+from common.log import logger
+from common import metrics
+
+
+HEDGES = metrics.counter("hedged_calls_total", "Requests sent to a second node because the first was slow", ["name"])
+
+_executor = futures.ThreadPoolExecutor(max_workers=16)
+
+
+class Hedger(object):
+    """
+        verify_hedger = Hedger("verifymessage")
+        result = verify_hedger.call([lambda: node1.verifymessage(...), lambda: node2.verifymessage(...)])
+
+    accept(result) decides if a reply that did not raise counts, e.g. lnclient calls with
+    return_stderr_on_fail report failures in the result. If no reply is accepted the last
+    exception is raised, or the last result returned.
+    """
+
+    def __init__(self, name, quantile=0.95, default_delay=1.0, min_samples=20, window=200, accept=None):
+        self.name = name
+        self.quantile = quantile
+        self.default_delay = default_delay
+        self.min_samples = min_samples
+        self.accept = accept or (lambda result: True)
+
+        self.lock = threading.Lock()
+        self.latencies = deque(maxlen=window)
+
+    def record(self, seconds):
+        with self.lock:
+            self.latencies.append(seconds)
+
+    def delay(self):
+        with self.lock:
+            latencies = sorted(self.latencies)
+
+        if len(latencies) < self.min_samples:
+            return self.default_delay
+
+        return latencies[min(int(len(latencies) * self.quantile), len(latencies) - 1)]
+
+    def _timed(self, fn):
+        start_time = time.time()
+        result = fn()
+        self.record(time.time() - start_time)
+        return result
+
+    def call(self, fns):
+        pending = set()
+        remaining = list(fns)
+        last_error = None
+        last_result = None
+        has_result = False
+
+        while remaining or pending:
+            if remaining:
+                if pending:
+                    HEDGES.inc(name=self.name)
+                    logger.info("Hedging {}, no reply within {:.3f} seconds".format(self.name, self.delay()))
+
+                pending.add(_executor.submit(self._timed, remaining.pop(0)))
+
+            # wait for the hedge delay while there is another node to try, otherwise until a reply arrives
+            done, pending = futures.wait(
+                pending,
+                timeout=self.delay() if remaining else None,
+                return_when=futures.FIRST_COMPLETED
+            )
+            for future in done:
+                try:
+                    result = future.result()
+                except Exception as e:
+                    logger.error("{} failed: {}".format(self.name, e))
+                    last_error = e
+                    continue
+
+                if self.accept(result):
+                    return result
+
+                last_result, has_result = result, True
+
+        if has_result:
+            return last_result
+
+        raise last_error
@@ -5,9 +5,11 @@ import json
 import random
 
 LNCLI_BIN = "/home/lightning/gocode/bin/lncli"
+MACAROON_PATH = "/etc/biostar/writer-{rpcserver}-invoice.macaroon"
+TLS_CERT_PATH = "/etc/biostar/writer-{rpcserver}-tls.cert"
 AUTH_ARGS = [
-    "--macaroonpath", "/etc/biostar/writer-{rpcserver}-invoice.macaroon",
-    "--tlscertpath", "/etc/biostar/writer-{rpcserver}-tls.cert",
+    "--macaroonpath", MACAROON_PATH,
+    "--tlscertpath", TLS_CERT_PATH,
     "--rpcserver", "{rpcserver}"
 ]
 
@@ -37,7 +39,7 @@ def addinvoice(memo, rpcserver, amt, expiry):
     return output
 
 
-def listinvoices(index_offset, rpcserver, max_invoices=100, mock=False):
+def listinvoices(index_offset, rpcserver, max_invoices=100, pending_only=False, mock=False):
     if mock:
         return {
             "first_index_offset": "0",
@@ -51,6 +53,8 @@ def listinvoices(index_offset, rpcserver, max_invoices=100, mock=False):
         "--max_invoices", str(max_invoices),
         "--paginate-forwards",
     ]
+    if pending_only:
+        cmd += ["--pending_only"]
 
     # TODO: return_stderr_on_fail=True, and adjust all the call sites
     return cli.run(cmd, log_cmd=False)
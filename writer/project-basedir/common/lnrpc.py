@@ -0,0 +1,625 @@
+"""
+gRPC client for lnd, a drop-in alternative to common.lnclient
+
+common.lnclient forks lncli for every call, which means re-reading the macaroon
+and the TLS cert, a fresh TLS handshake and JSON decoding of stdout each time.
+This module keeps one long-lived gRPC channel per rpcserver and exposes
+functions with the same signatures and the same return shapes as lnclient, so
+call sites can switch per LightningNode (see LightningNode.get_lnclient).
+
+Only the handful of lnd messages that ln-central uses are described here, with
+a minimal protobuf wire codec, so no generated rpc_pb2 stubs are needed.
+
+Needs the "grpcio" package.
+"""
+import json
+import time
+import threading
+import binascii
+
+try:
+    import grpc
+except ImportError:
+    # grpcio is only required for nodes with rpc_client set to "grpc"
+    grpc = None
+
+from django.conf import settings
+
+from common import lnclient
+from common.cli import RunCommandException
+from common.log import logger
+from common import metrics
+
+
+class LnrpcException(Exception):
+    pass
+
+
+#
+# Minimal protobuf wire codec
+#
+
+WIRE_VARINT, WIRE_64BIT, WIRE_LENGTH_DELIMITED, WIRE_32BIT = 0, 1, 2, 5
+
+UINT64, INT64, BOOL, ENUM, STRING, BYTES, MESSAGE = range(7)
+
+VARINT_KINDS = (UINT64, INT64, BOOL, ENUM)
+
+
+def encode_varint(value):
+    if value < 0:
+        value += 1 << 64  # two's complement, same as protobuf int64
+
+    out = bytearray()
+    while True:
+        to_write = value & 0x7f
+        value >>= 7
+        if value:
+            out.append(to_write | 0x80)
+        else:
+            out.append(to_write)
+            return bytes(out)
+
+
+def decode_varint(buf, pos):
+    result = 0
+    shift = 0
+    while True:
+        if pos >= len(buf):
+            raise LnrpcException("Truncated varint")
+
+        b = buf[pos]
+        pos += 1
+        result |= (b & 0x7f) << shift
+        if not b & 0x80:
+            return result, pos
+
+        shift += 7
+        if shift >= 70:
+            raise LnrpcException("Varint is too long")
+
+
+class Field(object):
+    def __init__(self, number, name, kind, repeated=False, message=None, enum=None):
+        self.number = number
+        self.name = name
+        self.kind = kind
+        self.repeated = repeated
+        self.message = message
+        self.enum = enum or {}
+
+    def default(self):
+        if self.repeated:
+            return []
+        if self.kind == STRING:
+            return ""
+        if self.kind == BYTES:
+            return b""
+        if self.kind == BOOL:
+            return False
+        if self.kind == MESSAGE:
+            return None
+        return 0
+
+
+class Message(object):
+    """
+    Describes a protobuf message, encodes dicts to bytes and decodes bytes to dicts
+    """
+
+    def __init__(self, name, fields):
+        self.name = name
+        self.fields = fields
+        self.by_number = {f.number: f for f in fields}
+        self.by_name = {f.name: f for f in fields}
+
+    def encode(self, obj):
+        out = bytearray()
+        for name, value in obj.items():
+            field = self.by_name.get(name)
+            if field is None:
+                raise LnrpcException("{} has no field {}".format(self.name, name))
+
+            values = value if field.repeated else [value]
+            for v in values:
+                out += self._encode_field(field, v)
+
+        return bytes(out)
+
+    def _encode_field(self, field, value):
+        if field.kind in VARINT_KINDS:
+            return encode_varint(field.number << 3 | WIRE_VARINT) + encode_varint(int(value))
+
+        if field.kind == STRING:
+            value = value.encode("utf-8")
+        elif field.kind == MESSAGE:
+            value = field.message.encode(value)
+
+        return (
+            encode_varint(field.number << 3 | WIRE_LENGTH_DELIMITED) +
+            encode_varint(len(value)) +
+            bytes(value)
+        )
+
+    def decode(self, buf):
+        obj = {f.name: f.default() for f in self.fields}
+
+        pos = 0
+        while pos < len(buf):
+            key, pos = decode_varint(buf, pos)
+            number, wire_type = key >> 3, key & 0x7
+
+            if wire_type == WIRE_VARINT:
+                value, pos = decode_varint(buf, pos)
+            elif wire_type == WIRE_LENGTH_DELIMITED:
+                size, pos = decode_varint(buf, pos)
+                value = bytes(buf[pos:pos + size])
+                pos += size
+            elif wire_type == WIRE_64BIT:
+                value = bytes(buf[pos:pos + 8])
+                pos += 8
+            elif wire_type == WIRE_32BIT:
+                value = bytes(buf[pos:pos + 4])
+                pos += 4
+            else:
+                raise LnrpcException("Unsupported wire type {} in {}".format(wire_type, self.name))
+
+            field = self.by_number.get(number)
+            if field is None:
+                continue  # unknown fields are skipped, just like in generated code
+
+            value = self._decode_value(field, value)
+            if field.repeated:
+                obj[field.name].append(value)
+            else:
+                obj[field.name] = value
+
+        return obj
+
+    def _decode_value(self, field, value):
+        if field.kind == INT64 and value >= 1 << 63:
+            return value - (1 << 64)
+        if field.kind == BOOL:
+            return bool(value)
+        if field.kind == STRING:
+            return value.decode("utf-8")
+        if field.kind == MESSAGE:
+            return field.message.decode(value)
+        return value
+
+    def to_json(self, obj):
+        """
+        Convert a decoded message to the same JSON-able shape that lncli prints:
+        64-bit integers as strings, bytes as hex and enums by name
+        """
+        result = {}
+        for field in self.fields:
+            value = obj.get(field.name, field.default())
+            if field.repeated:
+                result[field.name] = [self._value_to_json(field, v) for v in value]
+            else:
+                result[field.name] = self._value_to_json(field, value)
+
+        return result
+
+    def _value_to_json(self, field, value):
+        if field.kind in (UINT64, INT64):
+            return str(value)
+        if field.kind == BYTES:
+            return binascii.hexlify(value).decode("utf-8")
+        if field.kind == ENUM:
+            return field.enum.get(value, str(value))
+        if field.kind == MESSAGE:
+            return None if value is None else field.message.to_json(value)
+        return value
+
+
+#
+# lnd messages, field numbers are from lnrpc/rpc.proto
+#
+
+INVOICE_STATE = {0: "OPEN", 1: "SETTLED", 2: "CANCELED", 3: "ACCEPTED"}
+INVOICE_STATE_BY_NAME = {v: k for k, v in INVOICE_STATE.items()}
+
+Invoice = Message("Invoice", [
+    Field(1, "memo", STRING),
+    Field(3, "r_preimage", BYTES),
+    Field(4, "r_hash", BYTES),
+    Field(5, "value", INT64),
+    Field(6, "settled", BOOL),
+    Field(7, "creation_date", INT64),
+    Field(8, "settle_date", INT64),
+    Field(9, "payment_request", STRING),
+    Field(10, "description_hash", BYTES),
+    Field(11, "expiry", INT64),
+    Field(12, "fallback_addr", STRING),
+    Field(13, "cltv_expiry", UINT64),
+    Field(15, "private", BOOL),
+    Field(16, "add_index", UINT64),
+    Field(17, "settle_index", UINT64),
+    Field(19, "amt_paid_sat", INT64),
+    Field(20, "amt_paid_msat", INT64),
+    Field(21, "state", ENUM, enum=INVOICE_STATE),
+    Field(23, "value_msat", INT64),
+])
+
+AddInvoiceResponse = Message("AddInvoiceResponse", [
+    Field(1, "r_hash", BYTES),
+    Field(2, "payment_request", STRING),
+    Field(16, "add_index", UINT64),
+])
+
+ListInvoiceRequest = Message("ListInvoiceRequest", [
+    Field(1, "pending_only", BOOL),
+    Field(4, "index_offset", UINT64),
+    Field(5, "num_max_invoices", UINT64),
+    Field(6, "reversed", BOOL),
+])
+
+ListInvoiceResponse = Message("ListInvoiceResponse", [
+    Field(1, "invoices", MESSAGE, repeated=True, message=Invoice),
+    Field(2, "last_index_offset", UINT64),
+    Field(3, "first_index_offset", UINT64),
+])
+
+InvoiceSubscription = Message("InvoiceSubscription", [
+    Field(1, "add_index", UINT64),
+    Field(2, "settle_index", UINT64),
+])
+
+VerifyMessageRequest = Message("VerifyMessageRequest", [
+    Field(1, "msg", BYTES),
+    Field(2, "signature", STRING),
+])
+
+VerifyMessageResponse = Message("VerifyMessageResponse", [
+    Field(1, "valid", BOOL),
+    Field(2, "pubkey", STRING),
+])
+
+PayReqString = Message("PayReqString", [
+    Field(1, "pay_req", STRING),
+])
+
+PayReq = Message("PayReq", [
+    Field(1, "destination", STRING),
+    Field(2, "payment_hash", STRING),
+    Field(3, "num_satoshis", INT64),
+    Field(4, "timestamp", INT64),
+    Field(5, "expiry", INT64),
+    Field(6, "description", STRING),
+    Field(7, "description_hash", STRING),
+    Field(8, "fallback_addr", STRING),
+    Field(9, "cltv_expiry", INT64),
+    Field(12, "num_msat", INT64),
+])
+
+SendRequest = Message("SendRequest", [
+    Field(6, "payment_request", STRING),
+])
+
+SendResponse = Message("SendResponse", [
+    Field(1, "payment_error", STRING),
+    Field(2, "payment_preimage", BYTES),
+    Field(4, "payment_hash", BYTES),
+])
+
+
+# method name -> (request message, response message, is server streaming)
+METHODS = {
+    "AddInvoice": (Invoice, AddInvoiceResponse, False),
+    "ListInvoices": (ListInvoiceRequest, ListInvoiceResponse, False),
+    "SubscribeInvoices": (InvoiceSubscription, Invoice, True),
+    "VerifyMessage": (VerifyMessageRequest, VerifyMessageResponse, False),
+    "DecodePayReq": (PayReqString, PayReq, False),
+    "SendPaymentSync": (SendRequest, SendResponse, False),
+}
+
+SERVICE_NAME = "lnrpc.Lightning"
+
+
+def method_path(method):
+    return "/{}/{}".format(SERVICE_NAME, method)
+
+
+#
+# Client
+#
+
+MACAROON_PATH = lnclient.MACAROON_PATH
+TLS_CERT_PATH = lnclient.TLS_CERT_PATH
+
+# gRPC retries mirror the defaults of cli.run
+RETRYABLE_CODES = ("UNAVAILABLE", "DEADLINE_EXCEEDED", "RESOURCE_EXHAUSTED")
+
+RETRIES = metrics.counter("lnrpc_call_retries_total", "Failed gRPC call attempts", ["method"])
+TIMEOUTS = metrics.counter("lnrpc_call_timeouts_total", "gRPC call attempts that ran out of deadline", ["method"])
+
+CHANNEL_OPTIONS = [
+    ("grpc.keepalive_time_ms", 30000),
+    ("grpc.keepalive_timeout_ms", 10000),
+    ("grpc.keepalive_permit_without_calls", 1),
+    ("grpc.max_receive_message_length", 50 * 1024 * 1024),
+]
+
+
+def _require_grpc():
+    if grpc is None:
+        raise LnrpcException("grpcio is not installed, cannot use rpc_client=grpc")
+
+
+def _code_name(rpc_error):
+    try:
+        return rpc_error.code().name
+    except Exception:
+        return "UNKNOWN"
+
+
+class LightningClient(object):
+    """
+    Long-lived gRPC channel to one lnd node
+
+    The macaroon and the TLS cert are read once, the channel reconnects by itself
+    and is safe to share between threads.
+    """
+
+    def __init__(self, rpcserver, insecure=False):
+        _require_grpc()
+        lnclient._sanitize_rpcserver(rpcserver)
+
+        self.rpcserver = rpcserver
+        self.insecure = insecure
+
+        if insecure:
+            self.channel = grpc.insecure_channel(rpcserver, options=CHANNEL_OPTIONS)
+        else:
+            with open(TLS_CERT_PATH.format(rpcserver=rpcserver), "rb") as f:
+                cert = f.read()
+
+            with open(MACAROON_PATH.format(rpcserver=rpcserver), "rb") as f:
+                macaroon = binascii.hexlify(f.read()).decode("utf-8")
+
+            def metadata_callback(context, callback):
+                callback([("macaroon", macaroon)], None)
+
+            credentials = grpc.composite_channel_credentials(
+                grpc.ssl_channel_credentials(cert),
+                grpc.metadata_call_credentials(metadata_callback),
+            )
+            self.channel = grpc.secure_channel(rpcserver, credentials, options=CHANNEL_OPTIONS)
+
+        self._callables = {}
+        for method, (request_msg, response_msg, streaming) in METHODS.items():
+            factory = self.channel.unary_stream if streaming else self.channel.unary_unary
+            self._callables[method] = factory(
+                method_path(method),
+                request_serializer=request_msg.encode,
+                response_deserializer=response_msg.decode,
+            )
+
+    def __repr__(self):
+        return "LightningClient({})".format(self.rpcserver)
+
+    def call(self, method, request, timeout=5, try_num=3, run_try_sleep=1):
+        """
+        Unary call with the same retry semantics as cli.run
+
+        Raises grpc.RpcError after try_num failed attempts or once the accumulated
+        time is over timeout
+        """
+        start = time.time()
+        for try_count in range(1, try_num + 1):
+            try:
+                return self._callables[method](request, timeout=timeout)
+            except grpc.RpcError as e:
+                code = _code_name(e)
+                logger.error("{} {} failed on try {}: {} {}".format(
+                    self.rpcserver, method, try_count, code, e.details() if hasattr(e, "details") else e))
+                RETRIES.inc(method=method)
+                if code == "DEADLINE_EXCEEDED":
+                    TIMEOUTS.inc(method=method)
+
+                if code not in RETRYABLE_CODES or try_count == try_num:
+                    raise
+
+                if time.time() - start > timeout:
+                    raise
+
+                time.sleep(run_try_sleep)
+
+    def stream(self, method, request, timeout=None):
+        """
+        Server streaming call, returns an iterator that can be cancelled with .cancel()
+        """
+        return self._callables[method](request, timeout=timeout)
+
+    def close(self):
+        self.channel.close()
+
+
+_clients = {}  # Dict[str, LightningClient] where str is rpcserver
+_clients_lock = threading.Lock()
+
+
+def get_client(rpcserver):
+    """
+    Return the pooled client for rpcserver, creating the channel on first use
+    """
+    client = _clients.get(rpcserver)
+    if client is not None:
+        return client
+
+    _require_grpc()
+    with _clients_lock:
+        client = _clients.get(rpcserver)
+        if client is None:
+            insecure = rpcserver in getattr(settings, "LNRPC_INSECURE_RPCSERVERS", [])
+            client = LightningClient(rpcserver, insecure=insecure)
+            _clients[rpcserver] = client
+            logger.info("Opened gRPC channel to {}".format(rpcserver))
+
+        return client
+
+
+def register_client(client):
+    """
+    Put an existing client into the pool, e.g. one connected to FakeLightningServer
+    """
+    with _clients_lock:
+        old = _clients.get(client.rpcserver)
+        _clients[client.rpcserver] = client
+
+    if old is not None and old is not client:
+        old.close()
+
+
+def close_all():
+    with _clients_lock:
+        clients = list(_clients.values())
+        _clients.clear()
+
+    for client in clients:
+        client.close()
+
+
+#
+# Functions with the same signatures and return values as common.lnclient
+#
+
+def _json_call(rpcserver, method, request, log_call=True, **kwargs):
+    if log_call:
+        logger.info("Calling gRPC {} on {}".format(method, rpcserver))
+
+    client = get_client(rpcserver)
+    try:
+        response = client.call(method, request, **kwargs)
+    except grpc.RpcError as e:
+        raise RunCommandException("Failed gRPC {} on {}: {} {}".format(
+            method, rpcserver, _code_name(e), e.details() if hasattr(e, "details") else e))
+
+    return METHODS[method][1].to_json(response)
+
+
+def _stdouterr_call(rpcserver, method, request, **kwargs):
+    """
+    Same shape as cli.run(..., return_stderr_on_fail=True)
+    """
+    logger.info("Calling gRPC {} on {}".format(method, rpcserver))
+
+    client = get_client(rpcserver)
+    try:
+        response = client.call(method, request, **kwargs)
+    except grpc.RpcError as e:
+        code = _code_name(e)
+        details = e.details() if hasattr(e, "details") else str(e)
+        if code == "DEADLINE_EXCEEDED":
+            return {
+                "success": False,
+                "failure_type": "timeout",
+                "failure_msg": "gRPC {} timeout".format(method),
+                "stdouterr": details}
+        else:
+            return {
+                "success": False,
+                "failure_type": "exit",
+                "failure_msg": "gRPC {} failed with {}".format(method, code),
+                "stdouterr": details}
+
+    return {
+        "success": True,
+        "stdouterr": json.dumps(METHODS[method][1].to_json(response))
+    }
+
+
+def addinvoice(memo, rpcserver, amt, expiry):
+    output = _json_call(
+        rpcserver,
+        "AddInvoice",
+        {"memo": memo, "value": int(amt), "expiry": int(expiry)},
+    )
+    logger.info("addinvoice finished: {}".format(output))
+    return output
+
+
+def listinvoices(index_offset, rpcserver, max_invoices=100, pending_only=False, mock=False):
+    if mock:
+        return lnclient.listinvoices(index_offset, rpcserver, max_invoices=max_invoices, pending_only=pending_only, mock=True)
+
+    return _json_call(
+        rpcserver,
+        "ListInvoices",
+        {"index_offset": int(index_offset), "num_max_invoices": int(max_invoices), "pending_only": pending_only},
+        log_call=False,
+    )
+
+
+def verifymessage(msg, sig, rpcserver, mock=False):
+    if mock:
+        return lnclient.verifymessage(msg, sig, rpcserver, mock=True)
+
+    output = _json_call(
+        rpcserver,
+        "VerifyMessage",
+        {"msg": msg.encode("utf-8"), "signature": sig},
+    )
+    return {"valid": output["valid"], "pubkey": output["pubkey"]}
+
+
+def decodepayreq(payreq, rpcserver, mock=False):
+    if mock:
+        return lnclient.decodepayreq(payreq, rpcserver, mock=True)
+
+    return _stdouterr_call(rpcserver, "DecodePayReq", {"pay_req": payreq})
+
+
+def payinvoice(payreq, rpcserver, mock=False):
+    if mock:
+        return lnclient.payinvoice(payreq, rpcserver, mock=True)
+
+    result = _stdouterr_call(rpcserver, "SendPaymentSync", {"payment_request": payreq}, try_num=3, timeout=60)
+
+    if result["success"]:
+        payment_error = json.loads(result["stdouterr"])["payment_error"]
+        if payment_error:
+            # lncli payinvoice exits non-zero when lnd reports a payment_error
+            return {
+                "success": False,
+                "failure_type": "exit",
+                "failure_msg": "payment failed",
+                "stdouterr": payment_error}
+
+    return result
+
+
+class InvoiceStream(object):
+    """
+    Iterator over SubscribeInvoices updates, each one in the same format as the listinvoices entries
+    """
+
+    def __init__(self, call):
+        self.call = call
+
+    def __iter__(self):
+        for invoice in self.call:
+            yield Invoice.to_json(invoice)
+
+    def cancel(self):
+        self.call.cancel()
+
+
+def subscribeinvoices(rpcserver, add_index=0, settle_index=0, timeout=None):
+    """
+    lnd first replays invoices added after add_index and settled after settle_index,
+    then streams additions and settlements as they happen.
+
+    There is no lncli equivalent, so streaming is only available with rpc_client=grpc
+    """
+    logger.info("Subscribing to invoices on {} from add_index={} settle_index={}".format(
+        rpcserver, add_index, settle_index))
+
+    call = get_client(rpcserver).stream(
+        "SubscribeInvoices",
+        {"add_index": int(add_index), "settle_index": int(settle_index)},
+        timeout=timeout,
+    )
+    return InvoiceStream(call)
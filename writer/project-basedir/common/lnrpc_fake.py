@@ -0,0 +1,224 @@
+"""
+In-process fake of the lnd Lightning gRPC service
+
+Speaks the same wire format as lnd for the methods in common.lnrpc.METHODS and
+keeps invoices in memory. Used by the tests and by "manage.py run_fake_lnd" to
+develop against rpc_client=grpc without a real node.
+"""
+import os
+import time
+import hashlib
+import threading
+import binascii
+
+from concurrent import futures
+
+from common import lnrpc
+
+grpc = lnrpc.grpc
+
+
+class FakeLightningServer(object):
+    def __init__(self, identity_pubkey="FAKE2", valid_signatures=None):
+        lnrpc._require_grpc()
+
+        self.identity_pubkey = identity_pubkey
+
+        # signature -> pubkey that VerifyMessage reports, unknown signatures are not valid
+        self.valid_signatures = valid_signatures or {}
+
+        self.invoices = []  # List[dict], decoded lnrpc.Invoice messages ordered by add_index
+        self.payments = []  # List[str], payment requests passed to SendPaymentSync
+        self.calls = []  # List[str], method names in call order
+
+        self._lock = threading.Condition()
+        self._last_settle_index = 0
+        self._server = None
+        self.port = None
+
+    # Test helpers
+
+    def add_invoice(self, memo, value=2, expiry=3600):
+        return self._add_invoice({"memo": memo, "value": value, "expiry": expiry})
+
+    def settle(self, add_index):
+        with self._lock:
+            invoice = self.invoices[add_index - 1]
+            self._last_settle_index += 1
+            invoice.update(
+                settled=True,
+                state=lnrpc.INVOICE_STATE_BY_NAME["SETTLED"],
+                settle_date=int(time.time()),
+                settle_index=self._last_settle_index,
+                amt_paid_sat=invoice["value"],
+                amt_paid_msat=invoice["value"] * 1000,
+            )
+            self._lock.notify_all()
+
+        return invoice
+
+    def cancel(self, add_index):
+        with self._lock:
+            invoice = self.invoices[add_index - 1]
+            invoice.update(state=lnrpc.INVOICE_STATE_BY_NAME["CANCELED"])
+            self._lock.notify_all()
+
+        return invoice
+
+    # Server lifecycle
+
+    def start(self, port=0, max_workers=10):
+        self._server = grpc.server(futures.ThreadPoolExecutor(max_workers=max_workers))
+
+        handlers = {}
+        for method, (request_msg, response_msg, streaming) in lnrpc.METHODS.items():
+            handler_factory = grpc.unary_stream_rpc_method_handler if streaming else grpc.unary_unary_rpc_method_handler
+            handlers[method] = handler_factory(
+                self._make_handler(method),
+                request_deserializer=request_msg.decode,
+                response_serializer=response_msg.encode,
+            )
+
+        self._server.add_generic_rpc_handlers(
+            (grpc.method_handlers_generic_handler(lnrpc.SERVICE_NAME, handlers),)
+        )
+        self.port = self._server.add_insecure_port("localhost:{}".format(port))
+        self._server.start()
+        return self.port
+
+    def stop(self):
+        with self._lock:
+            self._lock.notify_all()
+
+        if self._server is not None:
+            self._server.stop(0)
+            self._server = None
+
+    def wait(self):
+        self._server.wait_for_termination()
+
+    def client(self):
+        """
+        Client connected to this server, rpcserver is "localhost:<port>"
+        """
+        return lnrpc.LightningClient("localhost:{}".format(self.port), insecure=True)
+
+    # RPC handlers
+
+    def _make_handler(self, method):
+        impl = getattr(self, "_rpc_" + method)
+
+        def handler(request, context):
+            with self._lock:
+                self.calls.append(method)
+
+            return impl(request, context)
+
+        return handler
+
+    def _add_invoice(self, request):
+        with self._lock:
+            preimage = os.urandom(32)
+            add_index = len(self.invoices) + 1
+            invoice = lnrpc.Invoice.decode(b"")
+            invoice.update(
+                memo=request.get("memo", ""),
+                value=request.get("value", 0),
+                expiry=request.get("expiry", 0) or 3600,
+                r_preimage=preimage,
+                r_hash=hashlib.sha256(preimage).digest(),
+                creation_date=int(time.time()),
+                add_index=add_index,
+                state=lnrpc.INVOICE_STATE_BY_NAME["OPEN"],
+                cltv_expiry=40,
+            )
+            invoice["value_msat"] = invoice["value"] * 1000
+            invoice["payment_request"] = "lnfake{}{}".format(
+                add_index, binascii.hexlify(invoice["r_hash"]).decode("utf-8"))
+
+            self.invoices.append(invoice)
+            self._lock.notify_all()
+
+        return invoice
+
+    def _rpc_AddInvoice(self, request, context):
+        invoice = self._add_invoice(request)
+        return {
+            "r_hash": invoice["r_hash"],
+            "payment_request": invoice["payment_request"],
+            "add_index": invoice["add_index"],
+        }
+
+    def _rpc_ListInvoices(self, request, context):
+        with self._lock:
+            offset = request["index_offset"]
+            num_max = request["num_max_invoices"] or 100
+
+            selected = [
+                i for i in self.invoices
+                if i["add_index"] > offset and (
+                    not request["pending_only"] or i["state"] == lnrpc.INVOICE_STATE_BY_NAME["OPEN"]
+                )
+            ][:num_max]
+
+        return {
+            "invoices": selected,
+            "first_index_offset": selected[0]["add_index"] if selected else 0,
+            "last_index_offset": selected[-1]["add_index"] if selected else 0,
+        }
+
+    def _rpc_SubscribeInvoices(self, request, context):
+        """
+        Like lnd: first replay invoices added after add_index and settled after settle_index,
+        then stream new additions and settlements as they happen
+        """
+        sent_added = request["add_index"]
+        sent_settled = request["settle_index"]
+
+        while context.is_active() and self._server is not None:
+            with self._lock:
+                updates = []
+                for invoice in self.invoices:
+                    if invoice["add_index"] > sent_added:
+                        updates.append(dict(invoice))
+                        sent_added = invoice["add_index"]
+                    if invoice["settle_index"] > sent_settled:
+                        updates.append(dict(invoice))
+                        sent_settled = max(sent_settled, invoice["settle_index"])
+
+                if not updates:
+                    self._lock.wait(0.1)
+
+            for update in updates:
+                yield update
+
+    def _rpc_VerifyMessage(self, request, context):
+        pubkey = self.valid_signatures.get(request["signature"])
+        return {"valid": pubkey is not None, "pubkey": pubkey or ""}
+
+    def _rpc_DecodePayReq(self, request, context):
+        with self._lock:
+            for invoice in self.invoices:
+                if invoice["payment_request"] == request["pay_req"]:
+                    return {
+                        "destination": self.identity_pubkey,
+                        "payment_hash": binascii.hexlify(invoice["r_hash"]).decode("utf-8"),
+                        "num_satoshis": invoice["value"],
+                        "num_msat": invoice["value_msat"],
+                        "timestamp": invoice["creation_date"],
+                        "expiry": invoice["expiry"],
+                        "description": invoice["memo"],
+                        "cltv_expiry": invoice["cltv_expiry"],
+                    }
+
+        context.abort(grpc.StatusCode.UNKNOWN, "invalid index of 1")
+
+    def _rpc_SendPaymentSync(self, request, context):
+        with self._lock:
+            self.payments.append(request["payment_request"])
+
+        return {
+            "payment_error": "",
+            "payment_preimage": os.urandom(32),
+            "payment_hash": os.urandom(32),
+        }
@@ -0,0 +1,47 @@
+"""
+Thread safe least recently used cache
+
+Shared by the reader (Python 2) and the writer (Python 3).
+"""
+import threading
+
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """
+        memos = LRUCache(maxsize=10000)
+        memo = memos.get(key)
+        if memo is None:
+            memo = memos.put(key, make_memo())
+
+    Once maxsize entries are stored, put drops the entry that was used least recently
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key not in self.entries:
+                return default
+
+            # move to the end, OrderedDict of Python 2 has no move_to_end
+            value = self.entries.pop(key)
+            self.entries[key] = value
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = value
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+        return value
+
+    def __len__(self):
+        return len(self.entries)
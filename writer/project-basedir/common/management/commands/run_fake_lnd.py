@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from common import lnrpc
+from common.lnrpc_fake import FakeLightningServer
+
+
+class Command(BaseCommand):
+    help = 'Runs an in-memory fake lnd gRPC server, for nodes with rpc_client=grpc'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--port', type=int, default=10009)
+        parser.add_argument('--pubkey', default="FAKE2")
+
+    def handle(self, *args, **options):
+        if lnrpc.grpc is None:
+            raise CommandError("grpcio is not installed")
+
+        server = FakeLightningServer(identity_pubkey=options["pubkey"])
+        port = server.start(port=options["port"])
+
+        self.stdout.write(self.style.SUCCESS("Fake lnd listening on localhost:{}".format(port)))
+        self.stdout.write("Add localhost:{} to LNRPC_INSECURE_RPCSERVERS to connect to it".format(port))
+
+        try:
+            server.wait()
+        except KeyboardInterrupt:
+            server.stop()
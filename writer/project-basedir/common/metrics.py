@@ -0,0 +1,324 @@
+"""
+In-process metrics with Prometheus text exposition
+
+Every process periodically writes a snapshot of its registry to METRICS_SNAPSHOT_DIR: run_many and
+stream_invoices after their passes, web workers from a thread started by start_snapshot_thread. The
+metrics endpoints merge the snapshots, skipping the ones that were not rewritten for max_age seconds
+(e.g. of a worker that exited). Counters and histograms are summed, gauges are taken as is (every process
+reports gauges with its own label values, e.g. the nodes it processes).
+
+Shared by the reader (Python 2) and the writer (Python 3).
+"""
+import os
+import json
+import time
+import threading
+import tempfile
+
+from collections import OrderedDict
+
+from common.log import logger
+
+
+LATENCY_BUCKETS = [0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+COUNT_BUCKETS = [0, 1, 5, 10, 25, 50, 100, 250, 500, 1000]
+
+
+class MetricsError(Exception):
+    pass
+
+
+def _labels_key(labelnames, labels):
+    if sorted(labels.keys()) != sorted(labelnames):
+        raise MetricsError("Expected labels {}, got {}".format(labelnames, sorted(labels.keys())))
+
+    return tuple(str(labels[name]) for name in labelnames)
+
+
+class Metric(object):
+    type_name = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = list(labelnames)
+        self.values = {}  # Dict[tuple, value] where tuple holds the label values
+        self.lock = threading.Lock()
+
+    def snapshot(self):
+        with self.lock:
+            samples = [[list(key), self._copy(value)] for key, value in self.values.items()]
+
+        return {
+            "type": self.type_name,
+            "help": self.documentation,
+            "labelnames": self.labelnames,
+            "samples": samples,
+        }
+
+    def _copy(self, value):
+        return value
+
+
+class Counter(Metric):
+    type_name = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = _labels_key(self.labelnames, labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    type_name = "gauge"
+
+    def set(self, value, **labels):
+        key = _labels_key(self.labelnames, labels)
+        with self.lock:
+            self.values[key] = value
+
+
+class Histogram(Metric):
+    type_name = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super(Histogram, self).__init__(name, documentation, labelnames)
+        self.buckets = list(buckets)
+
+    def observe(self, value, **labels):
+        key = _labels_key(self.labelnames, labels)
+        with self.lock:
+            value_obj = self.values.get(key)
+            if value_obj is None:
+                value_obj = {"buckets": [0] * len(self.buckets), "sum": 0, "count": 0}
+                self.values[key] = value_obj
+
+            for i, upper_bound in enumerate(self.buckets):
+                if value <= upper_bound:
+                    value_obj["buckets"][i] += 1
+
+            value_obj["sum"] += value
+            value_obj["count"] += 1
+
+    def snapshot(self):
+        snapshot = super(Histogram, self).snapshot()
+        snapshot["buckets"] = self.buckets
+        return snapshot
+
+    def _copy(self, value):
+        return {"buckets": list(value["buckets"]), "sum": value["sum"], "count": value["count"]}
+
+
+class Registry(object):
+    def __init__(self):
+        self.metrics = OrderedDict()  # Dict[str, Metric] where str is the metric name
+        self.lock = threading.Lock()
+
+    def _register(self, metric_class, name, *args, **kwargs):
+        with self.lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = metric_class(name, *args, **kwargs)
+                self.metrics[name] = metric
+            elif not isinstance(metric, metric_class):
+                raise MetricsError("Metric {} is already registered as a {}".format(name, metric.type_name))
+
+            return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter, name, documentation, labelnames)
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._register(Gauge, name, documentation, labelnames)
+
+    def histogram(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self._register(Histogram, name, documentation, labelnames, buckets=buckets)
+
+    def snapshot(self):
+        with self.lock:
+            metrics = list(self.metrics.values())
+
+        return OrderedDict((metric.name, metric.snapshot()) for metric in metrics)
+
+
+REGISTRY = Registry()
+
+counter = REGISTRY.counter
+gauge = REGISTRY.gauge
+histogram = REGISTRY.histogram
+
+
+def write_snapshot(directory, source, registry=REGISTRY):
+    """
+    Atomically replace <directory>/<source>.json with the current registry snapshot
+    """
+    snapshot = registry.snapshot()
+    snapshot["metrics_snapshot_timestamp_seconds"] = {
+        "type": "gauge",
+        "help": "Unix time when the process wrote its metrics snapshot",
+        "labelnames": ["source"],
+        "samples": [[[source], time.time()]],
+    }
+
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".{}-".format(source))
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(snapshot, f)
+
+        os.rename(tmp_path, os.path.join(directory, "{}.json".format(source)))
+    except Exception:
+        os.unlink(tmp_path)
+        raise
+
+
+_snapshot_threads = {}  # Dict[int, threading.Thread] where int is the pid
+_snapshot_threads_lock = threading.Lock()
+
+
+def start_snapshot_thread(directory, prefix, interval, registry=REGISTRY):
+    """
+    Write <directory>/<prefix>-<pid>.json every interval seconds from a daemon thread
+
+    Cheap enough to call on every request, the thread is started once per process, also in processes
+    that were forked after the parent called it.
+    """
+    pid = os.getpid()
+    if pid in _snapshot_threads:
+        return
+
+    with _snapshot_threads_lock:
+        if pid in _snapshot_threads:
+            return
+
+        source = "{}-{}".format(prefix, pid)
+
+        def write_forever():
+            while True:
+                try:
+                    write_snapshot(directory, source, registry=registry)
+                except Exception as e:
+                    logger.error("Could not write metrics snapshot {}: {}".format(source, e))
+
+                time.sleep(interval)
+
+        thread = threading.Thread(target=write_forever, name="metrics-snapshot")
+        thread.daemon = True
+        thread.start()
+        _snapshot_threads[pid] = thread
+
+
+def snapshot_time(snapshot):
+    timestamps = snapshot.get("metrics_snapshot_timestamp_seconds", {}).get("samples", [])
+    return max([value for _, value in timestamps] or [0])
+
+
+def read_snapshots(directory, max_age=None):
+    """
+    Snapshots that were not rewritten within max_age seconds are deleted, e.g. the ones of web workers
+    that exited, each of which left a <prefix>-<pid>.json behind
+    """
+    snapshots = []
+    if not os.path.isdir(directory):
+        return snapshots
+
+    for file_name in sorted(os.listdir(directory)):
+        if not file_name.endswith(".json") or file_name.startswith("."):
+            continue
+
+        try:
+            with open(os.path.join(directory, file_name)) as f:
+                snapshot = json.load(f, object_pairs_hook=OrderedDict)
+        except ValueError as e:
+            logger.error("Skipping unreadable metrics snapshot {}: {}".format(file_name, e))
+            continue
+
+        if max_age is not None and snapshot_time(snapshot) < time.time() - max_age:
+            try:
+                os.remove(os.path.join(directory, file_name))
+            except OSError:
+                pass  # already deleted by another reader
+
+            continue
+
+        snapshots.append(snapshot)
+
+    return snapshots
+
+
+def merge_snapshots(snapshots):
+    merged = OrderedDict()
+    for snapshot in snapshots:
+        for name, metric in snapshot.items():
+            target = merged.get(name)
+            if target is None:
+                target = dict(metric, samples=OrderedDict())
+                merged[name] = target
+            elif target["type"] != metric["type"] or target.get("buckets") != metric.get("buckets"):
+                logger.error("Metric {} does not match between snapshots, skipping one of them".format(name))
+                continue
+
+            for label_values, value in metric["samples"]:
+                key = tuple(label_values)
+                previous = target["samples"].get(key)
+                if previous is None or metric["type"] == "gauge":
+                    target["samples"][key] = value
+                elif metric["type"] == "counter":
+                    target["samples"][key] = previous + value
+                else:
+                    target["samples"][key] = {
+                        "buckets": [a + b for a, b in zip(previous["buckets"], value["buckets"])],
+                        "sum": previous["sum"] + value["sum"],
+                        "count": previous["count"] + value["count"],
+                    }
+
+    for metric in merged.values():
+        metric["samples"] = [[list(key), value] for key, value in metric["samples"].items()]
+
+    return merged
+
+
+def _format_labels(labelnames, label_values, extra=()):
+    pairs = list(zip(labelnames, label_values)) + list(extra)
+    if not pairs:
+        return ""
+
+    escaped = [
+        '{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"'))
+        for name, value in pairs
+    ]
+    return "{" + ",".join(escaped) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render(snapshot):
+    """
+    Prometheus text exposition format 0.0.4
+    """
+    lines = []
+    for name, metric in snapshot.items():
+        lines.append("# HELP {} {}".format(name, metric["help"]))
+        lines.append("# TYPE {} {}".format(name, metric["type"]))
+        labelnames = metric["labelnames"]
+
+        for label_values, value in sorted(metric["samples"], key=lambda sample: sample[0]):
+            if metric["type"] != "histogram":
+                lines.append("{}{} {}".format(name, _format_labels(labelnames, label_values), _format_value(value)))
+                continue
+
+            for upper_bound, count in zip(metric["buckets"] + [float("inf")], value["buckets"] + [value["count"]]):
+                le = (("le", _format_value(upper_bound)),)
+                lines.append("{}_bucket{} {}".format(name, _format_labels(labelnames, label_values, le), count))
+
+            lines.append("{}_sum{} {}".format(name, _format_labels(labelnames, label_values), _format_value(value["sum"])))
+            lines.append("{}_count{} {}".format(name, _format_labels(labelnames, label_values), value["count"]))
+
+    return "\n".join(lines) + "\n"
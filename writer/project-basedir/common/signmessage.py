@@ -0,0 +1,224 @@
+"""
+Local verification of lnd "signmessage" signatures
+
+lnd signs double-SHA256("Lightning Signed Message:" + msg) with the node key, producing a 65 byte
+compact recoverable secp256k1 signature which is then zbase32 encoded. Verifying it is public key
+recovery, so it can be done here instead of a round-trip to lnd's VerifyMessage.
+
+The difference from lnd: lnd also requires the recovered key to be a node in its channel graph
+before it reports valid=true, here any key that signed the message is valid. The writer only relies on
+this where the pubkey is compared against an existing author (upvotes, accepts, award payouts), a
+signature that makes its key the author of a new post goes to lnd unless LOCAL_VERIFYMESSAGE_NEW_AUTHORS
+is on. The reader uses it for previews and author checks that the writer repeats.
+
+Shared by the reader (Python 2) and the writer (Python 3).
+"""
+import hashlib
+import binascii
+
+SIGNED_MSG_PREFIX = b"Lightning Signed Message:"
+
+ZBASE32_ALPHABET = "ybndrfg8ejkmcpqxot1uwisza345h769"
+ZBASE32_VALUES = {c: i for i, c in enumerate(ZBASE32_ALPHABET)}
+
+# secp256k1 curve parameters
+P = 2 ** 256 - 2 ** 32 - 977
+N = 0xFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFEBAAEDCE6AF48A03BBFD25E8CD0364141
+GX = 0x79BE667EF9DCBBAC55A06295CE870B07029BFCDB2DCE28D959F2815B16F81798
+GY = 0x483ADA7726A3C4655DA4FBFC0E1108A8FD17B448A68554199C47D08FFB10D4B8
+
+
+class SignMessageError(Exception):
+    pass
+
+
+def zbase32_decode(text):
+    bits = 0
+    num_bits = 0
+    out = bytearray()
+    for c in text:
+        if c not in ZBASE32_VALUES:
+            raise SignMessageError("Not a zbase32 character: {}".format(repr(c)))
+
+        bits = (bits << 5) | ZBASE32_VALUES[c]
+        num_bits += 5
+        if num_bits >= 8:
+            num_bits -= 8
+            out.append((bits >> num_bits) & 0xff)
+
+    return bytes(out)
+
+
+def zbase32_encode(data):
+    bits = 0
+    num_bits = 0
+    out = []
+    for b in bytearray(data):
+        bits = (bits << 8) | b
+        num_bits += 8
+        while num_bits >= 5:
+            num_bits -= 5
+            out.append(ZBASE32_ALPHABET[(bits >> num_bits) & 0x1f])
+
+    if num_bits > 0:
+        out.append(ZBASE32_ALPHABET[(bits << (5 - num_bits)) & 0x1f])
+
+    return "".join(out)
+
+
+def _bytes_to_int(data):
+    return int(binascii.hexlify(data), 16)
+
+
+def _inverse(a, m):
+    return pow(a, m - 2, m)
+
+
+#
+# Point arithmetic in Jacobian coordinates (X, Y, Z), None is the point at infinity
+#
+
+def _to_jacobian(point):
+    return (point[0], point[1], 1)
+
+
+def _from_jacobian(point):
+    if point is None:
+        return None
+
+    x, y, z = point
+    z_inv = _inverse(z, P)
+    z_inv2 = z_inv * z_inv % P
+    return (x * z_inv2 % P, y * z_inv2 * z_inv % P)
+
+
+def _double(point):
+    if point is None:
+        return None
+
+    x, y, z = point
+    if y == 0:
+        return None
+
+    ysq = y * y % P
+    s = 4 * x * ysq % P
+    m = 3 * x * x % P
+    nx = (m * m - 2 * s) % P
+    ny = (m * (s - nx) - 8 * ysq * ysq) % P
+    nz = 2 * y * z % P
+    return (nx, ny, nz)
+
+
+def _add(p1, p2):
+    if p1 is None:
+        return p2
+    if p2 is None:
+        return p1
+
+    x1, y1, z1 = p1
+    x2, y2, z2 = p2
+    z1sq = z1 * z1 % P
+    z2sq = z2 * z2 % P
+    u1 = x1 * z2sq % P
+    u2 = x2 * z1sq % P
+    s1 = y1 * z2sq * z2 % P
+    s2 = y2 * z1sq * z1 % P
+
+    if u1 == u2:
+        if s1 != s2:
+            return None
+        return _double(p1)
+
+    h = u2 - u1
+    r = s2 - s1
+    h2 = h * h % P
+    h3 = h * h2 % P
+    u1h2 = u1 * h2 % P
+    nx = (r * r - h3 - 2 * u1h2) % P
+    ny = (r * (u1h2 - nx) - s1 * h3) % P
+    nz = h * z1 * z2 % P
+    return (nx, ny, nz)
+
+
+def _double_mul(k1, p1, k2, p2):
+    """
+    k1*p1 + k2*p2 with a shared double-and-add loop (Shamir's trick)
+    """
+    both = _add(p1, p2)
+    result = None
+    for i in range(max(k1.bit_length(), k2.bit_length()) - 1, -1, -1):
+        result = _double(result)
+        bit1 = (k1 >> i) & 1
+        bit2 = (k2 >> i) & 1
+        if bit1 and bit2:
+            result = _add(result, both)
+        elif bit1:
+            result = _add(result, p1)
+        elif bit2:
+            result = _add(result, p2)
+
+    return result
+
+
+def message_digest(msg):
+    if not isinstance(msg, bytes):
+        msg = msg.encode("utf-8")
+
+    return hashlib.sha256(hashlib.sha256(SIGNED_MSG_PREFIX + msg).digest()).digest()
+
+
+def recover_pubkey(digest, compact_sig):
+    """
+    Recover the compressed public key from a 65 byte compact signature, same as btcec.RecoverCompact
+    """
+    compact_sig = bytearray(compact_sig)
+    if len(compact_sig) != 65:
+        raise SignMessageError("Compact signature has to be 65 bytes, got {}".format(len(compact_sig)))
+
+    header = compact_sig[0]
+    if header < 27 or header > 34:
+        raise SignMessageError("Invalid compact signature header {}".format(header))
+
+    recovery_id = (header - 27) & 3
+
+    r = _bytes_to_int(bytes(compact_sig[1:33]))
+    s = _bytes_to_int(bytes(compact_sig[33:65]))
+    if not 1 <= r < N or not 1 <= s < N:
+        raise SignMessageError("Signature r or s is out of range")
+
+    # R is the point whose x coordinate is r (plus N for recovery ids 2 and 3)
+    x = r + (recovery_id >> 1) * N
+    if x >= P:
+        raise SignMessageError("Signature r is not a valid x coordinate")
+
+    alpha = (x * x * x + 7) % P
+    y = pow(alpha, (P + 1) // 4, P)
+    if y * y % P != alpha:
+        raise SignMessageError("Signature r is not on the curve")
+
+    if y & 1 != recovery_id & 1:
+        y = P - y
+
+    # Q = r^-1 * (s*R - e*G)
+    e = _bytes_to_int(digest)
+    r_inv = _inverse(r, N)
+    u1 = (-e * r_inv) % N
+    u2 = (s * r_inv) % N
+    q = _from_jacobian(_double_mul(u1, _to_jacobian((GX, GY)), u2, _to_jacobian((x, y))))
+    if q is None:
+        raise SignMessageError("Recovered public key is the point at infinity")
+
+    prefix = "03" if q[1] & 1 else "02"
+    return prefix + "{:064x}".format(q[0])
+
+
+def verifymessage(msg, sig):
+    """
+    Same result shape as lnclient.verifymessage: {"valid": bool, "pubkey": hex of the compressed pubkey}
+    """
+    try:
+        pubkey = recover_pubkey(message_digest(msg), zbase32_decode(sig))
+    except SignMessageError:
+        return {"valid": False, "pubkey": ""}
+
+    return {"valid": True, "pubkey": pubkey}
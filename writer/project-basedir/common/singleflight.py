@@ -0,0 +1,49 @@
+import threading
+
+
+class _Call(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """
+    Run a function once per key among concurrent callers of this process
+
+    The first caller of a key runs the function, callers that arrive while it is running wait
+    and get the same result, or the same exception. Once it returns the next caller runs it again.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}  # Dict[Hashable, _Call]
+
+    def do(self, key, fn):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self.calls[key] = call
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+
+            return call.result
+
+        try:
+            call.result = fn()
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+
+            call.done.set()
+
+        return call.result
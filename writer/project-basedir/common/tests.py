@@ -0,0 +1,441 @@
+import os
+import json
+import shutil
+import subprocess
+import tempfile
+import time
+import threading
+import unittest
+
+from django.test import SimpleTestCase
+
+from common import cli
+from common import lnrpc
+from common import metrics
+from common import signmessage
+from common.circuitbreaker import CircuitBreaker
+from common.hedge import Hedger
+from common.circuitbreaker import CircuitOpenError
+from common.singleflight import SingleFlight
+from common.lru import LRUCache
+
+if lnrpc.grpc is not None:
+    from common.lnrpc_fake import FakeLightningServer
+
+
+class ProtobufCodecTest(SimpleTestCase):
+    def test_varint_roundtrip(self):
+        for value in [0, 1, 127, 128, 300, 2 ** 32, 2 ** 63 - 1]:
+            encoded = lnrpc.encode_varint(value)
+            self.assertEqual(lnrpc.decode_varint(encoded, 0), (value, len(encoded)))
+
+    def test_negative_int64(self):
+        encoded = lnrpc.Invoice.encode({"value": -5})
+        self.assertEqual(lnrpc.Invoice.decode(encoded)["value"], -5)
+
+    def test_invoice_to_lncli_json(self):
+        encoded = lnrpc.Invoice.encode({
+            "memo": "ln.support_abc",
+            "r_hash": b"\x01\xff",
+            "add_index": 7,
+            "state": lnrpc.INVOICE_STATE_BY_NAME["SETTLED"],
+        })
+        as_json = lnrpc.Invoice.to_json(lnrpc.Invoice.decode(encoded))
+        self.assertEqual(as_json["memo"], "ln.support_abc")
+        self.assertEqual(as_json["r_hash"], "01ff")
+        self.assertEqual(as_json["add_index"], "7")
+        self.assertEqual(as_json["state"], "SETTLED")
+        self.assertEqual(as_json["settle_index"], "0")
+
+    def test_unknown_fields_are_skipped(self):
+        encoded = lnrpc.encode_varint(99 << 3 | lnrpc.WIRE_VARINT) + lnrpc.encode_varint(1)
+        encoded += lnrpc.AddInvoiceResponse.encode({"add_index": 3})
+        self.assertEqual(lnrpc.AddInvoiceResponse.decode(encoded)["add_index"], 3)
+
+
+class SignMessageTest(SimpleTestCase):
+    # (msg, zbase32 signature, compressed pubkey), signed with private keys 1, 0xdeadbeef * 2**100 + 12345 and N - 2
+    VECTORS = [
+        (
+            "hello",
+            "d6kfezkenigypp1az8jke9j4554frwscskq8659w4nis6bb15grz4co8bpuna5h5k77dk79mmnenhn1ddejhpu8es5c1nhxk58sjp1z7",
+            "0279be667ef9dcbbac55a06295ce870b07029bfcdb2dce28d959f2815b16f81798",
+        ),
+        (
+            '{"content": "Body", "post_type": 0, "tag_val": "ln", "title": "Question"}',
+            "d6zchsw9tmxuuwezpcexupwpot8zqeo357tgkqopa7378xxtfado61z5fm73qe83spro9sreh71hwweqfz3mzngeafdoc55hqa9tsy1q",
+            "02b38e653d58f3f9e98f39b9b0e37dfb0e021c0d0fb2e96ecc8515739b26ed2a23",
+        ),
+        (
+            u"ln.support \u00fcn\u00efcode",
+            "rnzcf75547y8d8obbc45rg1jgbxxbqpjfr43wtb1etfjqmhzderakbwsrjseb5xagmiymqiaonkup1g8ir4nbztjo18wi6kamiyf1jt3",
+            "03c6047f9441ed7d6d3045406e95c07cd85c778e4b8cef3ca7abac09b95c709ee5",
+        ),
+    ]
+
+    def test_vectors(self):
+        for msg, sig, pubkey in self.VECTORS:
+            self.assertEqual(signmessage.verifymessage(msg, sig), {"valid": True, "pubkey": pubkey})
+
+    def test_other_message_recovers_other_pubkey(self):
+        msg, sig, pubkey = self.VECTORS[0]
+        result = signmessage.verifymessage(msg + " ", sig)
+        self.assertNotEqual(result["pubkey"], pubkey)
+
+    def test_malformed_signatures(self):
+        msg, sig, pubkey = self.VECTORS[0]
+        for bad_sig in ["", sig[:-2], sig + "yy", "l" + sig[1:], "y" * len(sig)]:
+            self.assertEqual(signmessage.verifymessage(msg, bad_sig), {"valid": False, "pubkey": ""})
+
+    def test_zbase32_roundtrip(self):
+        data = bytes(bytearray(range(65)))
+        self.assertEqual(signmessage.zbase32_decode(signmessage.zbase32_encode(data)), data)
+
+
+class MetricsTest(SimpleTestCase):
+    def setUp(self):
+        self.registry = metrics.Registry()
+        self.snapshot_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.snapshot_dir)
+
+    def test_render(self):
+        self.registry.counter("runs_total", "Runs", ["node"]).inc(node='a"b')
+        self.registry.gauge("lag", "Lag").set(7)
+        latency = self.registry.histogram("latency_seconds", "Latency", buckets=[0.1, 1])
+        latency.observe(0.05)
+        latency.observe(0.5)
+
+        self.assertEqual(metrics.render(self.registry.snapshot()).splitlines(), [
+            "# HELP runs_total Runs",
+            "# TYPE runs_total counter",
+            'runs_total{node="a\\"b"} 1',
+            "# HELP lag Lag",
+            "# TYPE lag gauge",
+            "lag 7",
+            "# HELP latency_seconds Latency",
+            "# TYPE latency_seconds histogram",
+            'latency_seconds_bucket{le="0.1"} 1',
+            'latency_seconds_bucket{le="1"} 2',
+            'latency_seconds_bucket{le="+Inf"} 2',
+            "latency_seconds_sum 0.55",
+            "latency_seconds_count 2",
+        ])
+
+    def test_snapshots_are_merged(self):
+        runs = self.registry.counter("runs_total", "Runs", ["node"])
+        lag = self.registry.gauge("lag", "Lag", ["node"])
+        runs.inc(3, node="a")
+        lag.set(5, node="a")
+        metrics.write_snapshot(self.snapshot_dir, "worker", registry=self.registry)
+
+        other = metrics.Registry()
+        other.counter("runs_total", "Runs", ["node"]).inc(2, node="a")
+        other.gauge("lag", "Lag", ["node"]).set(1, node="b")
+
+        merged = metrics.merge_snapshots(metrics.read_snapshots(self.snapshot_dir) + [other.snapshot()])
+        self.assertEqual(merged["runs_total"]["samples"], [[["a"], 5]])
+        self.assertEqual(merged["lag"]["samples"], [[["a"], 5], [["b"], 1]])
+        self.assertEqual(merged["metrics_snapshot_timestamp_seconds"]["samples"][0][0], ["worker"])
+
+    def test_stale_snapshots_are_deleted(self):
+        self.registry.counter("runs_total", "Runs").inc()
+        metrics.write_snapshot(self.snapshot_dir, "worker", registry=self.registry)
+        self.assertEqual(len(metrics.read_snapshots(self.snapshot_dir, max_age=60)), 1)
+
+        # the worker stopped writing two minutes ago
+        path = os.path.join(self.snapshot_dir, "worker.json")
+        with open(path) as f:
+            snapshot = json.load(f)
+        snapshot["metrics_snapshot_timestamp_seconds"]["samples"][0][1] -= 120
+        with open(path, "w") as f:
+            json.dump(snapshot, f)
+
+        self.assertEqual(len(metrics.read_snapshots(self.snapshot_dir)), 1)
+        self.assertEqual(len(metrics.read_snapshots(self.snapshot_dir, max_age=60)), 0)
+        self.assertFalse(os.path.exists(path))
+
+    def test_snapshot_thread(self):
+        # a request of another test may have started the thread of this process already
+        started = metrics._snapshot_threads.pop(os.getpid(), None)
+        if started is not None:
+            self.addCleanup(metrics._snapshot_threads.__setitem__, os.getpid(), started)
+
+        self.registry.counter("runs_total", "Runs").inc()
+        metrics.start_snapshot_thread(self.snapshot_dir, "web", 60, registry=self.registry)
+
+        thread = metrics._snapshot_threads.pop(os.getpid())
+        for _ in range(100):
+            if len(metrics.read_snapshots(self.snapshot_dir)) > 0:
+                break
+            time.sleep(0.01)
+
+        self.assertTrue(thread.daemon)
+        self.assertEqual(os.listdir(self.snapshot_dir), ["web-{}.json".format(os.getpid())])
+
+    def test_labels_are_checked(self):
+        with self.assertRaises(metrics.MetricsError):
+            self.registry.counter("runs_total", "Runs", ["node"]).inc(rpcserver="a")
+
+    def test_cli_command_name(self):
+        cmd = ["/bin/lncli", "--macaroonpath", "m", "--rpcserver=r", "listinvoices", "--index_offset", "0"]
+        self.assertEqual(cli.command_name(cmd), "lncli listinvoices")
+
+
+class RpcserverSlotTest(SimpleTestCase):
+    def test_rpcserver_of(self):
+        self.assertEqual(cli.rpcserver_of(["lncli", "--rpcserver", "node1:10009", "getinfo"]), "node1:10009")
+        self.assertEqual(cli.rpcserver_of(["lncli", "--rpcserver=node2", "getinfo"]), "node2")
+        self.assertIsNone(cli.rpcserver_of(["ls", "-l"]))
+
+    def test_slots_limit_concurrency(self):
+        holders = [cli.rpcserver_slot("slottest", timeout=1) for _ in range(cli.MAX_CONCURRENT_PER_RPCSERVER)]
+        for holder in holders:
+            holder.__enter__()
+
+        with self.assertRaises(subprocess.TimeoutExpired):
+            with cli.rpcserver_slot("slottest", timeout=0.05):
+                pass
+
+        with cli.rpcserver_slot("otherserver", timeout=0.05):
+            pass
+
+        holders[0].__exit__(None, None, None)
+        with cli.rpcserver_slot("slottest", timeout=0.05):
+            pass
+
+        for holder in holders[1:]:
+            holder.__exit__(None, None, None)
+
+
+class HedgerTest(SimpleTestCase):
+    def test_slow_first_node_is_hedged(self):
+        hedger = Hedger("test", default_delay=0.05)
+        release = threading.Event()
+
+        def slow():
+            release.wait(5)
+            return "slow"
+
+        start_time = time.time()
+        self.assertEqual(hedger.call([slow, lambda: "fast"]), "fast")
+        self.assertLess(time.time() - start_time, 1)
+        release.set()
+
+    def test_fast_first_node_is_not_hedged(self):
+        hedger = Hedger("test", default_delay=5)
+        calls = []
+
+        self.assertEqual(hedger.call([lambda: "first", lambda: calls.append(1)]), "first")
+        self.assertEqual(calls, [])
+
+    def test_failure_goes_to_next_node(self):
+        hedger = Hedger("test", default_delay=5, accept=lambda output: output["success"])
+
+        def failing():
+            raise ValueError("lncli failed")
+
+        self.assertEqual(hedger.call([failing, lambda: {"success": True}]), {"success": True})
+        self.assertEqual(hedger.call([lambda: {"success": False}]), {"success": False})
+        with self.assertRaises(ValueError):
+            hedger.call([failing, failing])
+
+    def test_delay_is_p95(self):
+        hedger = Hedger("test", default_delay=1.0, min_samples=20)
+        for i in range(19):
+            hedger.record(i / 100.0)
+        self.assertEqual(hedger.delay(), 1.0)
+
+        for i in range(19, 100):
+            hedger.record(i / 100.0)
+        self.assertEqual(hedger.delay(), 0.95)
+
+
+class SingleFlightTest(SimpleTestCase):
+    def test_concurrent_callers_share_one_call(self):
+        flight = SingleFlight()
+        release = threading.Event()
+        calls = []
+
+        def slow_call():
+            calls.append(1)
+            release.wait(5)
+            return {"pay_req": "lnfake1"}
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(flight.do("key", slow_call))) for _ in range(5)]
+        threads[0].start()
+        while len(calls) == 0:
+            time.sleep(0.01)  # leader is inside slow_call
+
+        for thread in threads[1:]:
+            thread.start()
+
+        time.sleep(0.1)
+        release.set()
+        for thread in threads:
+            thread.join(5)
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(len(results), 5)
+        self.assertTrue(all(r is results[0] for r in results))
+        self.assertEqual(flight.calls, {})
+
+        self.assertEqual(flight.do("key", lambda: "again"), "again")
+
+    def test_error_is_shared(self):
+        flight = SingleFlight()
+
+        def failing_call():
+            raise ValueError("addinvoice failed")
+
+        with self.assertRaises(ValueError):
+            flight.do("key", failing_call)
+
+        self.assertEqual(flight.calls, {})
+
+
+class CircuitBreakerTest(SimpleTestCase):
+    def test_opens_after_threshold_and_fails_fast(self):
+        breaker = CircuitBreaker("test", failure_threshold=3, reset_timeout=30)
+        for _ in range(2):
+            breaker.before_call()
+            breaker.record_failure()
+
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+        breaker.before_call()
+        breaker.record_failure()
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+
+        with self.assertRaises(CircuitOpenError):
+            breaker.before_call()
+
+    def test_success_resets_failures(self):
+        breaker = CircuitBreaker("test", failure_threshold=2)
+        breaker.record_failure()
+        breaker.record_success()
+        breaker.record_failure()
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+
+    def test_half_open_trial_call(self):
+        breaker = CircuitBreaker("test", failure_threshold=1, reset_timeout=30)
+        breaker.record_failure()
+
+        breaker.opened_at -= 30
+        breaker.before_call()
+        self.assertEqual(breaker.state, CircuitBreaker.HALF_OPEN)
+        with self.assertRaises(CircuitOpenError):
+            breaker.before_call()  # only one trial call
+
+        breaker.record_failure()
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        with self.assertRaises(CircuitOpenError):
+            breaker.before_call()
+
+        breaker.opened_at -= 30
+        breaker.before_call()
+        breaker.record_success()
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+        breaker.before_call()
+
+    def test_lost_trial_call_opens_again(self):
+        breaker = CircuitBreaker("test", failure_threshold=1, reset_timeout=30)
+        breaker.record_failure()
+
+        breaker.opened_at -= 30
+        breaker.before_call()  # the trial call never reports back
+        self.assertEqual(breaker.state, CircuitBreaker.HALF_OPEN)
+
+        breaker.opened_at -= 30
+        breaker.before_call()
+        self.assertEqual(breaker.state, CircuitBreaker.HALF_OPEN)
+        breaker.record_success()
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+
+
+@unittest.skipIf(lnrpc.grpc is None, "grpcio is not installed")
+class FakeLightningServerTest(SimpleTestCase):
+    def setUp(self):
+        self.server = FakeLightningServer(valid_signatures={"goodsig": "FAKEPUBKEY"})
+        self.server.start()
+        self.client = self.server.client()
+        self.rpcserver = self.client.rpcserver
+        lnrpc.register_client(self.client)
+
+    def tearDown(self):
+        lnrpc.close_all()
+        self.server.stop()
+
+    def test_addinvoice_and_listinvoices(self):
+        added = lnrpc.addinvoice("memo1", self.rpcserver, amt=2, expiry=3600)
+        self.assertEqual(added["add_index"], "1")
+        self.assertTrue(added["payment_request"].startswith("lnfake1"))
+
+        lnrpc.addinvoice("memo2", self.rpcserver, amt=2, expiry=3600)
+        self.server.settle(1)
+
+        listed = lnrpc.listinvoices(index_offset=0, rpcserver=self.rpcserver)
+        self.assertEqual([i["memo"] for i in listed["invoices"]], ["memo1", "memo2"])
+        self.assertEqual([i["state"] for i in listed["invoices"]], ["SETTLED", "OPEN"])
+        self.assertEqual(listed["invoices"][0]["amt_paid_sat"], "2")
+        self.assertEqual(listed["last_index_offset"], "2")
+
+        listed = lnrpc.listinvoices(index_offset=1, rpcserver=self.rpcserver, max_invoices=1)
+        self.assertEqual([i["add_index"] for i in listed["invoices"]], ["2"])
+
+    def test_channel_is_reused(self):
+        for _ in range(3):
+            lnrpc.listinvoices(index_offset=0, rpcserver=self.rpcserver)
+
+        self.assertIs(lnrpc.get_client(self.rpcserver), self.client)
+        self.assertEqual(self.server.calls, ["ListInvoices"] * 3)
+
+    def test_verifymessage(self):
+        self.assertEqual(
+            lnrpc.verifymessage("msg", "goodsig", self.rpcserver),
+            {"valid": True, "pubkey": "FAKEPUBKEY"}
+        )
+        self.assertFalse(lnrpc.verifymessage("msg", "badsig", self.rpcserver)["valid"])
+
+    def test_decodepayreq_and_payinvoice(self):
+        added = lnrpc.addinvoice("memo1", self.rpcserver, amt=5, expiry=3600)
+
+        decoded = lnrpc.decodepayreq(added["payment_request"], self.rpcserver)
+        self.assertTrue(decoded["success"])
+        self.assertEqual(json.loads(decoded["stdouterr"])["num_satoshis"], "5")
+
+        failed = lnrpc.decodepayreq("lnbogus", self.rpcserver)
+        self.assertFalse(failed["success"])
+        self.assertEqual(failed["failure_type"], "exit")
+
+        paid = lnrpc.payinvoice(added["payment_request"], self.rpcserver)
+        self.assertTrue(paid["success"])
+        self.assertEqual(self.server.payments, [added["payment_request"]])
+
+    def test_subscribe_invoices(self):
+        lnrpc.addinvoice("memo1", self.rpcserver, amt=2, expiry=3600)
+        lnrpc.addinvoice("memo2", self.rpcserver, amt=2, expiry=3600)
+
+        stream = self.client.stream("SubscribeInvoices", {"add_index": 1})
+        updates = [next(stream)]
+
+        self.server.settle(2)
+        updates.append(next(stream))
+        stream.cancel()
+
+        self.assertEqual([(u["add_index"], u["settled"]) for u in updates], [(2, False), (2, True)])
+
+
+class LRUCacheTest(SimpleTestCase):
+    def test_least_recently_used_is_dropped(self):
+        cache = LRUCache(maxsize=2)
+        cache.put("a", 1)
+        cache.put("b", 2)
+        self.assertEqual(cache.get("a"), 1)
+
+        cache.put("c", 3)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("a"), 1)
+        self.assertEqual(cache.get("c"), 3)
+        self.assertEqual(len(cache), 2)
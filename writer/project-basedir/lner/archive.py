@@ -0,0 +1,121 @@
+"""
+Invoice retention, run as its own background task instead of in Runner.pre_run
+
+Invoices older than INVOICE_RETENTION that the global checkpoint moved past are copied into ArchivedInvoice,
+together with the memo of their InvoiceRequest, and deleted from the hot tables. Each chunk is one
+transaction with a handful of set-based statements, so Invoice and InvoiceRequest stay small and the
+ingestion loop never scans history. InvoiceRequests that never got an invoice are deleted after retention.
+"""
+import time
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from common.log import logger
+from common import metrics
+
+from lner.models import LightningNode
+from lner.models import Invoice
+from lner.models import InvoiceRequest
+from lner.models import ArchivedInvoice
+
+
+ARCHIVE_INTERVAL_SECONDS = 3600
+CHUNK_SIZE = 1000
+
+ARCHIVED = metrics.counter("lner_archived_invoices_total", "Invoices moved to the archive after retention", ["node"])
+
+
+def archive_chunk(node, cutoff, now, chunk_size=CHUNK_SIZE):
+    """
+    Move up to chunk_size expired invoices of the node into the archive, returns how many were moved
+    """
+    with transaction.atomic():
+        rows = list(
+            Invoice.objects.filter(
+                lightning_node=node,
+                created__lt=cutoff,
+                add_index__lte=node.global_checkpoint,
+            ).order_by("id").values(
+                "id",
+                "add_index",
+                "r_hash",
+                "invoice_request_id",
+                "invoice_request__memo",
+                "checkpoint_value",
+                "performed_action_type",
+                "performed_action_id",
+                "created",
+            )[:chunk_size]
+        )
+        if len(rows) == 0:
+            return 0
+
+        # ignore_conflicts makes a chunk that was archived but not deleted safe to archive again
+        ArchivedInvoice.objects.bulk_create(
+            [
+                ArchivedInvoice(
+                    id=row["id"],
+                    lightning_node=node,
+                    add_index=row["add_index"],
+                    r_hash=row["r_hash"],
+                    memo=row["invoice_request__memo"] or "",
+                    checkpoint_value=row["checkpoint_value"],
+                    performed_action_type=row["performed_action_type"],
+                    performed_action_id=row["performed_action_id"],
+                    created=row["created"],
+                    archived=now,
+                )
+                for row in rows
+            ],
+            ignore_conflicts=True
+        )
+
+        Invoice.objects.filter(pk__in=[row["id"] for row in rows]).delete()
+        InvoiceRequest.objects.filter(
+            pk__in=[row["invoice_request_id"] for row in rows if row["invoice_request_id"] is not None]
+        ).delete()
+
+    ARCHIVED.inc(len(rows), node=node.node_name)
+    return len(rows)
+
+
+def delete_orphan_requests(node, cutoff, chunk_size=CHUNK_SIZE):
+    deleted = 0
+    while True:
+        ids = list(
+            InvoiceRequest.objects.filter(
+                lightning_node=node,
+                created__lt=cutoff,
+                invoice__isnull=True,
+            ).order_by("id").values_list("id", flat=True)[:chunk_size]
+        )
+        if len(ids) == 0:
+            return deleted
+
+        InvoiceRequest.objects.filter(pk__in=ids).delete()
+        deleted += len(ids)
+
+
+def archive_invoices(now=None, chunk_size=CHUNK_SIZE):
+    start_time = time.time()
+    now = now or timezone.now()
+    cutoff = now - settings.INVOICE_RETENTION
+
+    archived = 0
+    for node in LightningNode.objects.all():
+        while True:
+            moved = archive_chunk(node, cutoff, now, chunk_size=chunk_size)
+            archived += moved
+            if moved < chunk_size:
+                break
+
+        deleted = delete_orphan_requests(node, cutoff, chunk_size=chunk_size)
+        if deleted:
+            logger.info("Deleted {} invoice requests of node {} without an invoice".format(deleted, node.node_name))
+
+    logger.info("Archived {} invoices older than {} in {:.3f} seconds".format(
+        archived, settings.INVOICE_RETENTION, time.time() - start_time))
+
+    return archived
@@ -0,0 +1,171 @@
+"""
+Node leases, so several run_many workers (processes or hosts) can share the polled nodes
+
+stream_invoices holds the lease of every node it streams with LeaseManager.hold, so a node is streamed by
+one process at a time.
+
+Every worker heartbeats into IngestWorker and holds a NodeLease for each node it processes. A worker takes
+free or expired leases up to its share, ceil(nodes / live workers), and releases leases above its share so
+workers that join get nodes too. A worker that dies stops renewing, its leases expire after LEASE_SECONDS
+and the other workers take them over.
+
+Leases are renewed well before they expire, but a worker can still stall past the expiry. Writes that must
+not happen twice are fenced in the DB: checkpoints are advanced with compare-and-set (set_global_checkpoint,
+set_settle_checkpoint) and upvotes claim their invoices, see Runner.apply_upvotes.
+"""
+import math
+import os
+import socket
+import uuid
+
+from datetime import timedelta
+
+from django.db import IntegrityError
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from common.log import logger
+from common import metrics
+
+from lner.models import LightningNode
+from lner.models import NodeLease
+from lner.models import IngestWorker
+
+
+LEASE_SECONDS = 30
+HEARTBEAT_SECONDS = 5
+
+WORKER_ID = "{}:{}:{}".format(socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+
+OWNED_NODES = metrics.gauge("lner_owned_nodes", "Nodes leased by this run_many worker", ["worker"])
+
+
+class LeaseLost(Exception):
+    pass
+
+
+class LeaseManager(object):
+    def __init__(self, worker_id=WORKER_ID, lease_seconds=LEASE_SECONDS, heartbeat_seconds=HEARTBEAT_SECONDS):
+        self.worker_id = worker_id
+        self.lease_seconds = lease_seconds
+        self.heartbeat_seconds = heartbeat_seconds
+
+        self.owned = set()  # Set[int] where int is node id
+        self.last_heartbeat = None
+
+    def owned_nodes(self, nodes, now=None):
+        """
+        The nodes leased by this worker, heartbeats every heartbeat_seconds
+        """
+        now = now or timezone.now()
+        if self.last_heartbeat is None or (now - self.last_heartbeat).total_seconds() >= self.heartbeat_seconds:
+            self.heartbeat(nodes, now)
+
+        return [node for node in nodes if node.id in self.owned]
+
+    def heartbeat(self, nodes, now=None):
+        now = now or timezone.now()
+        expires_at = now + timedelta(seconds=self.lease_seconds)
+        node_ids = set(node.id for node in nodes)
+
+        IngestWorker.objects.update_or_create(worker_id=self.worker_id, defaults={"heartbeat_at": now})
+        live_workers = IngestWorker.objects.filter(heartbeat_at__gt=now - timedelta(seconds=self.lease_seconds)).count()
+        share = int(math.ceil(len(node_ids) / float(max(live_workers, 1))))
+
+        # renew
+        NodeLease.objects.filter(owner=self.worker_id, expires_at__gt=now).update(expires_at=expires_at)
+        owned = set(
+            NodeLease.objects.filter(owner=self.worker_id, expires_at__gt=now).values_list("lightning_node_id", flat=True)
+        )
+
+        # release nodes that are no longer polled, and nodes above the share
+        keep = sorted(owned & node_ids)[:share]
+        released = owned - set(keep)
+        if released:
+            NodeLease.objects.filter(owner=self.worker_id, lightning_node_id__in=released).update(owner="", expires_at=now)
+            logger.info("Worker {} released nodes {}".format(self.worker_id, sorted(released)))
+
+        owned = set(keep)
+
+        # take free or expired leases
+        for node_id in sorted(node_ids - owned):
+            if len(owned) >= share:
+                break
+
+            if self.take(node_id, now, expires_at):
+                logger.info("Worker {} took the lease of node {}".format(self.worker_id, node_id))
+                owned.add(node_id)
+
+        self.owned = owned
+        self.last_heartbeat = now
+        OWNED_NODES.set(len(owned), worker=self.worker_id)
+
+        return owned
+
+    def take(self, node_id, now, expires_at):
+        try:
+            with transaction.atomic():
+                NodeLease.objects.get_or_create(lightning_node_id=node_id, defaults={"owner": "", "expires_at": now})
+        except IntegrityError:
+            pass  # created by another worker at the same time
+
+        taken = NodeLease.objects.filter(lightning_node_id=node_id).filter(
+            Q(owner="") | Q(expires_at__lte=now)
+        ).update(owner=self.worker_id, expires_at=expires_at)
+
+        return taken == 1
+
+    def hold(self, node_id, now=None):
+        """
+        Take or renew the lease of one node, without shares, False while another worker holds it
+        """
+        now = now or timezone.now()
+        expires_at = now + timedelta(seconds=self.lease_seconds)
+
+        renewed = NodeLease.objects.filter(
+            lightning_node_id=node_id, owner=self.worker_id, expires_at__gt=now
+        ).update(expires_at=expires_at)
+
+        if renewed == 0 and not self.take(node_id, now, expires_at):
+            self.owned.discard(node_id)
+            return False
+
+        self.owned.add(node_id)
+        return True
+
+    def release(self, node_id):
+        NodeLease.objects.filter(owner=self.worker_id, lightning_node_id=node_id).update(owner="", expires_at=timezone.now())
+        self.owned.discard(node_id)
+
+    def lost(self, node_id):
+        self.owned.discard(node_id)
+
+    def release_all(self):
+        NodeLease.objects.filter(owner=self.worker_id).update(owner="", expires_at=timezone.now())
+        IngestWorker.objects.filter(worker_id=self.worker_id).delete()
+        self.owned = set()
+        self.last_heartbeat = None
+
+
+def set_global_checkpoint(node, new_global_checkpoint):
+    """
+    Advance the global checkpoint only if nobody else moved it since node was read
+    """
+    updated = LightningNode.objects.filter(pk=node.pk, global_checkpoint=node.global_checkpoint).update(
+        global_checkpoint=new_global_checkpoint
+    )
+    if updated == 0:
+        raise LeaseLost("Global checkpoint of node {} was changed by another worker".format(node.node_name))
+
+    node.global_checkpoint = new_global_checkpoint
+
+
+def set_settle_checkpoint(node, new_settle_checkpoint):
+    updated = LightningNode.objects.filter(pk=node.pk, settle_checkpoint=node.settle_checkpoint).update(
+        settle_checkpoint=new_settle_checkpoint
+    )
+    if updated == 0:
+        raise LeaseLost("Settle checkpoint of node {} was changed by another worker".format(node.node_name))
+
+    node.settle_checkpoint = new_settle_checkpoint
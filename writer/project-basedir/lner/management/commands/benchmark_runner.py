@@ -0,0 +1,236 @@
+import time
+import logging
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.db import transaction
+from django.test.utils import override_settings
+from django.utils import timezone
+
+from common import json_util
+from common.log import logger
+
+from posts.models import Post
+from users.models import User
+
+from lner.models import LightningNode
+from lner.models import Invoice
+from lner.models import InvoiceRequest
+from lner.models import memo_digest
+from lner.tasks import Runner
+
+
+BENCHMARK_PUBKEY = "benchmark-author"
+BATCH_SIZE = 1000
+
+
+class Rollback(Exception):
+    pass
+
+
+class QueryCounter(object):
+    """
+    connection.execute_wrapper that only counts, CaptureQueriesContext would keep every query in memory
+    """
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+class FakeLnd(object):
+    """
+    Stands in for lnclient on the benchmark node, every seeded invoice is reported as settled
+    """
+    def __init__(self, raw_invoices):
+        self.raw_invoices = raw_invoices  # List[dict] ordered by add_index, starting at 1
+
+    def listinvoices(self, index_offset, rpcserver, max_invoices=100, pending_only=False, mock=False):
+        if pending_only:
+            selected = []
+        else:
+            selected = self.raw_invoices[index_offset:index_offset + max_invoices]
+
+        return {
+            "invoices": selected,
+            "first_index_offset": selected[0]["add_index"] if selected else "0",
+            "last_index_offset": selected[-1]["add_index"] if selected else "0",
+        }
+
+    def verifymessage(self, msg, sig, rpcserver, mock=False):
+        return {"valid": True, "pubkey": BENCHMARK_PUBKEY}
+
+
+def gen_memo(i, questions, answers):
+    """
+    Mix of actions: 50% upvotes, 10% accepts, 10% bounties, 15% questions and 15% answers
+    """
+    kind = i % 20
+    question = questions[i % len(questions)]
+    answer = answers[i % len(answers)]
+
+    if kind < 10:
+        memo = {"action": "Upvote", "post_id": answer.id, "unixtime": i}
+    elif kind < 12:
+        memo = {"action": "Accept", "post_id": answer.id, "unixtime": i, "sig": "benchmarksig"}
+    elif kind < 14:
+        memo = {"action": "Bounty", "post_id": question.id, "amt": 100, "unixtime": i}
+    elif kind < 17:
+        memo = {
+            "title": "Benchmark question number {}".format(i),
+            "content": "Synthetic question body number {} used to benchmark invoice processing".format(i),
+            "post_type": Post.QUESTION,
+            "tag_val": "benchmark",
+        }
+    else:
+        memo = {
+            "parent_post_id": question.id,
+            "content": "Synthetic answer body number {} used to benchmark invoice processing".format(i),
+            "post_type": Post.ANSWER,
+        }
+
+    return json_util.serialize_memo(memo)
+
+
+class Command(BaseCommand):
+    help = 'Measures lner.tasks.Runner throughput on synthetic settled invoices, all changes are rolled back'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', default="1000,10000,100000", help="Comma separated numbers of invoices")
+        parser.add_argument('--with-logging', action='store_true', help="Keep Runner INFO logs, they dominate the timings")
+
+    def handle(self, *args, **options):
+        sizes = [int(size) for size in options["sizes"].split(",")]
+
+        old_level = logger.level
+        if not options["with_logging"]:
+            logger.setLevel(logging.WARNING)
+
+        try:
+            with override_settings(MOCK_LN_CLIENT=False, LOCAL_VERIFYMESSAGE=False):
+                results = [self.run_size(size) for size in sizes]
+        finally:
+            logger.setLevel(old_level)
+
+        self.stdout.write(
+            "{:>8} {:>8} {:>10} {:>10} {:>10} {:>8} {:>12} {:>12} {:>12}".format(
+                "invoices", "seed_s", "pre_run_s", "run_s", "inv/sec", "passes", "pre_run_sql", "run_sql", "sql/invoice")
+        )
+        for r in results:
+            self.stdout.write(
+                "{size:>8} {seed:>8.2f} {pre_run:>10.2f} {run:>10.2f} {rate:>10.1f} {passes:>8} "
+                "{pre_run_queries:>12} {run_queries:>12} {queries_per_invoice:>12.1f}".format(**r)
+            )
+
+    def run_size(self, size):
+        result = {}
+        try:
+            with transaction.atomic():
+                result = self.measure(size)
+                raise Rollback()
+        except Rollback:
+            pass
+
+        return result
+
+    def seed(self, size):
+        node = LightningNode.objects.create(node_name="benchmark-{}".format(time.time()), rpcserver="benchmark:1", global_checkpoint=0)
+
+        author, _ = User.objects.get_or_create(pubkey=BENCHMARK_PUBKEY)
+        questions = []
+        answers = []
+        for i in range(10):
+            question = Post.objects.create(
+                author=author, type=Post.QUESTION, title="Benchmark seed question {}".format(i),
+                content="Seed question body", tag_val="benchmark")
+            questions.append(question)
+            answers.append(Post.objects.create(author=author, type=Post.ANSWER, parent=question, content="Seed answer body"))
+
+        now = int(time.time())
+        raw_invoices = []
+        for start in range(0, size, BATCH_SIZE):
+            add_indexes = range(start + 1, min(start + BATCH_SIZE, size) + 1)
+            memos = [gen_memo(i, questions, answers) for i in add_indexes]
+
+            # bulk_create skips the save methods, so created, modified and memo_digest are set here
+            ts = timezone.now()
+            invoice_requests = InvoiceRequest.objects.bulk_create(
+                [
+                    InvoiceRequest(lightning_node=node, memo=memo, memo_digest=memo_digest(memo), created=ts, modified=ts)
+                    for memo in memos
+                ]
+            )
+            if invoice_requests[0].id is None:
+                # Only PostgreSQL sets primary keys on bulk_create
+                invoice_requests = list(InvoiceRequest.objects.filter(lightning_node=node).order_by("-id")[:len(memos)])[::-1]
+
+            invoices = []
+            for add_index, memo, invoice_request in zip(add_indexes, memos, invoice_requests):
+                pay_req = "lnbenchmark{}".format(add_index)
+                invoices.append(
+                    Invoice(
+                        lightning_node=node, invoice_request=invoice_request, pay_req=pay_req, add_index=add_index,
+                        created=ts, modified=ts,
+                    )
+                )
+                raw_invoices.append({
+                    "memo": memo,
+                    "payment_request": pay_req,
+                    "add_index": str(add_index),
+                    "settle_index": str(add_index),
+                    "state": "SETTLED",
+                    "settled": True,
+                    "settle_date": str(now),
+                    "creation_date": str(now),
+                    "expiry": "3600",
+                })
+
+            Invoice.objects.bulk_create(invoices)
+
+        fake_lnd = FakeLnd(raw_invoices)
+        node.get_lnclient = lambda: fake_lnd
+        return node
+
+    def measure(self, size):
+        start_time = time.time()
+        node = self.seed(size)
+        seed_time = time.time() - start_time
+
+        runner = Runner()
+        pre_run_queries = QueryCounter()
+        run_queries = QueryCounter()
+        pre_run_time = 0
+        run_time = 0
+        passes = 0
+
+        while node.global_checkpoint < size:
+            last_checkpoint = node.global_checkpoint
+            passes += 1
+
+            with connection.execute_wrapper(pre_run_queries):
+                pre_run_time += runner.pre_run(node)
+
+            with connection.execute_wrapper(run_queries):
+                run_time += runner.run_one_node(node)
+
+            if node.global_checkpoint == last_checkpoint:
+                logger.error("Benchmark stalled at global checkpoint {}".format(last_checkpoint))
+                break
+
+        done = Invoice.objects.filter(lightning_node=node, checkpoint_value="done").count()
+        if done != size:
+            logger.warning("Only {} of {} benchmark invoices were done".format(done, size))
+
+        return {
+            "size": size,
+            "seed": seed_time,
+            "pre_run": pre_run_time,
+            "run": run_time,
+            "rate": size / (pre_run_time + run_time),
+            "passes": passes,
+            "pre_run_queries": pre_run_queries.count,
+            "run_queries": run_queries.count,
+            "queries_per_invoice": float(pre_run_queries.count + run_queries.count) / size,
+        }
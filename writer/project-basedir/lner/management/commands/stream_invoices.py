@@ -0,0 +1,22 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from common import lnrpc
+from lner.stream import run_streams
+
+
+class Command(BaseCommand):
+    help = 'Processes invoices of rpc_client=grpc nodes as they are settled, using SubscribeInvoices'
+
+    def handle(self, *args, **options):
+        if lnrpc.grpc is None:
+            raise CommandError("grpcio is not installed")
+
+        if not settings.STREAM_INVOICES:
+            raise CommandError("STREAM_INVOICES is off, run_many is processing all nodes")
+
+        self.stdout.write(self.style.SUCCESS("Streaming invoices"))
+        try:
+            run_streams()
+        except KeyboardInterrupt:
+            self.stdout.write("Stopped")
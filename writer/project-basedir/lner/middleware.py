@@ -0,0 +1,18 @@
+from django.conf import settings
+
+from common import metrics
+
+
+class MetricsSnapshotMiddleware(object):
+    """
+    Makes sure this web worker writes its metrics snapshot, see common.metrics.start_snapshot_thread
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if settings.METRICS_SNAPSHOT_SECONDS:
+            metrics.start_snapshot_thread(settings.METRICS_SNAPSHOT_DIR, "web", settings.METRICS_SNAPSHOT_SECONDS)
+
+        return self.get_response(request)
@@ -5,6 +5,15 @@ import django.db.models.deletion
 import lner.models
 
 
+def get_first_node():
+    """
+    lner.models.get_first_node selects and inserts columns that were added by later migrations,
+    so the database operation uses this default to keep migrating a fresh database working
+    """
+    from lner.models import LightningNode
+    return LightningNode.objects.order_by("id").values_list("id", flat=True).first()
+
+
 class Migration(migrations.Migration):
 
     dependencies = [
@@ -12,9 +21,20 @@ class Migration(migrations.Migration):
     ]
 
     operations = [
-        migrations.AddField(
-            model_name='invoice',
-            name='lightning_node',
-            field=models.ForeignKey(default=lner.models.get_first_node, on_delete=django.db.models.deletion.CASCADE, to='lner.LightningNode'),
+        migrations.SeparateDatabaseAndState(
+            database_operations=[
+                migrations.AddField(
+                    model_name='invoice',
+                    name='lightning_node',
+                    field=models.ForeignKey(default=get_first_node, on_delete=django.db.models.deletion.CASCADE, to='lner.LightningNode'),
+                ),
+            ],
+            state_operations=[
+                migrations.AddField(
+                    model_name='invoice',
+                    name='lightning_node',
+                    field=models.ForeignKey(default=lner.models.get_first_node, on_delete=django.db.models.deletion.CASCADE, to='lner.LightningNode'),
+                ),
+            ],
         ),
     ]
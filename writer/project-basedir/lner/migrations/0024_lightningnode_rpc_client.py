@@ -0,0 +1,18 @@
+# Generated by Django 2.2.28 on 2026-10-18 14:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lner', '0023_payawardresult'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='lightningnode',
+            name='rpc_client',
+            field=models.CharField(choices=[('lncli', 'lncli'), ('grpc', 'grpc')], default='lncli', max_length=16, verbose_name='How to talk to the ln daemon: fork lncli per call, or keep a gRPC channel open'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.2.28 on 2026-10-18 14:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lner', '0024_lightningnode_rpc_client'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='lightningnode',
+            name='settle_checkpoint',
+            field=models.IntegerField(default=-1, verbose_name='settle_index up to which all settled invoices are processed, -1 if none were seen yet'),
+        ),
+    ]
@@ -0,0 +1,42 @@
+# Generated by Django 2.2.28 on 2026-10-18 14:45
+
+import hashlib
+
+from django.db import migrations, models
+
+
+def backfill_memo_digest(apps, schema_editor):
+    """
+    Concurrent get_or_create calls could create the same memo twice on a node. The oldest request keeps
+    the real digest and is the one lookups find, later duplicates get a digest that includes their id.
+    """
+    InvoiceRequest = apps.get_model('lner', 'InvoiceRequest')
+
+    seen = set()
+    for invoice_request in InvoiceRequest.objects.order_by('id').iterator():
+        digest = hashlib.sha256(invoice_request.memo.encode("utf-8")).hexdigest()
+        if (invoice_request.lightning_node_id, digest) in seen:
+            digest = hashlib.sha256(
+                "{}#duplicate-{}".format(invoice_request.memo, invoice_request.id).encode("utf-8")
+            ).hexdigest()
+        else:
+            seen.add((invoice_request.lightning_node_id, digest))
+
+        InvoiceRequest.objects.filter(pk=invoice_request.pk).update(memo_digest=digest)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lner', '0025_lightningnode_settle_checkpoint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='invoicerequest',
+            name='memo_digest',
+            field=models.CharField(default='', editable=False, max_length=64, verbose_name='SHA256 hex digest of memo'),
+            preserve_default=False,
+        ),
+        migrations.RunPython(backfill_memo_digest, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,20 @@
+# Generated by Django 2.2.28 on 2026-10-18 14:45
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+    """
+    Separate from the backfill, PostgreSQL does not allow altering a table with pending updates in one transaction
+    """
+
+    dependencies = [
+        ('lner', '0026_invoicerequest_memo_digest'),
+    ]
+
+    operations = [
+        migrations.AlterUniqueTogether(
+            name='invoicerequest',
+            unique_together={('lightning_node', 'memo_digest')},
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 2.2.28 on 2026-10-18 15:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lner', '0027_invoicerequest_memo_digest_unique'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='lightningnode',
+            name='qos_latency',
+            field=models.FloatField(default=0, verbose_name='Moving average of lnd call latency in seconds, see lner.qos'),
+        ),
+        migrations.AddField(
+            model_name='lightningnode',
+            name='qos_error_rate',
+            field=models.FloatField(default=0, verbose_name='Moving average of failed lnd calls, 0 to 1'),
+        ),
+        migrations.AddField(
+            model_name='lightningnode',
+            name='qos_samples',
+            field=models.IntegerField(default=0, verbose_name='Number of lnd calls in the moving averages'),
+        ),
+        migrations.AddField(
+            model_name='lightningnode',
+            name='qos_disabled',
+            field=models.BooleanField(default=False, verbose_name='Was this node disabled by lner.qos? It is enabled again once its error rate drops'),
+        ),
+    ]
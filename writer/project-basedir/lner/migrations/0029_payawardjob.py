@@ -0,0 +1,32 @@
+# Generated by Django 2.2.28 on 2026-10-18 15:40
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bounty', '0005_auto_20200520_2306'),
+        ('lner', '0028_lightningnode_qos'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PayAwardJob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', models.DateTimeField(editable=False)),
+                ('modified', models.DateTimeField()),
+                ('invoice', models.CharField(max_length=2000, verbose_name='LN Invoice to pay the award to')),
+                ('sig', models.CharField(max_length=255, verbose_name='Signature of the invoice by the award recipient')),
+                ('status', models.CharField(choices=[('queued', 'queued'), ('running', 'running'), ('succeeded', 'succeeded'), ('failed', 'failed')], db_index=True, default='queued', max_length=16)),
+                ('failure_message', models.CharField(default='', max_length=255, verbose_name='The failure message to report back to the user')),
+                ('award', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='bounty.BountyAward')),
+                ('lightning_node', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='lner.LightningNode')),
+            ],
+        ),
+        migrations.DeleteModel(
+            name='PayAwardResult',
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 2.2.28 on 2026-10-18 16:20
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lner', '0029_payawardjob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IngestWorker',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('worker_id', models.CharField(max_length=255, unique=True)),
+                ('heartbeat_at', models.DateTimeField(db_index=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='NodeLease',
+            fields=[
+                ('lightning_node', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, serialize=False, to='lner.LightningNode')),
+                ('owner', models.CharField(default='', max_length=255, verbose_name='worker_id of the owner, empty if released')),
+                ('expires_at', models.DateTimeField(verbose_name='The lease is free after this time unless the owner renews it')),
+            ],
+        ),
+    ]
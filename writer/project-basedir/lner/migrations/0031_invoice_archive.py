@@ -0,0 +1,37 @@
+# Generated by Django 2.2.28 on 2026-10-18 14:57
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lner', '0030_nodelease_ingestworker'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedInvoice',
+            fields=[
+                ('id', models.IntegerField(primary_key=True, serialize=False, verbose_name='id of the Invoice')),
+                ('add_index', models.IntegerField(verbose_name='LN Invoice add_index')),
+                ('r_hash', models.CharField(max_length=255, verbose_name='LN Invoice r_hash')),
+                ('memo', models.CharField(default='', max_length=600, verbose_name='LN Invoice memo')),
+                ('checkpoint_value', models.CharField(max_length=255)),
+                ('performed_action_type', models.CharField(max_length=255)),
+                ('performed_action_id', models.IntegerField()),
+                ('created', models.DateTimeField()),
+                ('archived', models.DateTimeField()),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='invoice',
+            index=models.Index(fields=['lightning_node', 'created'], name='lner_invoic_lightni_64c5b3_idx'),
+        ),
+        migrations.AddField(
+            model_name='archivedinvoice',
+            name='lightning_node',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='lner.LightningNode'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.2.28 on 2026-10-18 15:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lner', '0031_invoice_archive'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='payawardjob',
+            name='started',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='When the worker started the payout'),
+        ),
+    ]
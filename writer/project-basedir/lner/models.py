@@ -1,9 +1,19 @@
+import hashlib
+
 from django.db import models
 from common import validators
+from common import signmessage
+from common.hedge import Hedger
 from django.conf import settings
 from django.utils import timezone
 
 
+# Node-agnostic calls go to the node itself and, if it is slow, to the best other enabled node
+HEDGE_NODES = 2
+verifymessage_hedger = Hedger("verifymessage")
+decodepayreq_hedger = Hedger("decodepayreq", accept=lambda output: output["success"] is True)
+
+
 class CustomModel(models.Model):
     created = models.DateTimeField(editable=False)
     modified = models.DateTimeField()
@@ -26,7 +36,18 @@ class LightningNode(CustomModel):
         verbose_name='add_index of the last global checkpoint',
         default=-1
     )
+    settle_checkpoint = models.IntegerField(
+        verbose_name='settle_index up to which all settled invoices are processed, -1 if none were seen yet',
+        default=-1
+    )
     qos_score = models.IntegerField(verbose_name='Higher score means higher quality of service', default=-1)
+    qos_latency = models.FloatField(verbose_name='Moving average of lnd call latency in seconds, see lner.qos', default=0)
+    qos_error_rate = models.FloatField(verbose_name='Moving average of failed lnd calls, 0 to 1', default=0)
+    qos_samples = models.IntegerField(verbose_name='Number of lnd calls in the moving averages', default=0)
+    qos_disabled = models.BooleanField(
+        verbose_name="Was this node disabled by lner.qos? It is enabled again once its error rate drops",
+        default=False
+    )
     enabled = models.BooleanField(
         verbose_name="Should this node show up in the Web UI and used in process_tasks?",
         default=True
@@ -37,6 +58,63 @@ class LightningNode(CustomModel):
     )
     connect_ip = models.CharField(verbose_name='Public IP:port of the target node', max_length=255, default="1.2.3.4:9735")
     connect_tor = models.CharField(verbose_name='Public onion:port of the target node', max_length=255, default="abczyx123.onion:9735")
+    rpc_client = models.CharField(
+        verbose_name='How to talk to the ln daemon: fork lncli per call, or keep a gRPC channel open',
+        max_length=16,
+        choices=[("lncli", "lncli"), ("grpc", "grpc")],
+        default="lncli"
+    )
+
+    def get_lnclient(self):
+        """
+        Module with addinvoice, listinvoices, verifymessage, decodepayreq and payinvoice for this node
+        """
+        if self.rpc_client == "grpc":
+            from common import lnrpc
+            return lnrpc
+        else:
+            from common import lnclient
+            return lnclient
+
+    def verifymessage(self, msg, sig, new_author=False):
+        """
+        Check an lnd signmessage signature, locally unless LOCAL_VERIFYMESSAGE is off or lnd is mocked
+
+        Pass new_author=True when the recovered key becomes the author of a post, lnd then also checks that
+        the key is a node in its channel graph, unless LOCAL_VERIFYMESSAGE_NEW_AUTHORS is on
+        """
+        local = settings.LOCAL_VERIFYMESSAGE and (not new_author or settings.LOCAL_VERIFYMESSAGE_NEW_AUTHORS)
+        if local and not settings.MOCK_LN_CLIENT:
+            return signmessage.verifymessage(msg, sig)
+
+        return verifymessage_hedger.call([
+            lambda node=node: node.get_lnclient().verifymessage(
+                msg=msg, sig=sig, rpcserver=node.rpcserver, mock=settings.MOCK_LN_CLIENT)
+            for node in self.hedge_nodes()
+        ])
+
+    def decodepayreq(self, payreq):
+        """
+        Output of lnclient.decodepayreq, {"success": ..., "stdouterr": ...}, from this node or a hedge node
+        """
+        return decodepayreq_hedger.call([
+            lambda node=node: node.get_lnclient().decodepayreq(
+                payreq=payreq, rpcserver=node.rpcserver, mock=settings.MOCK_LN_CLIENT)
+            for node in self.hedge_nodes()
+        ])
+
+    def hedge_nodes(self):
+        """
+        This node, then the enabled nodes with the best qos_score
+        """
+        others = LightningNode.objects.filter(enabled=True).exclude(pk=self.pk).order_by("-qos_score")
+        return [self] + list(others[:HEDGE_NODES - 1])
+
+    def is_streamed(self):
+        """
+        Invoices of streamed nodes are processed by "manage.py stream_invoices" instead of run_many
+        """
+        return settings.STREAM_INVOICES and self.rpc_client == "grpc"
 
 
 def get_first_node():
@@ -47,12 +125,44 @@ def get_first_node():
     return LightningNode.objects.get(id=1).id
 
 
+def memo_digest(memo):
+    """
+    Fixed size key for looking up an InvoiceRequest by memo
+    """
+    return hashlib.sha256(memo.encode("utf-8")).hexdigest()
+
+
+class NodeLease(models.Model):
+    """
+    Which run_many worker processes the invoices of a node, see lner.leases
+    """
+    lightning_node = models.OneToOneField(LightningNode, primary_key=True, on_delete=models.CASCADE)
+    owner = models.CharField(verbose_name='worker_id of the owner, empty if released', max_length=255, default="")
+    expires_at = models.DateTimeField(verbose_name='The lease is free after this time unless the owner renews it')
+
+
+class IngestWorker(models.Model):
+    """
+    A run_many worker, alive while heartbeat_at is recent, see lner.leases
+    """
+    worker_id = models.CharField(max_length=255, unique=True)
+    heartbeat_at = models.DateTimeField(db_index=True)
+
+
 class InvoiceRequest(CustomModel):
     lightning_node = models.ForeignKey(LightningNode, on_delete=models.CASCADE)
     memo = models.CharField(
         verbose_name='LN Invoice memo',
         max_length=settings.MAX_MEMO_SIZE
     )
+    memo_digest = models.CharField(verbose_name='SHA256 hex digest of memo', max_length=64, editable=False)
+
+    class Meta:
+        unique_together = [("lightning_node", "memo_digest")]
+
+    def save(self, *args, **kwargs):
+        self.memo_digest = memo_digest(self.memo)
+        return super(InvoiceRequest, self).save(*args, **kwargs)
 
 class Invoice(CustomModel):
     lightning_node = models.ForeignKey(LightningNode, on_delete=models.CASCADE, default=get_first_node)
@@ -72,6 +182,25 @@ class Invoice(CustomModel):
     )
     performed_action_id =  models.IntegerField(verbose_name='E.g. post.id', default=-1)
 
+    class Meta:
+        indexes = [models.Index(fields=["lightning_node", "created"])]
+
+
+class ArchivedInvoice(models.Model):
+    """
+    Invoice and the memo of its InvoiceRequest after retention, moved here by lner.archive
+    """
+    id = models.IntegerField(primary_key=True, verbose_name='id of the Invoice')
+    lightning_node = models.ForeignKey(LightningNode, on_delete=models.CASCADE)
+    add_index = models.IntegerField(verbose_name='LN Invoice add_index')
+    r_hash = models.CharField(verbose_name='LN Invoice r_hash', max_length=255)
+    memo = models.CharField(verbose_name='LN Invoice memo', max_length=settings.MAX_MEMO_SIZE, default="")
+    checkpoint_value = models.CharField(max_length=255)
+    performed_action_type = models.CharField(max_length=255)
+    performed_action_id = models.IntegerField()
+    created = models.DateTimeField()
+    archived = models.DateTimeField()
+
 
 class VerifyMessageResult(models.Model):
     memo = models.CharField(
@@ -85,13 +214,31 @@ class VerifyMessageResult(models.Model):
         managed = False
 
 
-class PayAwardResult(models.Model):
-    payment_successful = models.BooleanField(verbose_name="Is message valid against it's signature?")
-    failure_message =  models.CharField(
+class PayAwardJob(CustomModel):
+    """
+    Payout of a bounty award, run by lner.payouts.run_payaward_job on the "queue-payouts" queue
+    """
+    QUEUED = "queued"
+    RUNNING = "running"
+    SUCCEEDED = "succeeded"
+    FAILED = "failed"
+
+    lightning_node = models.ForeignKey(LightningNode, on_delete=models.CASCADE)
+    award = models.ForeignKey("bounty.BountyAward", on_delete=models.CASCADE)
+    invoice = models.CharField(verbose_name='LN Invoice to pay the award to', max_length=settings.MAX_PAYREQ_SIZE)
+    sig = models.CharField(verbose_name='Signature of the invoice by the award recipient', max_length=255)
+    status = models.CharField(
+        max_length=16,
+        choices=[(QUEUED, QUEUED), (RUNNING, RUNNING), (SUCCEEDED, SUCCEEDED), (FAILED, FAILED)],
+        default=QUEUED,
+        db_index=True
+    )
+    failure_message = models.CharField(
         verbose_name="The failure message to report back to the user",
         max_length=255,
         default=""
     )
+    started = models.DateTimeField(verbose_name="When the worker started the payout", null=True, blank=True)
 
-    class Meta:
-        managed = False
+    def is_finished(self):
+        return self.status in [PayAwardJob.SUCCEEDED, PayAwardJob.FAILED]
@@ -0,0 +1,142 @@
+"""
+Wake up requests that wait for an invoice checkpoint, see WaitPaymentViewSet
+
+Checkpoints are written by run_many and stream_invoices, which run in other processes than the web
+workers. On PostgreSQL checkpoint_changed sends a NOTIFY that is delivered when the transaction commits,
+and every web process runs one listener thread that wakes up its local waiters. Other databases (sqlite
+in dev) have no notifications, there waiters re-read the checkpoint every FALLBACK_POLL_SECONDS.
+"""
+import time
+import select
+import threading
+
+from django.db import connection
+from django.db import connections
+
+from common.log import logger
+
+
+CHANNEL = "lner_checkpoint"
+LISTEN_SELECT_SECONDS = 5
+LISTENER_RECONNECT_SECONDS = 5
+FALLBACK_POLL_SECONDS = 1
+RECHECK_SECONDS = 5  # on PostgreSQL too, for notifications sent while the listener was (re)connecting
+
+_waiters = {}  # Dict[int, Set[threading.Event]] where int is invoice id
+_waiters_lock = threading.Lock()
+_listener = None
+
+
+def is_postgresql():
+    return connection.vendor == "postgresql"
+
+
+def _wake(invoice_id):
+    with _waiters_lock:
+        events = list(_waiters.get(invoice_id, []))
+
+    for event in events:
+        event.set()
+
+
+def checkpoint_changed(invoice_ids):
+    """
+    Called after the checkpoint_value of invoices was updated
+    """
+    invoice_ids = list(invoice_ids)
+    for invoice_id in invoice_ids:
+        _wake(invoice_id)  # waiters of this process, e.g. in tests
+
+    if is_postgresql():
+        with connection.cursor() as cursor:
+            for invoice_id in invoice_ids:
+                cursor.execute("SELECT pg_notify(%s, %s)", [CHANNEL, str(invoice_id)])
+
+
+class Listener(threading.Thread):
+    """
+    LISTEN on its own connection and wake up the waiters of notified invoices
+    """
+
+    def __init__(self):
+        super(Listener, self).__init__(name="lner-checkpoint-listener")
+        self.daemon = True
+
+    def run(self):
+        while True:
+            try:
+                self.listen()
+            except Exception as e:
+                logger.error("Checkpoint listener failed, reconnecting in {} seconds".format(LISTENER_RECONNECT_SECONDS))
+                logger.exception(e)
+
+            time.sleep(LISTENER_RECONNECT_SECONDS)
+
+    def listen(self):
+        db = connections["default"]
+        raw_connection = db.get_new_connection(db.get_connection_params())
+        try:
+            raw_connection.autocommit = True
+            with raw_connection.cursor() as cursor:
+                cursor.execute("LISTEN {}".format(CHANNEL))
+
+            while True:
+                readable, _, _ = select.select([raw_connection], [], [], LISTEN_SELECT_SECONDS)
+                if not readable:
+                    continue
+
+                raw_connection.poll()
+                while raw_connection.notifies:
+                    notify = raw_connection.notifies.pop(0)
+                    _wake(int(notify.payload))
+        finally:
+            raw_connection.close()
+
+
+def _ensure_listener():
+    global _listener
+
+    with _waiters_lock:
+        if _listener is None or not _listener.is_alive():
+            _listener = Listener()
+            _listener.start()
+
+
+class CheckpointWaiter(object):
+    """
+    with CheckpointWaiter(invoice_id) as waiter:
+        # re-read the invoice, then
+        waiter.wait(timeout)
+
+    Subscribe before re-reading the invoice, so a checkpoint written in between is not missed.
+    """
+
+    def __init__(self, invoice_id):
+        self.invoice_id = invoice_id
+        self.event = threading.Event()
+
+    def __enter__(self):
+        if is_postgresql():
+            _ensure_listener()
+
+        with _waiters_lock:
+            _waiters.setdefault(self.invoice_id, set()).add(self.event)
+
+        return self
+
+    def __exit__(self, *args):
+        with _waiters_lock:
+            events = _waiters.get(self.invoice_id, set())
+            events.discard(self.event)
+            if len(events) == 0:
+                _waiters.pop(self.invoice_id, None)
+
+    def wait(self, timeout):
+        """
+        Returns True if the invoice was notified, otherwise the caller re-reads the invoice and waits again
+        """
+        timeout = min(timeout, RECHECK_SECONDS if is_postgresql() else FALLBACK_POLL_SECONDS)
+
+        notified = self.event.wait(timeout)
+        self.event.clear()
+        return notified
@@ -0,0 +1,214 @@
+"""
+Bounty award payouts, run outside of the web workers
+
+PayAwardViewSet only saves a PayAwardJob and schedules run_payaward_job, the reader then polls the job
+status. payinvoice can take minutes, so the jobs run on their own queue with a dedicated worker:
+
+    python manage.py process_tasks --queue queue-payouts
+
+Jobs are never retried by background_task, a failed payout is reported back and the user may submit again.
+A job that is still running after PAYOUT_JOB_TIMEOUT is failed, the payment may or may not have gone out.
+"""
+import json
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from background_task import background
+
+from common.log import logger
+
+from bounty.models import Bounty, BountyAward
+
+from lner.models import PayAwardJob
+
+
+QUEUE = "queue-payouts"
+
+
+STALE_MESSAGE = "Payout did not finish, please contact us before trying again"
+
+
+class PayoutError(Exception):
+    pass
+
+
+def fail_if_stale(job):
+    """
+    Fail a job that has been running for longer than PAYOUT_JOB_TIMEOUT, returns True if it did
+    """
+    cutoff = timezone.now() - timedelta(seconds=settings.PAYOUT_JOB_TIMEOUT)
+    if job.status != PayAwardJob.RUNNING or job.started is None or job.started >= cutoff:
+        return False
+
+    failed = PayAwardJob.objects.filter(id=job.id, status=PayAwardJob.RUNNING, started__lt=cutoff).update(
+        status=PayAwardJob.FAILED,
+        failure_message=STALE_MESSAGE,
+        modified=timezone.now()
+    )
+    if failed == 0:
+        return False
+
+    logger.error("Payout job {} has been running since {}, failed it".format(job.id, job.started))
+    job.refresh_from_db(fields=["status", "failure_message", "modified"])
+    return True
+
+
+def submit(node, award_id, invoice, sig):
+    """
+    Save a job and schedule it, or return the unfinished job of the award
+    """
+    with transaction.atomic():
+        award = BountyAward.objects.select_for_update().get(id=award_id)
+
+        job = PayAwardJob.objects.filter(
+            award=award,
+            status__in=[PayAwardJob.QUEUED, PayAwardJob.RUNNING]
+        ).first()
+        if job is not None:
+            if not fail_if_stale(job):
+                logger.info("Award {} already has an unfinished payout job {}".format(award.id, job.id))
+            return job
+
+        job = PayAwardJob.objects.create(lightning_node=node, award=award, invoice=invoice, sig=sig)
+
+    run_payaward_job(job.id)
+    logger.info("Scheduled payout job {} for award {}".format(job.id, award_id))
+
+    return job
+
+
+@background(queue=QUEUE)
+def run_payaward_job(job_id):
+    claimed = PayAwardJob.objects.filter(id=job_id, status=PayAwardJob.QUEUED).update(
+        status=PayAwardJob.RUNNING,
+        started=timezone.now()
+    )
+    if claimed == 0:
+        logger.error("Payout job {} is not queued, skipping".format(job_id))
+        return
+
+    job = PayAwardJob.objects.select_related("lightning_node", "award").get(id=job_id)
+    try:
+        pay_award(job)
+
+    except PayoutError as e:
+        logger.error("Payout job {} failed: {}".format(job_id, e))
+        job.status = PayAwardJob.FAILED
+        job.failure_message = str(e)[:255]
+
+    except Exception as e:
+        logger.exception(e)
+        job.status = PayAwardJob.FAILED
+        job.failure_message = "Unexpected error, please contact us before trying again"
+
+    else:
+        job.status = PayAwardJob.SUCCEEDED
+
+    job.save()
+
+
+def pay_award(job):
+    node = job.lightning_node
+    invoice = job.invoice
+
+    if not node.enabled:
+        raise PayoutError("Node is not enabled, try a different node")
+
+    sig_verify_json = node.verifymessage(msg=invoice, sig=job.sig)
+    logger.info("Attempting to pay award for: {}".format(sig_verify_json))
+
+    valid = sig_verify_json["valid"]
+    sig_pubkey = sig_verify_json["pubkey"]
+
+    if not valid:
+        raise PayoutError("Signature is invalid")
+
+    award = job.award
+
+    # Check award recipient
+    award_pubkey = award.post.author.pubkey
+    if award_pubkey != sig_pubkey:
+        raise PayoutError("Incorrect signature, this award will be payed out only to {}".format(award_pubkey))
+
+    # Calculate award amount
+    # TODO: put into a shard function get_bounty_sats
+    bounty_sats = 0
+
+    bounties_to_pay = []
+    for b in Bounty.objects.filter(post_id=award.post.parent.id, is_active=True, is_payed=False):
+        bounties_to_pay.append(b)
+        bounty_sats += b.amt
+
+    logger.info("Need to pay award in the amount of: {} sat".format(bounty_sats))
+
+    # Decode invoice and lookup amount
+    decodepayreq_out = node.decodepayreq(payreq=invoice)
+    if decodepayreq_out["success"] is not True:
+        if decodepayreq_out["failure_type"] == "timeout":
+            raise PayoutError("LND decodepayreq timed out")
+        else:
+            # TODO: from stdouterr remove anything that looks like an IP address
+            # E.g. [lncli] rpc error: code = Unknown desc = caveat "ipaddr 172.1.1.1" not satisfied: macaroon locked to different IP address
+            raise PayoutError("LND decodepayreq failed. LND error message was: {}".format(decodepayreq_out["stdouterr"]))
+
+    payreq_decoded = json.loads(decodepayreq_out["stdouterr"])
+
+    num_satoshis = payreq_decoded["num_satoshis"]
+    num_msat = payreq_decoded["num_msat"]
+    logger.info("User requested: num_satoshis={} and num_msat={} ".format(num_satoshis, num_msat))
+
+    if int(bounty_sats) == 0:
+        raise PayoutError("This bounty has already been payed out")
+
+    # Check invoice amount
+    if not settings.MOCK_LN_CLIENT:
+        if int(bounty_sats) != int(num_satoshis):
+            raise PayoutError(
+                (
+                    "Invoice num_satoshis amount is incorrect, "
+                    "we expect to send you {} sats, yet the invoice says {}"
+                ).format(bounty_sats, num_satoshis)
+            )
+
+        if int(bounty_sats) != int(int(num_msat) / 1000):
+            raise PayoutError(
+                (
+                    "Invoice num_satoshis amount is incorrect, "
+                    "we expect to send you {} sats, yet your invoice says {} msats which is {} sats"
+                ).format(
+                    bounty_sats,
+                    num_msat,
+                    int(int(num_msat) / 1000)
+                )
+            )
+
+    logger.info("Entered critical section")
+
+    # ! TODO (2020-05-19): Check for recent payments on all nodes, in case we crash in the middle of critical section
+
+    logger.info("about to pay")
+
+    pay_result = node.get_lnclient().payinvoice(payreq=invoice, rpcserver=node.rpcserver, mock=settings.MOCK_LN_CLIENT)
+    logger.info("pay_result: {}".format(pay_result))
+
+    if pay_result["success"] is not True:
+        if pay_result["failure_type"] == "timeout":
+            raise PayoutError("LND payinvoice timed out")
+        else:
+            # TODO: from stdouterr remove anything that looks like an IP address
+            # E.g. [lncli] rpc error: code = Unknown desc = caveat "ipaddr 172.1.1.1" not satisfied: macaroon locked to different IP address
+            raise PayoutError("LND payinvoice failed. LND error message was: {}".format(pay_result["stdouterr"]))
+
+    logger.info("payed, about to update db")
+
+    for b in bounties_to_pay:
+        b.is_payed = True
+        b.is_active = False
+        b.save()
+
+    logger.info("updated db")
+
+    logger.info("Exited critical section")
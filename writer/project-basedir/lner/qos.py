@@ -0,0 +1,167 @@
+"""
+Quality of service of lightning nodes, measured from real lnd calls and periodic probes
+
+Calls wrapped in measure() are buffered in this process and written by flush() as exponentially weighted
+moving averages of latency and error rate on the LightningNode row. The probe task (see lner.tasks) adds
+one cheap listinvoices call per node, turns the averages into qos_score, and disables nodes whose error
+rate is too high, enabling them again once it drops. Nodes disabled by hand are left alone.
+"""
+import time
+import threading
+
+from collections import defaultdict
+from concurrent import futures
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db.models import Case
+from django.db.models import F
+from django.db.models import FloatField
+from django.db.models import Q
+from django.db.models import Value
+from django.db.models import When
+
+from common.log import logger
+from common import metrics
+
+from lner.models import LightningNode
+
+
+EWMA_ALPHA = 0.2  # weight of the newest sample
+
+# Scores and enabled are only changed after this many samples
+MIN_SAMPLES = 5
+
+# qos_score of a node that never fails and answers instantly, half of it at one second of latency
+QOS_SCORE_SCALE = 1000
+
+DISABLE_ERROR_RATE = 0.5
+ENABLE_ERROR_RATE = 0.1
+
+PROBE_INTERVAL_SECONDS = 30
+MAX_PARALLEL_PROBES = 8
+
+LATENCY = metrics.gauge("lner_qos_latency_seconds", "Moving average of lnd call latency", ["node"])
+ERROR_RATE = metrics.gauge("lner_qos_error_rate", "Moving average of failed lnd calls", ["node"])
+SCORE = metrics.gauge("lner_qos_score", "qos_score of the node", ["node"])
+
+_samples = defaultdict(list)  # Dict[int, List[Tuple[float, bool]]] where int is node id
+_samples_lock = threading.Lock()
+
+
+def observe(node, seconds, success):
+    with _samples_lock:
+        _samples[node.id].append((seconds, success))
+
+
+@contextmanager
+def measure(node):
+    """
+    with qos.measure(node):
+        node.get_lnclient().addinvoice(...)
+
+    An exception counts as a failed call and is re-raised
+    """
+    start_time = time.time()
+    try:
+        yield
+    except Exception:
+        observe(node, time.time() - start_time, success=False)
+        raise
+
+    observe(node, time.time() - start_time, success=True)
+
+
+def ewma(start, values):
+    for value in values:
+        start = start * (1 - EWMA_ALPHA) + value * EWMA_ALPHA
+
+    return start
+
+
+def _ewma_update(field, values):
+    """
+    Expression that folds values into the moving average in field, or starts it if there were no samples yet
+    """
+    decay = (1 - EWMA_ALPHA) ** len(values)
+    return Case(
+        When(qos_samples=0, then=Value(ewma(values[0], values[1:]))),
+        default=F(field) * decay + ewma(0, values),
+        output_field=FloatField(),
+    )
+
+
+def flush():
+    """
+    Write the buffered samples, call it outside of transactions that lock the node rows
+    """
+    with _samples_lock:
+        samples = dict(_samples)
+        _samples.clear()
+
+    for node_id, node_samples in samples.items():
+        LightningNode.objects.filter(pk=node_id).update(
+            qos_latency=_ewma_update("qos_latency", [seconds for seconds, _ in node_samples]),
+            qos_error_rate=_ewma_update("qos_error_rate", [0 if success else 1 for _, success in node_samples]),
+            qos_samples=F("qos_samples") + len(node_samples),
+        )
+
+
+def score(node):
+    return int(round(QOS_SCORE_SCALE * (1 - node.qos_error_rate) / (1 + node.qos_latency)))
+
+
+def probe_node(node):
+    try:
+        with measure(node):
+            node.get_lnclient().listinvoices(
+                index_offset=max(node.global_checkpoint, 0),
+                rpcserver=node.rpcserver,
+                max_invoices=1,
+                pending_only=True,
+                mock=settings.MOCK_LN_CLIENT
+            )
+    except Exception as e:
+        logger.error("QoS probe of node {} failed".format(node.node_name))
+        logger.exception(e)
+
+
+def probe():
+    """
+    Probe enabled nodes and the ones disabled by qos, then update their scores
+    """
+    nodes = list(LightningNode.objects.filter(Q(enabled=True) | Q(qos_disabled=True)))
+
+    with futures.ThreadPoolExecutor(max_workers=MAX_PARALLEL_PROBES) as executor:
+        list(executor.map(probe_node, nodes))
+
+    flush()
+    update_scores()
+
+
+def update_scores():
+    enabled_count = LightningNode.objects.filter(enabled=True).count()
+
+    for node in LightningNode.objects.filter(qos_samples__gte=MIN_SAMPLES).filter(Q(enabled=True) | Q(qos_disabled=True)):
+        updates = {"qos_score": score(node)}
+
+        if node.enabled and node.qos_error_rate >= DISABLE_ERROR_RATE:
+            if enabled_count > 1:
+                logger.error("Disabling node {}, error rate is {:.2f}".format(node.node_name, node.qos_error_rate))
+                updates.update(enabled=False, qos_disabled=True)
+                enabled_count -= 1
+            else:
+                logger.error("Node {} has error rate {:.2f}, but it is the last enabled node".format(
+                    node.node_name, node.qos_error_rate))
+
+        elif node.qos_disabled and node.qos_error_rate <= ENABLE_ERROR_RATE:
+            logger.info("Enabling node {} again, error rate is {:.2f}".format(node.node_name, node.qos_error_rate))
+            updates.update(enabled=True, qos_disabled=False)
+            enabled_count += 1
+
+        # enabled only changes if nobody changed it by hand in the meantime
+        LightningNode.objects.filter(pk=node.pk, enabled=node.enabled, qos_disabled=node.qos_disabled).update(**updates)
+
+        LATENCY.set(node.qos_latency, node=node.node_name)
+        ERROR_RATE.set(node.qos_error_rate, node=node.node_name)
+        SCORE.set(updates["qos_score"], node=node.node_name)
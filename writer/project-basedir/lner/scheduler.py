@@ -0,0 +1,127 @@
+
+from common.log import logger
+from common import metrics
+
+from lner.models import Invoice
+
+
+# Nodes with invoices that somebody is likely paying right now are polled at this interval
+HOT_POLL_INTERVAL = 0.5
+
+# Other nodes back off exponentially up to these intervals
+BACKOFF_FACTOR = 2
+PENDING_MAX_POLL_INTERVAL = 5  # only stale open invoices left, e.g. abandoned by the user
+IDLE_MAX_POLL_INTERVAL = 30  # nothing open
+
+# Open invoices modified within this window keep a node hot
+RECENT_INVOICE_SECONDS = 300
+
+# Settle rate is an exponentially weighted average with this half-life,
+# a node that settles more than HOT_SETTLE_RATE invoices per second stays hot without open invoices
+SETTLE_RATE_HALF_LIFE = 120
+HOT_SETTLE_RATE = 1.0 / 60
+
+POLL_INTERVAL = metrics.gauge("lner_poll_interval_seconds", "Current poll interval of the node", ["node"])
+SETTLE_RATE = metrics.gauge("lner_settle_rate", "Exponentially weighted settled invoices per second", ["node"])
+
+
+class NodeSchedule(object):
+    __slots__ = ["interval", "next_poll", "last_poll", "settle_rate", "settled_total"]
+
+    def __init__(self, now):
+        self.interval = HOT_POLL_INTERVAL
+        self.next_poll = now  # new nodes are polled right away
+        self.last_poll = None
+        self.settle_rate = 0.0
+        self.settled_total = 0
+
+    def __repr__(self):
+        return "NodeSchedule(interval={:.2f}, settle_rate={:.4f})".format(self.interval, self.settle_rate)
+
+
+class PollScheduler(object):
+    """
+    Decide when each node is polled next
+
+    After every poll the node reports how many open invoices it has (all of them, and the recent ones)
+    and its running total of settled invoices. Nodes with recent open invoices or a settle rate above
+    HOT_SETTLE_RATE are polled every HOT_POLL_INTERVAL, the others back off exponentially. New invoices
+    created by the web process wake their node up again, see wake_new_invoices.
+    """
+
+    def __init__(self):
+        self.schedules = {}  # Dict[int, NodeSchedule] where int is node id
+        self.last_invoice_id = None
+
+    def get_schedule(self, node_id, now):
+        schedule = self.schedules.get(node_id)
+        if schedule is None:
+            schedule = NodeSchedule(now)
+            self.schedules[node_id] = schedule
+
+        return schedule
+
+    def due(self, nodes, now):
+        return [node for node in nodes if self.get_schedule(node.id, now).next_poll <= now]
+
+    def next_poll(self, nodes, now):
+        """
+        Time of the earliest next poll among nodes
+        """
+        return min([self.get_schedule(node.id, now).next_poll for node in nodes] or [now + IDLE_MAX_POLL_INTERVAL])
+
+    def wake(self, node_id, now):
+        schedule = self.get_schedule(node_id, now)
+        schedule.interval = HOT_POLL_INTERVAL
+        schedule.next_poll = min(schedule.next_poll, now)
+
+    def wake_new_invoices(self, now):
+        """
+        Wake up nodes that got new invoices since the last call, one query on the Invoice primary key
+        """
+        new_invoices = Invoice.objects.order_by("id")
+        if self.last_invoice_id is None:
+            last = new_invoices.values_list("id", flat=True).last()
+            self.last_invoice_id = last or 0
+            return
+
+        for invoice_id, node_id in new_invoices.filter(id__gt=self.last_invoice_id).values_list("id", "lightning_node_id"):
+            self.wake(node_id, now)
+            self.last_invoice_id = invoice_id
+
+    def record(self, node, pending, recent_pending, settled_total, now):
+        """
+        Schedule the next poll of node after a successful poll, returns the new interval
+        """
+        schedule = self.get_schedule(node.id, now)
+
+        settled = max(settled_total - schedule.settled_total, 0)
+        schedule.settled_total = settled_total
+        if schedule.last_poll is not None and now > schedule.last_poll:
+            elapsed = now - schedule.last_poll
+            weight = 0.5 ** (elapsed / SETTLE_RATE_HALF_LIFE)
+            schedule.settle_rate = schedule.settle_rate * weight + (settled / elapsed) * (1 - weight)
+
+        if recent_pending > 0 or settled > 0 or schedule.settle_rate >= HOT_SETTLE_RATE:
+            schedule.interval = HOT_POLL_INTERVAL
+        else:
+            max_interval = PENDING_MAX_POLL_INTERVAL if pending > 0 else IDLE_MAX_POLL_INTERVAL
+            schedule.interval = min(schedule.interval * BACKOFF_FACTOR, max_interval)
+
+        schedule.last_poll = now
+        schedule.next_poll = now + schedule.interval
+
+        POLL_INTERVAL.set(schedule.interval, node=node.node_name)
+        SETTLE_RATE.set(schedule.settle_rate, node=node.node_name)
+        logger.info("Node {} has {} open invoices ({} recent), next poll in {:.2f} seconds".format(
+            node.node_name, pending, recent_pending, schedule.interval))
+
+        return schedule.interval
+
+    def record_failure(self, node, now):
+        schedule = self.get_schedule(node.id, now)
+        schedule.interval = min(schedule.interval * BACKOFF_FACTOR, IDLE_MAX_POLL_INTERVAL)
+        schedule.next_poll = now + schedule.interval
+        POLL_INTERVAL.set(schedule.interval, node=node.node_name)
+
+        return schedule.interval
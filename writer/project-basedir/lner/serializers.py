@@ -9,7 +9,7 @@ from lner.models import LightningNode
 from lner.models import Invoice
 from lner.models import InvoiceRequest
 from lner.models import VerifyMessageResult
-from lner.models import PayAwardResult
+from lner.models import PayAwardJob
 
 from common import validators
 
@@ -57,13 +57,9 @@ class VerifyMessageResponseSerializer(HyperlinkedModelSerializer):
         fields = ['memo', 'valid', 'identity_pubkey']
 
 
-class PayAwardResponseSerializer(HyperlinkedModelSerializer):
-    payment_successful = BooleanField()
-    failure_message =  CharField(
-        max_length=255,
-        default=""
-    )
+class PayAwardJobSerializer(HyperlinkedModelSerializer):
+    award_id = IntegerField(read_only=True)
 
     class Meta:
-        model = PayAwardResult
-        fields = ['payment_successful', 'failure_message']
+        model = PayAwardJob
+        fields = ['id', 'award_id', 'status', 'failure_message']
@@ -0,0 +1,144 @@
+import time
+import threading
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import Q
+
+from common.log import logger
+from common import lnrpc
+from common import metrics
+
+from lner.models import LightningNode
+from lner.tasks import Runner
+from lner import leases
+from lner import qos
+
+
+# Only these states can produce a checkpoint, OPEN updates are additions that are not paid yet
+ACTIONABLE_STATES = ["SETTLED", "CANCELED"]
+
+RECONNECT_DELAY = 5
+
+
+class NodeStreamer(threading.Thread):
+    """
+    Keep one SubscribeInvoices stream open to a node and feed settled invoices into the Runner
+
+    The stream is opened with a deadline of STREAM_RECONCILE_SECONDS. When it runs out the streamer
+    does a regular listinvoices pass (expiry, global checkpoint) and resubscribes from the new global
+    and settle checkpoints, lnd replays everything after them so nothing is lost between streams.
+
+    The streamer holds the NodeLease of its node, so a second stream_invoices process leaves the node alone.
+    """
+
+    def __init__(self, node_id):
+        super(NodeStreamer, self).__init__(name="stream-node-{}".format(node_id))
+        self.daemon = True
+        self.node_id = node_id
+        self.stop_event = threading.Event()
+        self.stream = None
+
+        # renewed before every stream, which lasts up to STREAM_RECONCILE_SECONDS
+        self.leases = leases.LeaseManager(lease_seconds=settings.STREAM_RECONCILE_SECONDS + leases.LEASE_SECONDS)
+
+    def stop(self):
+        self.stop_event.set()
+        if self.stream is not None:
+            self.stream.cancel()
+
+    def run(self):
+        try:
+            while not self.stop_event.is_set():
+                node = LightningNode.objects.get(id=self.node_id)
+                if not (node.enabled or node.qos_disabled) or not node.is_streamed():
+                    logger.info("Node {} is no longer streamed, stopping".format(node.node_name))
+                    return
+
+                if not self.leases.hold(node.id):
+                    logger.info("Node {} is streamed by another worker, waiting".format(node.node_name))
+                    self.stop_event.wait(RECONNECT_DELAY)
+                    continue
+
+                try:
+                    self.run_once(node)
+                except Exception as e:
+                    if self.stop_event.is_set():
+                        return
+
+                    logger.exception(e)
+                    self.stop_event.wait(RECONNECT_DELAY)
+                finally:
+                    qos.flush()
+        finally:
+            self.leases.release(self.node_id)
+            connection.close()
+
+    def run_once(self, node):
+        runner = Runner()
+
+        if node.global_checkpoint == -1:
+            leases.set_global_checkpoint(node, 0)
+
+        runner.pre_run(node)
+        runner.run_one_node(node)
+
+        self.stream = lnrpc.subscribeinvoices(
+            node.rpcserver,
+            add_index=node.global_checkpoint,
+            settle_index=max(node.settle_checkpoint, 0),
+            timeout=settings.STREAM_RECONCILE_SECONDS
+        )
+        try:
+            for raw_invoice in self.stream:
+                self.on_invoice(runner, node, raw_invoice)
+        except lnrpc.grpc.RpcError as e:
+            if lnrpc._code_name(e) not in ["CANCELLED", "DEADLINE_EXCEEDED"]:
+                raise
+        finally:
+            self.stream.cancel()
+
+    def on_invoice(self, runner, node, raw_invoice):
+        if raw_invoice["state"] not in ACTIONABLE_STATES:
+            return
+
+        add_index = int(raw_invoice["add_index"])
+        if add_index not in runner.all_invoices_from_db.get(node, {}):
+            runner.pre_run(node)  # invoice was added after the last load
+
+        start_time = time.time()
+        runner.process_invoices(node, [raw_invoice], advance_global_checkpoint=False)
+        logger.info("Streamed invoice add_index={} of node {} processed in {:.3f} seconds".format(
+            add_index, node.node_name, time.time() - start_time))
+
+
+def run_streams():
+    """
+    Start a NodeStreamer for every enabled or qos disabled streamed node and pick up new ones as they show up
+    """
+    streamers = {}  # Dict[int, NodeStreamer] where int is node id
+
+    try:
+        while True:
+            # including nodes disabled by qos, the invoices they already issued can still be paid
+            for node in LightningNode.objects.filter(Q(enabled=True) | Q(qos_disabled=True), rpc_client="grpc"):
+                streamer = streamers.get(node.id)
+                if streamer is None or not streamer.is_alive():
+                    logger.info("Starting invoice stream for node {}".format(node.node_name))
+                    streamer = NodeStreamer(node.id)
+                    streamer.start()
+                    streamers[node.id] = streamer
+
+            try:
+                metrics.write_snapshot(settings.METRICS_SNAPSHOT_DIR, "stream_invoices")
+            except Exception as e:
+                logger.error("Could not write metrics snapshot")
+                logger.exception(e)
+
+            time.sleep(settings.STREAM_RECONCILE_SECONDS)
+    finally:
+        for streamer in streamers.values():
+            streamer.stop()
+
+        for streamer in streamers.values():
+            streamer.join(RECONNECT_DELAY)
@@ -3,24 +3,30 @@ import sys
 import time
 import json
 
+from collections import Counter
+from collections import defaultdict
+from concurrent import futures
 from datetime import datetime
 from datetime import timedelta
 
 from django.utils import timezone
 from django.conf import settings
+from django.db import connection
+from django.db import transaction
 from django.core.exceptions import ValidationError
 from django.core.exceptions import ObjectDoesNotExist
 
 from django.db.models import F
+from django.db.models import Q
 
 from rest_framework import serializers
 from background_task import background
 
-from common import lnclient
 from common.log import logger
 from common import validators
 from common import json_util
 from common import general_util
+from common import metrics
 
 from posts.models import Post
 from posts.models import Vote
@@ -33,12 +39,35 @@ from bounty.models import Bounty, BountyAward
 
 from lner.models import LightningNode
 from lner.models import Invoice
-from lner.models import InvoiceRequest
+from lner import notify
+from lner import qos
+from lner import leases
+from lner import archive
+from lner import payouts  # registers run_payaward_job for process_tasks
+from lner.scheduler import PollScheduler
+from lner.scheduler import HOT_POLL_INTERVAL
+from lner.scheduler import RECENT_INVOICE_SECONDS
 
 logger.info("Python version: {}".format(sys.version.replace("\n", " ")))
 
 
-BETWEEN_NODES_DELAY = 1
+RUN_MANY_SECONDS = 10
+PENDING_SCAN_PAGE_SIZE = 1000
+MODIFIED_OVERLAP = timedelta(seconds=60)  # re-read window for rows that commit late or come from a lagging clock
+MAX_PARALLEL_NODES = 8
+
+LISTINVOICES_SECONDS = metrics.histogram(
+    "lner_listinvoices_seconds", "Latency of the listinvoices call of a pass", ["node"])
+INVOICES_FETCHED = metrics.histogram(
+    "lner_invoices_fetched", "Invoices listed from the node in one pass", ["node"], buckets=metrics.COUNT_BUCKETS)
+CHECKPOINTS = metrics.counter(
+    "lner_checkpoints_total", "Invoices checkpointed, by checkpoint value", ["node", "checkpoint_value"])
+GLOBAL_CHECKPOINT = metrics.gauge(
+    "lner_global_checkpoint", "Global checkpoint (add_index) of the node", ["node"])
+GLOBAL_CHECKPOINT_LAG = metrics.gauge(
+    "lner_global_checkpoint_lag", "Distance from the global checkpoint to the latest add_index after a pass", ["node"])
+PENDING_INVOICES = metrics.gauge(
+    "lner_pending_invoices", "Open invoices below the global checkpoint", ["node"])
 
 
 def human_time(ts):
@@ -136,6 +165,25 @@ def award_bounty(question_post):
         update_deadline(earliest_bounty, new_deadline)
 
 
+class InvoiceRecord(object):
+    """
+    The parts of an Invoice and its InvoiceRequest that Runner needs, kept in memory between passes
+    """
+    __slots__ = ["id", "add_index", "pay_req", "memo", "checkpoint_value", "created", "modified"]
+
+    def __init__(self, invoice_obj):
+        self.id = invoice_obj.id
+        self.add_index = invoice_obj.add_index
+        self.pay_req = invoice_obj.pay_req
+        self.memo = invoice_obj.invoice_request.memo if invoice_obj.invoice_request else None
+        self.checkpoint_value = invoice_obj.checkpoint_value
+        self.created = invoice_obj.created
+        self.modified = invoice_obj.modified
+
+    def __repr__(self):
+        return "InvoiceRecord(id={}, add_index={}, checkpoint_value={})".format(self.id, self.add_index, self.checkpoint_value)
+
+
 class CheckpointHelper(object):
     def __init__(self, node, invoice, creation_date):
         self.node = node
@@ -160,50 +208,92 @@ class CheckpointHelper(object):
         if self.invoice.checkpoint_value == checkpoint_value:
             logger.info("Invoice already has this checkpoint {}".format(self))
         else:
+            updates = {"checkpoint_value": checkpoint_value, "modified": timezone.now()}
             if action_type and action_id:
-                self.invoice.performed_action_type = action_type
-                self.invoice.performed_action_id = action_id
+                updates["performed_action_type"] = action_type
+                updates["performed_action_id"] = action_id
 
+            Invoice.objects.filter(pk=self.invoice.id).update(**updates)
             self.invoice.checkpoint_value = checkpoint_value
-            self.invoice.save()
+            self.invoice.modified = updates["modified"]
+            CHECKPOINTS.inc(node=self.node.node_name, checkpoint_value=checkpoint_value)
+            notify.checkpoint_changed([self.invoice.id])
             logger.info("Updated checkpoint to {}".format(self))
 
+    def claim(self):
+        """
+        Lock the invoice row until the transaction ends, False if another worker checkpointed it meanwhile
+        """
+        claimed = Invoice.objects.filter(
+            pk=self.invoice.id,
+            checkpoint_value="no_checkpoint"
+        ).update(modified=timezone.now())
+
+        if claimed == 0:
+            self.invoice.checkpoint_value = Invoice.objects.filter(
+                pk=self.invoice.id).values_list("checkpoint_value", flat=True).first()
+
+        return claimed == 1
+
     def is_checkpointed(self):
         return self.invoice.checkpoint_value != "no_checkpoint"
 
 
 class Runner(object):
     def __init__(self):
-        self.all_invoices_from_db = {}  # Dict[LightningNode, Dict[int, Invoice]]  # where int is add_index
+        # Index of invoices above the global checkpoint and of pending invoices below it, refreshed incrementally by pre_run
+        self.all_invoices_from_db = {}  # Dict[LightningNode, Dict[int, InvoiceRecord]]  # where int is add_index
+        self.last_modified_from_db = {}  # Dict[LightningNode, datetime]
 
         self.invoice_count_from_db = {}  # Dict[LightningNode, int]]
         self.invoice_count_from_nodes = {}  # Dict[LightningNode, int]]
+        self.settled_count_from_nodes = {}  # Dict[LightningNode, int]]  # running total, used by the poll scheduler
+        self.settled_above_checkpoint = {}  # Dict[LightningNode, Set[int]]  # processed settle_index values past a gap
 
     def pre_run(self, node):
         start_time = time.time()
-        self.all_invoices_from_db[node] = {}
-
-        # Delete invoices that are passed retention
-        for invoice_obj in Invoice.objects.filter(lightning_node=node, add_index__lte=node.global_checkpoint):
-            if invoice_obj.created < timezone.now() - settings.INVOICE_RETENTION:
-                logger.info("Deleting invoice {} because it is older then retention {}".format(invoice_obj, settings.INVOICE_RETENTION))
-                invoice_request = InvoiceRequest.objects.get(id=invoice_obj.invoice_request.id)
-                if invoice_request:
-                    invoice_request.delete()  # cascading delete also deletes the invoice
-                else:
-                    logger.info("There was no invoice request, deleting just the invoice")
-                    invoice_obj.delete()
-
-        # Get all invoices:
-        # - not checkpointed ones needed for re-checking
+        invoice_index = self.all_invoices_from_db.setdefault(node, {})
+
+        # Forget checkpointed invoices that the global checkpoint moved past, and the ones that passed
+        # retention, the archive_invoices task moves those out of the DB
+        retention_cutoff = timezone.now() - settings.INVOICE_RETENTION
+        for add_index, record in list(invoice_index.items()):
+            if add_index <= node.global_checkpoint and (
+                record.checkpoint_value != "no_checkpoint" or record.created < retention_cutoff
+            ):
+                del invoice_index[add_index]
+
+        # Index all invoices:
+        # - not checkpointed ones needed for re-checking, including pending ones below the global checkpoint
         # - checkpointed ones needed for de-duplication
-        invoices_from_db = Invoice.objects.filter(lightning_node=node, add_index__gt=node.global_checkpoint)
-        self.invoice_count_from_db[node] = len(invoices_from_db)
+        # Only rows that changed since the last pre_run are fetched, minus an overlap window because
+        # rows that commit late or come from a host with a lagging clock could otherwise be missed,
+        # re-reading them is harmless. Anything older is looked up directly on an index miss.
+        invoices_from_db = Invoice.objects.filter(lightning_node=node).select_related("invoice_request")
+
+        last_modified = self.last_modified_from_db.get(node)
+        if last_modified:
+            # includes invoices that got checkpointed below the global checkpoint, so they are dropped below
+            invoices_from_db = invoices_from_db.filter(modified__gte=last_modified - MODIFIED_OVERLAP)
+        else:
+            invoices_from_db = invoices_from_db.filter(
+                Q(add_index__gt=node.global_checkpoint) | Q(checkpoint_value="no_checkpoint")
+            )
 
         # TODO: Handle duplicates (e.g. payments to different nodes), first come first serve
+        num_new = 0
         for invoice_obj in invoices_from_db:
-            invoice_request = InvoiceRequest.objects.get(id=invoice_obj.invoice_request.id)
-            self.all_invoices_from_db[node][invoice_obj.add_index] = invoice_obj
+            if invoice_obj.add_index <= node.global_checkpoint and invoice_obj.checkpoint_value != "no_checkpoint":
+                invoice_index.pop(invoice_obj.add_index, None)  # got checkpointed since the last pre_run
+            else:
+                invoice_index[invoice_obj.add_index] = InvoiceRecord(invoice_obj)
+            num_new += 1
+            if last_modified is None or invoice_obj.modified > last_modified:
+                last_modified = invoice_obj.modified
+
+        self.last_modified_from_db[node] = last_modified
+        self.invoice_count_from_db[node] = len(invoice_index)
+        logger.info("Pre-run indexed {} new or changed invoices, {} in total".format(num_new, len(invoice_index)))
 
         processing_wall_time = time.time() - start_time
         logger.info(
@@ -216,23 +306,44 @@ class Runner(object):
 
         return processing_wall_time
 
+    def lookup_invoice(self, node, add_index):
+        """
+        Index miss: the row may have been saved after pre_run read past its modified time
+        """
+        invoice_obj = Invoice.objects.filter(
+            lightning_node=node,
+            add_index=add_index
+        ).select_related("invoice_request").first()
+
+        if invoice_obj is None:
+            return None
+
+        logger.info("Invoice at add_index {} was missing from the index".format(add_index))
+        return InvoiceRecord(invoice_obj)
+
+    def pending_count(self, node, modified_after=None):
+        """
+        Indexed invoices that are not checkpointed yet, i.e. open invoices somebody may be paying
+        """
+        return sum(
+            1 for record in self.all_invoices_from_db.get(node, {}).values()
+            if record.checkpoint_value == "no_checkpoint" and (modified_after is None or record.modified > modified_after)
+        )
+
     def run_one_node(self, node):
         start_time = time.time()
 
-        invoices_details = lnclient.listinvoices(
-            index_offset=node.global_checkpoint,
-            rpcserver=node.rpcserver,
-            mock=settings.MOCK_LN_CLIENT
-        )
-
-        if node not in self.all_invoices_from_db:
-            invoice_list_from_db = {}
-            logger.info("DB has no invoices for this node")
-        else:
-            invoice_list_from_db = self.all_invoices_from_db[node]
+        with qos.measure(node):
+            invoices_details = node.get_lnclient().listinvoices(
+                index_offset=node.global_checkpoint,
+                rpcserver=node.rpcserver,
+                mock=settings.MOCK_LN_CLIENT
+            )
+        LISTINVOICES_SECONDS.observe(time.time() - start_time, node=node.node_name)
 
         # example of invoices_details: {"invoices": [], 'first_index_offset': '5', 'last_index_offset': '72'}
         invoice_list_from_node = invoices_details['invoices']
+        invoice_list_from_node += self.get_transitioned_invoices(node)
         self.invoice_count_from_nodes[node] = len(invoice_list_from_node)
 
         if settings.MOCK_LN_CLIENT:
@@ -244,9 +355,13 @@ class Runner(object):
             # 5. After X seconds passed based on Invoice created time, here Mock update the Invoice checkpoint to "done" faking a payment
 
             invoice_list_from_node = []
-            for invoice_obj in Invoice.objects.filter(lightning_node=node, checkpoint_value="no_checkpoint"):
-                invoice_request = InvoiceRequest.objects.get(id=invoice_obj.invoice_request.id)
-                if invoice_request.lightning_node.id != node.id:
+            mock_invoices = Invoice.objects.filter(
+                lightning_node=node,
+                checkpoint_value="no_checkpoint"
+            ).select_related("invoice_request")
+            for invoice_obj in mock_invoices:
+                invoice_request = invoice_obj.invoice_request
+                if invoice_request.lightning_node_id != node.id:
                     continue
 
                 mock_setteled = (invoice_obj.created + timedelta(seconds=3) < timezone.now())
@@ -267,7 +382,401 @@ class Runner(object):
                     }
                 )
 
+        INVOICES_FETCHED.observe(len(invoice_list_from_node), node=node.node_name)
+        self.process_invoices(node, invoice_list_from_node)
+
+        # listinvoices returns one page, the invoices added by the writer past it are in the index
+        latest_add_index = max(
+            [int(invoices_details["last_index_offset"]), node.global_checkpoint] +
+            list(self.all_invoices_from_db.get(node, {}).keys())
+        )
+        GLOBAL_CHECKPOINT.set(node.global_checkpoint, node=node.node_name)
+        GLOBAL_CHECKPOINT_LAG.set(latest_add_index - node.global_checkpoint, node=node.node_name)
+        PENDING_INVOICES.set(
+            sum(
+                1 for add_index, record in self.all_invoices_from_db.get(node, {}).items()
+                if add_index <= node.global_checkpoint and record.checkpoint_value == "no_checkpoint"
+            ),
+            node=node.node_name
+        )
+
+        processing_wall_time = time.time() - start_time
+
+        logger.info("Processing node {} took {:.3f} seconds".format(node.node_name, processing_wall_time))
+        return processing_wall_time
+
+    def get_transitioned_invoices(self, node):
+        """
+        Find pending invoices below the global checkpoint that are no longer open (settled, canceled),
+        and checkpoint the ones that are still open after INVOICE_EXPIRY as expired, and the ones that
+        the node no longer lists after INVOICE_EXPIRY as canceled
+
+        Open invoices do not hold back the global checkpoint, instead a pending-only scan lists the
+        invoices that are still open, and only the ones that dropped out of it are fetched.
+        """
+        if settings.MOCK_LN_CLIENT:
+            return []  # mocked invoices are listed from the DB regardless of the global checkpoint
+
+        pending = sorted(
+            add_index for add_index, record in self.all_invoices_from_db.get(node, {}).items()
+            if add_index <= node.global_checkpoint and record.checkpoint_value == "no_checkpoint"
+        )
+        if len(pending) == 0:
+            return []
+
+        still_open = set()
+        index_offset = pending[0] - 1
+        while index_offset < pending[-1]:
+            open_details = node.get_lnclient().listinvoices(
+                index_offset=index_offset,
+                rpcserver=node.rpcserver,
+                max_invoices=PENDING_SCAN_PAGE_SIZE,
+                pending_only=True,
+            )
+            if len(open_details["invoices"]) == 0:
+                break
+
+            still_open.update(int(i["add_index"]) for i in open_details["invoices"])
+            index_offset = int(open_details["last_index_offset"])
+
+        # Some lnd versions keep expired invoices OPEN, so they never drop out of the scan
+        records = self.all_invoices_from_db[node]
+        expiry_cutoff = timezone.now() - timedelta(seconds=settings.INVOICE_EXPIRY)
+        for add_index in pending:
+            record = records[add_index]
+            if add_index in still_open and record.created < expiry_cutoff:
+                creation_date = int(time.mktime(record.created.timetuple()))
+                CheckpointHelper(node=node, invoice=record, creation_date=creation_date).set_checkpoint("expired")
+
+        # One paged listinvoices over the add_index range of the invoices that dropped out of the scan
+        dropped = set(add_index for add_index in pending if add_index not in still_open)
+        transitioned = []
+        if len(dropped) > 0:
+            index_offset = min(dropped) - 1
+            while index_offset < max(dropped):
+                details = node.get_lnclient().listinvoices(
+                    index_offset=index_offset,
+                    rpcserver=node.rpcserver,
+                    max_invoices=min(max(dropped) - index_offset, PENDING_SCAN_PAGE_SIZE),
+                )
+                if len(details["invoices"]) == 0:
+                    break
+
+                transitioned += [i for i in details["invoices"] if int(i["add_index"]) in dropped]
+                index_offset = int(details["last_index_offset"])
+
+        # lnd deletes canceled invoices, once they could no longer be paid they stop being fetched
+        missing = dropped - set(int(i["add_index"]) for i in transitioned)
+        for add_index in sorted(missing):
+            record = records[add_index]
+            if record.created < expiry_cutoff:
+                logger.info("Invoice at add_index {} is no longer listed by the node".format(add_index))
+                creation_date = int(time.mktime(record.created.timetuple()))
+                CheckpointHelper(node=node, invoice=record, creation_date=creation_date).set_checkpoint("canceled")
+
+        logger.info("Pending scan: {} pending, {} still open, {} transitioned".format(
+            len(pending), len(still_open), len(transitioned)))
+
+        return transitioned
+
+    def apply_upvotes(self, upvotes):
+        """
+        Apply a batch of settled upvotes in one transaction
+
+        Votes are bulk-created, score, vote_count and thread_score changes are summed up per row,
+        bounties are re-evaluated once per question and checkpoints are written once per post.
+        """
+        if len(upvotes) == 0:
+            return
+
+        start_time = time.time()
+        change = settings.PAYMENT_AMOUNT
+
+        post_ids = {}
+        for checkpoint_helper, post_id in upvotes:
+            try:
+                post_ids[checkpoint_helper] = int(post_id)
+            except (TypeError, ValueError):
+                pass
+
+        posts = Post.objects.in_bulk(set(post_ids.values()))
+
+        valid_upvotes = []  # List[Tuple[CheckpointHelper, Post]]
+        for checkpoint_helper, post_id in upvotes:
+            post = posts.get(post_ids.get(checkpoint_helper))
+            if post is None:
+                logger.error("Skipping vote. The post for vote does not exist: {}".format(post_id))
+                checkpoint_helper.set_checkpoint("invalid_post")
+                continue
+
+            valid_upvotes.append((checkpoint_helper, post))
+
+        if len(valid_upvotes) == 0:
+            return
+
+        user = get_anon_user()
+
+        modified = timezone.now()
+        with transaction.atomic():
+            # Claim the invoices, the ones another worker already checkpointed are skipped, see lner.leases
+            claimed = set(
+                Invoice.objects.select_for_update().filter(
+                    pk__in=[checkpoint_helper.invoice.id for checkpoint_helper, _ in valid_upvotes],
+                    checkpoint_value="no_checkpoint"
+                ).values_list("id", flat=True)
+            )
+            if len(claimed) < len(valid_upvotes):
+                logger.error("Skipping {} upvotes that were already applied".format(len(valid_upvotes) - len(claimed)))
+                valid_upvotes = [
+                    (checkpoint_helper, post) for checkpoint_helper, post in valid_upvotes
+                    if checkpoint_helper.invoice.id in claimed
+                ]
+
+            score_deltas = Counter()  # Counter[int] where int is user id
+            vote_count_deltas = Counter()  # Counter[int] where int is post id
+            thread_score_deltas = Counter()  # Counter[int] where int is root post id
+            invoice_ids_by_post = defaultdict(list)  # Dict[int, List[int]] where first int is post id
+            question_ids = set()
+            for checkpoint_helper, post in valid_upvotes:
+                score_deltas[post.author_id] += change
+                vote_count_deltas[post.id] += change
+                thread_score_deltas[post.root_id] += change
+                invoice_ids_by_post[post.id].append(checkpoint_helper.invoice.id)
+
+                # Upvote on an Aswer is the trigger for potentian bounty awards
+                if post.type == Post.ANSWER and post.author_id != user.id:
+                    question_ids.add(post.parent_id)
+
+            logger.info("Creating {} new votes".format(len(valid_upvotes)))
+            Vote.objects.bulk_create(
+                [Vote(author=user, post=post, type=Vote.UP) for _, post in valid_upvotes]
+            )
+
+            # Update user reputation
+            # TODO: reactor score logic to be shared with "mark_fake_test_data.py"
+            for user_id, delta in score_deltas.items():
+                User.objects.filter(pk=user_id).update(score=F('score') + delta)
+
+            for post_id, delta in vote_count_deltas.items():
+                Post.objects.filter(pk=post_id).update(vote_count=F('vote_count') + delta)
+
+            # The thread score represents all votes in a thread
+            for root_id, delta in thread_score_deltas.items():
+                Post.objects.filter(pk=root_id).update(thread_score=F('thread_score') + delta)
+
+            for question_post in Post.objects.filter(pk__in=question_ids):
+                award_bounty(question_post=question_post)
+
+            for post_id, invoice_ids in invoice_ids_by_post.items():
+                Invoice.objects.filter(pk__in=invoice_ids).update(
+                    checkpoint_value="done",
+                    performed_action_type="upvote",
+                    performed_action_id=post_id,
+                    modified=modified,
+                )
+
+            notify.checkpoint_changed(checkpoint_helper.invoice.id for checkpoint_helper, _ in valid_upvotes)
+
+        for checkpoint_helper, post in valid_upvotes:
+            checkpoint_helper.invoice.checkpoint_value = "done"
+            checkpoint_helper.invoice.modified = modified
+            CHECKPOINTS.inc(node=checkpoint_helper.node.node_name, checkpoint_value="done")
+            logger.info("Updated checkpoint to {}".format(checkpoint_helper))
+
+        logger.info("Applied {} upvotes in {:.3f} seconds".format(len(valid_upvotes), time.time() - start_time))
+
+    def apply_action(self, node, checkpoint_helper, action_details):
+        """
+        Apply a settled Accept, Bounty or new post, runs in the transaction that claimed the invoice
+        """
+        action = action_details.get("action")
+        if action:
+            if action == "Accept":
+                vote_type = Vote.ACCEPT
+                change = settings.PAYMENT_AMOUNT
+                post_id = action_details["post_id"]
+                try:
+                    post = Post.objects.get(pk=post_id)
+                except (ObjectDoesNotExist, ValueError):
+                    logger.error("Skipping vote. The post for vote does not exist: {}".format(action_details))
+                    checkpoint_helper.set_checkpoint("invalid_post")
+                    return
+
+                user = get_anon_user()
+
+                logger.info("Creating a new vote: author={}, post={}, type={}".format(user, post, vote_type))
+                vote = Vote.objects.create(author=user, post=post, type=vote_type)
+
+                # Update user reputation
+                # TODO: reactor score logic to be shared with "mark_fake_test_data.py"
+                User.objects.filter(pk=post.author.id).update(score=F('score') + change)
+
+                # The thread score represents all votes in a thread
+                Post.objects.filter(pk=post.root_id).update(thread_score=F('thread_score') + change)
+
+                if "sig" not in action_details:
+                    checkpoint_helper.set_checkpoint("sig_missing")
+                    return
+
+                sig = action_details.pop("sig")
+                sig = validators.pre_validate_signature(sig)
+
+                verifymessage_detail = node.verifymessage(
+                    msg=json.dumps(action_details, sort_keys=True),
+                    sig=sig,
+                )
+
+                if not verifymessage_detail["valid"]:
+                    checkpoint_helper.set_checkpoint("invalid_signiture")
+                    return
+
+                if verifymessage_detail["pubkey"] != post.parent.author.pubkey:
+                    checkpoint_helper.set_checkpoint("signiture_unauthorized")
+                    return
+
+                if change > 0:
+                    # First, un-accept all answers
+                    for answer in Post.objects.filter(parent=post.parent, type=Post.ANSWER):
+                        if answer.has_accepted:
+                            Post.objects.filter(pk=answer.id).update(vote_count=F('vote_count') - change, has_accepted=False)
+
+                    # There does not seem to be a negation operator for F objects.
+                    Post.objects.filter(pk=post.id).update(vote_count=F('vote_count') + change, has_accepted=True)
+                    Post.objects.filter(pk=post.root_id).update(has_accepted=True)
+                else:
+                    # TODO: change "change". here change is set to payment ammount, so does not make sense to be called change
+                    # TODO: detect un-accept attempt and raise "Un-accept not yet supported"
+                    raise Exeption("Payment ammount has to be positive")
+
+                checkpoint_helper.set_checkpoint("done", action_type="upvote", action_id=post.id)
+
+            elif action == "Bounty":
+                valid = True
+                for keyword in ["post_id", "amt"]:
+                    if keyword not in action_details:
+                        logger.warn("Bounty invalid because {} is missing".format(keyword))
+                        valid = False
+
+                if not valid:
+                    logger.warn("Could not start Bounty: bounty_invalid")
+                    checkpoint_helper.set_checkpoint("bounty_invalid")
+                    return
+
+                post_id = action_details["post_id"]
+                amt = action_details["amt"]
+
+                try:
+                    post_obj = Post.objects.get(pk=post_id)
+                except (ObjectDoesNotExist, ValueError):
+                    logger.error("Bounty invalid because post {} does not exist".format(post_id))
+                    checkpoint_helper.set_checkpoint("bounty_invalid_post_does_not_exist")
+                    return
+
+                logger.info("Starting bounty for post {}!".format(post_id))
+
+                new_b = Bounty(
+                    post_id=post_obj,
+                    amt=amt,
+                    activation_time=timezone.now(),
+                )
+                new_b.save()
+
+                checkpoint_helper.set_checkpoint("done", action_type="bonty", action_id=post_id)
+            else:
+                logger.error("Invalid action: {}".format(action_details))
+                checkpoint_helper.set_checkpoint("invalid_action")
+                return
+        else:
+            # Posts do not include the "action" key to save on memo space
+            logger.info("Action details {}".format(action_details))
+
+            if "sig" in action_details:
+                sig = action_details.pop("sig")
+                sig = validators.pre_validate_signature(sig)
+
+                verifymessage_detail = node.verifymessage(
+                    msg=json.dumps(action_details, sort_keys=True),
+                    sig=sig,
+                    new_author=True,
+                )
+
+                if not verifymessage_detail["valid"]:
+                    checkpoint_helper.set_checkpoint("invalid_signiture")
+                    return
+                pubkey = verifymessage_detail["pubkey"]
+            else:
+                pubkey = "Unknown"
+
+
+            if "parent_post_id" in action_details:
+                # Find the parent.
+                try:
+                    parent_post_id = int(action_details["parent_post_id"])
+                    parent = Post.objects.get(pk=parent_post_id)
+                except (ObjectDoesNotExist, ValueError):
+                    logger.error("The post parent does not exist: {}".format(action_details))
+                    checkpoint_helper.set_checkpoint("invalid_parent_post")
+                    return
+
+                title = parent.title
+                tag_val = parent.tag_val
+            else:
+                title = action_details["title"]
+                tag_val = action_details["tag_val"]
+                parent = None
+
+            user, created = User.objects.get_or_create(pubkey=pubkey)
+
+            post = Post(
+                author=user,
+                parent=parent,
+                type=action_details["post_type"],
+                title=title,
+                content=action_details["content"],
+                tag_val=tag_val,
+            )
+
+            # TODO: Catch failures when post title is duplicate (e.g. another node already saved post)
+            post.save()
+
+            # New Answer is the trigger for potentian bounty awards
+            if post.type == Post.ANSWER and user != get_anon_user():
+                award_bounty(question_post=post.parent)
+
+            # Save tags
+            if "tag_val" in action_details:
+                tags = action_details["tag_val"].split(",")
+                for tag in tags:
+                    tag_obj, created = Tag.objects.get_or_create(name=tag)
+                    if created:
+                        logger.info("Created a new tag: {}".format(tag))
+
+                    tag_obj.count += 1
+                    post.tag_set.add(tag_obj)
+
+                    tag_obj.save()
+                    post.save()
+
+            checkpoint_helper.set_checkpoint("done", action_type="post", action_id=post.id)
+
+    def process_invoices(self, node, invoice_list_from_node, advance_global_checkpoint=True):
+        """
+        Validate and apply invoices in the listinvoices format, invoices from DB need to be loaded with pre_run
+
+        The global checkpoint can only be advanced when invoice_list_from_node has all invoices
+        after the current global checkpoint, e.g. listinvoices output. Streams pass advance_global_checkpoint=False.
+
+        The settle checkpoint is advanced over consecutive settle_index values, every settled invoice at or
+        below it has been processed, so it is skipped if the index confirms it was checkpointed.
+        """
+        if node not in self.all_invoices_from_db:
+            invoice_list_from_db = {}
+            logger.info("DB has no invoices for this node")
+        else:
+            invoice_list_from_db = self.all_invoices_from_db[node]
+
         retry_mini_map = {int(invoice['add_index']): False for invoice in invoice_list_from_node}
+        upvotes = []  # List[Tuple[CheckpointHelper, str]] where str is post_id from the memo
 
         one_hour_ago = timezone.now() - timedelta(hours=1)
         recent_invoices = [i.id for i in invoice_list_from_db.values() if i.modified > one_hour_ago]
@@ -293,6 +802,17 @@ class Runner(object):
             # 'amt_paid_msat': '0', 'r_preimage': 'd...=', 'fallback_addr': '',
             # 'payment_request': 'lnbc...'
             # }
+            settle_index = int(raw_invoice.get("settle_index", 0))
+            if raw_invoice["state"] == "SETTLED" and 0 < settle_index <= node.settle_checkpoint:
+                # pre_run only forgets checkpointed invoices below the global checkpoint, so an unknown
+                # add_index there was processed, otherwise the indexed checkpoint has to confirm it
+                record = invoice_list_from_db.get(int(raw_invoice["add_index"]))
+                if record is None and int(raw_invoice["add_index"]) <= node.global_checkpoint:
+                    continue  # already processed
+
+                if record is not None and record.checkpoint_value != "no_checkpoint":
+                    continue  # already processed
+
             created = general_util.unixtime_to_datetime(int(raw_invoice["creation_date"]))
             if created < general_util.now() - settings.INVOICE_RETENTION:
                 logger.info("Got old invoice from listinvoices, skipping... {} is older then retention {}".format(
@@ -306,6 +826,11 @@ class Runner(object):
 
             invoice = invoice_list_from_db.get(add_index_from_node)
 
+            if invoice is None:
+                invoice = self.lookup_invoice(node, add_index_from_node)
+                if invoice is not None:
+                    invoice_list_from_db[add_index_from_node] = invoice
+
             if invoice is None:
                 logger.error("Unknown add_index {}".format(add_index_from_node))
                 logger.error("Raw invoice from node was: {}".format(raw_invoice))
@@ -319,9 +844,9 @@ class Runner(object):
                 continue
 
             # Validate
-            if invoice.invoice_request.memo != raw_invoice["memo"]:
+            if invoice.memo != raw_invoice["memo"]:
                 logger.error("Memo in DB does not match the one in invoice request: db=({}) invoice_request=({})".format(
-                    invoice.invoice_request.memo,
+                    invoice.memo,
                     raw_invoice["memo"]
                 ))
 
@@ -359,8 +884,8 @@ class Runner(object):
                 continue
 
             if not raw_invoice['settled']:
+                # Does not hold back the global checkpoint, get_transitioned_invoices picks it up once it is paid
                 logger.info("Skipping invoice at {}: Not yet settled".format(checkpoint_helper))
-                retry_mini_map[checkpoint_helper.add_index] = True  # try again later
                 continue
 
             #
@@ -368,6 +893,7 @@ class Runner(object):
             #
 
             logger.info("Processing invoice at {}: SETTLED".format(checkpoint_helper))
+            self.settled_count_from_nodes[node] = self.settled_count_from_nodes.get(node, 0) + 1
 
             memo = raw_invoice["memo"]
             try:
@@ -383,190 +909,58 @@ class Runner(object):
                 checkpoint_helper.set_checkpoint("memo_invalid")
                 continue
 
-            action = action_details.get("action")
-
-            if action:
-                if action in ["Upvote", "Accept"]:
-                    vote_type = Vote.VOTE_TYPE_MAP[action]
-                    change = settings.PAYMENT_AMOUNT
-                    post_id = action_details["post_id"]
-                    try:
-                        post = Post.objects.get(pk=post_id)
-                    except (ObjectDoesNotExist, ValueError):
-                        logger.error("Skipping vote. The post for vote does not exist: {}".format(action_details))
-                        checkpoint_helper.set_checkpoint("invalid_post")
-                        continue
-
-                    user = get_anon_user()
-
-                    logger.info("Creating a new vote: author={}, post={}, type={}".format(user, post, vote_type))
-                    vote = Vote.objects.create(author=user, post=post, type=vote_type)
-
-                    # Update user reputation
-                    # TODO: reactor score logic to be shared with "mark_fake_test_data.py"
-                    User.objects.filter(pk=post.author.id).update(score=F('score') + change)
-
-                    # The thread score represents all votes in a thread
-                    Post.objects.filter(pk=post.root_id).update(thread_score=F('thread_score') + change)
-
-                    if vote_type == Vote.ACCEPT:
-                        if "sig" not in action_details:
-                            checkpoint_helper.set_checkpoint("sig_missing")
-                            continue
-
-                        sig = action_details.pop("sig")
-                        sig = validators.pre_validate_signature(sig)
-
-                        verifymessage_detail = lnclient.verifymessage(
-                            msg=json.dumps(action_details, sort_keys=True),
-                            sig=sig,
-                            rpcserver=node.rpcserver,
-                            mock=settings.MOCK_LN_CLIENT
-                        )
-
-                        if not verifymessage_detail["valid"]:
-                            checkpoint_helper.set_checkpoint("invalid_signiture")
-                            continue
-
-                        if verifymessage_detail["pubkey"] != post.parent.author.pubkey:
-                            checkpoint_helper.set_checkpoint("signiture_unauthorized")
-                            continue
-
-                        if change > 0:
-                            # First, un-accept all answers
-                            for answer in Post.objects.filter(parent=post.parent, type=Post.ANSWER):
-                                if answer.has_accepted:
-                                    Post.objects.filter(pk=answer.id).update(vote_count=F('vote_count') - change, has_accepted=False)
-
-                            # There does not seem to be a negation operator for F objects.
-                            Post.objects.filter(pk=post.id).update(vote_count=F('vote_count') + change, has_accepted=True)
-                            Post.objects.filter(pk=post.root_id).update(has_accepted=True)
-                        else:
-                            # TODO: change "change". here change is set to payment ammount, so does not make sense to be called change
-                            # TODO: detect un-accept attempt and raise "Un-accept not yet supported"
-                            raise Exeption("Payment ammount has to be positive")
-                    else:
-                        Post.objects.filter(pk=post.id).update(vote_count=F('vote_count') + change)
-
-                        # Upvote on an Aswer is the trigger for potentian bounty awards
-                        if post.type == Post.ANSWER and post.author != get_anon_user():
-                            award_bounty(question_post=post.parent)
-
-                    checkpoint_helper.set_checkpoint("done", action_type="upvote", action_id=post.id)
-
-                elif action == "Bounty":
-                    valid = True
-                    for keyword in ["post_id", "amt"]:
-                        if keyword not in action_details:
-                            logger.warn("Bounty invalid because {} is missing".format(keyword))
-                            valid = False
-
-                    if not valid:
-                        logger.warn("Could not start Bounty: bounty_invalid")
-                        checkpoint_helper.set_checkpoint("bounty_invalid")
-                        continue
-
-                    post_id = action_details["post_id"]
-                    amt = action_details["amt"]
-
-                    try:
-                        post_obj = Post.objects.get(pk=post_id)
-                    except (ObjectDoesNotExist, ValueError):
-                        logger.error("Bounty invalid because post {} does not exist".format(post_id))
-                        checkpoint_helper.set_checkpoint("bounty_invalid_post_does_not_exist")
-                        continue
-
-                    logger.info("Starting bounty for post {}!".format(post_id))
-
-                    new_b = Bounty(
-                        post_id=post_obj,
-                        amt=amt,
-                        activation_time=timezone.now(),
-                    )
-                    new_b.save()
+            if action_details.get("action") == "Upvote":
+                # Applied in one transaction together with the other upvotes, see apply_upvotes
+                upvotes.append((checkpoint_helper, action_details["post_id"]))
+                continue
 
-                    checkpoint_helper.set_checkpoint("done", action_type="bonty", action_id=post_id)
-                else:
-                    logger.error("Invalid action: {}".format(action_details))
-                    checkpoint_helper.set_checkpoint("invalid_action")
+            # The claim locks the invoice row until the action is committed, so only one worker applies it
+            with transaction.atomic():
+                if not checkpoint_helper.claim():
+                    logger.info("Skipping invoice at {}: Already processed by another worker".format(checkpoint_helper))
                     continue
-            else:
-                # Posts do not include the "action" key to save on memo space
-                logger.info("Action details {}".format(action_details))
-
-                if "sig" in action_details:
-                    sig = action_details.pop("sig")
-                    sig = validators.pre_validate_signature(sig)
-
-                    verifymessage_detail = lnclient.verifymessage(
-                        msg=json.dumps(action_details, sort_keys=True),
-                        sig=sig,
-                        rpcserver=node.rpcserver,
-                        mock=settings.MOCK_LN_CLIENT
-                    )
-
-                    if not verifymessage_detail["valid"]:
-                        checkpoint_helper.set_checkpoint("invalid_signiture")
-                        continue
-                    pubkey = verifymessage_detail["pubkey"]
-                else:
-                    pubkey = "Unknown"
 
+                self.apply_action(node, checkpoint_helper, action_details)
 
-                if "parent_post_id" in action_details:
-                    # Find the parent.
-                    try:
-                        parent_post_id = int(action_details["parent_post_id"])
-                        parent = Post.objects.get(pk=parent_post_id)
-                    except (ObjectDoesNotExist, ValueError):
-                        logger.error("The post parent does not exist: {}".format(action_details))
-                        checkpoint_helper.set_checkpoint("invalid_parent_post")
-                        continue
+        self.apply_upvotes(upvotes)
 
-                    title = parent.title
-                    tag_val = parent.tag_val
+        # advance settle checkpoint
+        settled_done = set(
+            int(raw_invoice["settle_index"]) for raw_invoice in invoice_list_from_node
+            if raw_invoice["state"] == "SETTLED" and int(raw_invoice.get("settle_index", 0)) > 0
+            and not retry_mini_map[int(raw_invoice["add_index"])]
+        )
+        if settled_done:
+            new_settle_checkpoint = node.settle_checkpoint
+            if new_settle_checkpoint == -1:
+                if node.global_checkpoint <= 0:
+                    # Fresh node, no settled invoice was processed before
+                    new_settle_checkpoint = 0
                 else:
-                    title = action_details["title"]
-                    tag_val = action_details["tag_val"]
-                    parent = None
-
-                user, created = User.objects.get_or_create(pubkey=pubkey)
-
-                post = Post(
-                    author=user,
-                    parent=parent,
-                    type=action_details["post_type"],
-                    title=title,
-                    content=action_details["content"],
-                    tag_val=tag_val,
-                )
-
-                # TODO: Catch failures when post title is duplicate (e.g. another node already saved post)
-                post.save()
-
-                # New Answer is the trigger for potentian bounty awards
-                if post.type == Post.ANSWER and user != get_anon_user():
-                    award_bounty(question_post=post.parent)
+                    # Node from before the settle checkpoint existed, earlier settlements are assumed processed.
+                    # If one was not, the skip above does not trust the settle checkpoint without its checkpoint.
+                    new_settle_checkpoint = min(settled_done) - 1
 
-                # Save tags
-                if "tag_val" in action_details:
-                    tags = action_details["tag_val"].split(",")
-                    for tag in tags:
-                        tag_obj, created = Tag.objects.get_or_create(name=tag)
-                        if created:
-                            logger.info("Created a new tag: {}".format(tag))
+            # settlements arrive out of order across listinvoices pages, the ones past a gap wait for it
+            settled_done.update(self.settled_above_checkpoint.get(node, set()))
+            while new_settle_checkpoint + 1 in settled_done:
+                new_settle_checkpoint += 1
 
-                        tag_obj.count += 1
-                        post.tag_set.add(tag_obj)
+            self.settled_above_checkpoint[node] = set(i for i in settled_done if i > new_settle_checkpoint)
 
-                        tag_obj.save()
-                        post.save()
+            if new_settle_checkpoint != node.settle_checkpoint:
+                leases.set_settle_checkpoint(node, new_settle_checkpoint)
+                logger.info("Saved new settle checkpoint {}".format(new_settle_checkpoint))
 
-                checkpoint_helper.set_checkpoint("done", action_type="post", action_id=post.id)
+        if not advance_global_checkpoint:
+            return
 
         # advance global checkpoint
         new_global_checkpoint = None
         for add_index in sorted(retry_mini_map.keys()):
+            if add_index <= node.global_checkpoint:
+                continue  # pending invoice from get_transitioned_invoices
+
             retry = retry_mini_map[add_index]
             if retry:
                 break
@@ -575,95 +969,187 @@ class Runner(object):
                 new_global_checkpoint = add_index
 
         if new_global_checkpoint:
-            node.global_checkpoint = new_global_checkpoint
-            node.save()
+            leases.set_global_checkpoint(node, new_global_checkpoint)
             logger.info("Saved new global checkpoint {}".format(new_global_checkpoint))
 
-        processing_wall_time = time.time() - start_time
 
-        logger.info("Processing node {} took {:.3f} seconds".format(node.node_name, processing_wall_time))
-        return processing_wall_time
+def run_node(runner, node):
+    """
+    Process one node, runs in a worker thread of run_many with its own DB connection
+    """
+    try:
+        logger.info("--------------------- {} id={} ----------------------------".format(node.node_name, node.id))
 
+        created = (node.global_checkpoint == -1)
+        if created:
+            logger.info("Global checkpoint does not exist")
+            leases.set_global_checkpoint(node, 0)
 
-@background(queue='queue-1', remove_existing_tasks=True)
-def run_many():
-    start_time = time.time()
-    runner = Runner()
-    total_prerun_processing_times_array = []
-    total_run_processing_times_array = []
+        # pre-run!
+        p = runner.pre_run(node)
 
-    num_runs = 10
-    for _ in range(num_runs):
-        node_list = LightningNode.objects.all()
+        # run
+        t = runner.run_one_node(node)
 
-        prerun_processing_times_array = []
-        run_processing_times_array = []
+        logger.info(
+            (
+                "Processed {} invoices from node {} and {} from db"
+            ).format(
+                runner.invoice_count_from_nodes[node],
+                node.node_name,
+                runner.invoice_count_from_db[node],
+            )
+        )
 
-        # initialize checkpoints
-        for node in node_list:
-            logger.info("--------------------- {} id={} ----------------------------".format(node.node_name, node.id))
+        return p, t
+    finally:
+        qos.flush()
+        connection.close()
 
-            if not node.enabled:
-                logger.info("Node {} disabled, skipping...".format(node.node_name))
-                continue
 
-            created = (node.global_checkpoint == -1)
-            if created:
-                logger.info("Global checkpoint does not exist")
-                node.global_checkpoint = 0
-                node.save()
+def log_stats(label, times_array):
+    if len(times_array) == 0:
+        logger.info("{}: no runs".format(label))
+        return
 
-            # pre-run!
-            p = runner.pre_run(node)
+    logger.info(
+        "{} total was {:.3f} max was {:.3f} avg was {:.3f} min was {:.3f} seconds".format(
+            label,
+            sum(times_array),
+            max(times_array),
+            sum(times_array) / len(times_array),
+            min(times_array),
+        )
+    )
 
-            # run
-            t = runner.run_one_node(node)
 
-            prerun_processing_times_array.append(p)
-            total_prerun_processing_times_array.append(p)
+# Shared between runs of the background task, so the invoice index and the poll intervals survive from one run to the next
+runner = Runner()
+scheduler = PollScheduler()
+node_leases = leases.LeaseManager()
 
-            run_processing_times_array.append(t)
-            total_run_processing_times_array.append(t)
 
-            logger.info(
-                (
-                    "Processed {} invoices from node and {} from db\n\n\n\n\n"
-                ).format(
-                    runner.invoice_count_from_nodes[node],
-                    runner.invoice_count_from_db[node],
-                )
-            )
+def polled_nodes():
+    # Nodes disabled by qos get no new invoices, but the ones they already issued can still be paid
+    node_list = []
+    for node in LightningNode.objects.filter(Q(enabled=True) | Q(qos_disabled=True)):
+        if node.is_streamed():
+            continue  # processed by "manage.py stream_invoices"
 
-            sleep(BETWEEN_NODES_DELAY)
+        node_list.append(node)
 
-        logger.info("Pre-run Max was {:.3f} seconds".format(max(prerun_processing_times_array)))
-        logger.info("Pre-run Avg was {:.3f} seconds".format(sum(prerun_processing_times_array) / len(prerun_processing_times_array)))
-        logger.info("Pre-run Min was {:.3f} seconds".format(min(prerun_processing_times_array)))
-        logger.info("\n")
-        logger.info("Run Max was {:.3f} seconds".format(max(run_processing_times_array)))
-        logger.info("Run Avg was {:.3f} seconds".format(sum(run_processing_times_array) / len(run_processing_times_array)))
-        logger.info("Run Min was {:.3f} seconds".format(min(run_processing_times_array)))
+    return node_list
 
-        logger.info("\n")
 
+def write_metrics_snapshot():
+    try:
+        # one snapshot per worker, several workers can run run_many at the same time
+        metrics.write_snapshot(settings.METRICS_SNAPSHOT_DIR, "run_many-{}".format(node_leases.worker_id))
+    except Exception as e:
+        logger.error("Could not write metrics snapshot")
+        logger.exception(e)
 
-    logger.info("\n")
-    logger.info("Cumulative pre-run total was {:.3f} seconds".format(sum(prerun_processing_times_array)))
-    logger.info("Cumulative pre-run max was {:.3f} seconds".format(max(prerun_processing_times_array)))
-    logger.info("Cumulative pre-run avg was {:.3f} seconds".format(sum(prerun_processing_times_array) / len(prerun_processing_times_array)))
-    logger.info("Cumulative pre-run min was {:.3f} seconds".format(min(prerun_processing_times_array)))
 
+@background(queue='queue-1', remove_existing_tasks=True)
+def run_many():
+    """
+    Nodes are processed in parallel, so one slow or timing out node does not delay the others
+
+    Each node is polled on its own interval, short while it has open invoices or settles payments
+    and backing off when it is idle, see lner.scheduler.PollScheduler
+
+    Several workers can run run_many at the same time, each one only polls the nodes it leased, see lner.leases
+    """
+    start_time = time.time()
+
+    prerun_times_by_node = {}  # Dict[str, List[float]] where str is node_name
+    run_times_by_node = {}  # Dict[str, List[float]] where str is node_name
+    running = {}  # Dict[futures.Future, LightningNode]
+    recent_cutoff = timedelta(seconds=RECENT_INVOICE_SECONDS)
+
+    with futures.ThreadPoolExecutor(max_workers=MAX_PARALLEL_NODES) as executor:
+        while True:
+            now = time.time()
+            node_list = node_leases.owned_nodes(polled_nodes())
+
+            if now - start_time < RUN_MANY_SECONDS:
+                scheduler.wake_new_invoices(now)
+                running_ids = set(node.id for node in running.values())
+                for node in scheduler.due(node_list, now):
+                    if node.id not in running_ids:
+                        running[executor.submit(run_node, runner, node)] = node
+            elif len(running) == 0:
+                break
+
+            # wake up at least every HOT_POLL_INTERVAL to look for new invoices
+            timeout = min(
+                max(scheduler.next_poll(node_list, now) - time.time(), 0),
+                HOT_POLL_INTERVAL
+            )
+            if len(running) == 0:
+                time.sleep(timeout)
+                continue
+
+            done, _ = futures.wait(list(running.keys()), timeout=timeout, return_when=futures.FIRST_COMPLETED)
+            for future in done:
+                node = running.pop(future)
+                try:
+                    p, t = future.result()
+                except leases.LeaseLost as e:
+                    logger.error("Stopped processing node {}: {}".format(node.node_name, e))
+                    node_leases.lost(node.id)
+                    continue
+                except Exception as e:
+                    logger.error("Processing node {} failed".format(node.node_name))
+                    logger.exception(e)
+                    scheduler.record_failure(node, time.time())
+                    continue
+
+                prerun_times_by_node.setdefault(node.node_name, []).append(p)
+                run_times_by_node.setdefault(node.node_name, []).append(t)
+                scheduler.record(
+                    node,
+                    pending=runner.pending_count(node),
+                    recent_pending=runner.pending_count(node, modified_after=timezone.now() - recent_cutoff),
+                    settled_total=runner.settled_count_from_nodes.get(node, 0),
+                    now=time.time(),
+                )
+
+            if len(done) > 0:
+                write_metrics_snapshot()
+
+    write_metrics_snapshot()  # also when no node was due, so the snapshot does not go stale
     logger.info("\n")
-    logger.info("Cumulative total was {:.3f} seconds".format(sum(run_processing_times_array)))
-    logger.info("Cumulative max was {:.3f} seconds".format(max(run_processing_times_array)))
-    logger.info("Cumulative avg was {:.3f} seconds".format(sum(run_processing_times_array) / len(run_processing_times_array)))
-    logger.info("Cumulative min was {:.3f} seconds".format(min(run_processing_times_array)))
+    for node_name in sorted(run_times_by_node.keys()):
+        log_stats("Node {} pre-run".format(node_name), prerun_times_by_node[node_name])
+        log_stats("Node {} run".format(node_name), run_times_by_node[node_name])
 
     logger.info("\n")
     processing_wall_time = time.time() - start_time
-    logger.info("Finished {} runs in wall-time of {:.3f} seconds".format(num_runs, processing_wall_time))
+    logger.info("Finished {} polls in wall-time of {:.3f} seconds".format(
+        sum(len(times) for times in run_times_by_node.values()), processing_wall_time))
 
     logger.info("\n\n\n\n\n")
 
+
+@background(queue='queue-1', remove_existing_tasks=True)
+def probe_nodes():
+    """
+    Measure every node with a cheap call and update qos_score, see lner.qos
+    """
+    qos.probe()
+    write_metrics_snapshot()
+
+
+@background(queue='queue-1', remove_existing_tasks=True)
+def archive_invoices():
+    """
+    Move invoices that passed retention out of the hot tables, see lner.archive
+    """
+    archive.archive_invoices()
+
+
 # schedule a new task after "repeat" number of seconds
 run_many(repeat=1)
+probe_nodes(repeat=qos.PROBE_INTERVAL_SECONDS)
+archive_invoices(repeat=archive.ARCHIVE_INTERVAL_SECONDS)
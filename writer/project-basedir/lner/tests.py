@@ -1,3 +1,885 @@
+import io
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management import call_command
 from django.test import TestCase
+from django.test import SimpleTestCase
+from django.test import override_settings
+from django.utils import timezone
+
+from common import lnrpc
+from common import json_util
+
+from posts.models import Post
+from posts.models import Vote
+from bounty.models import Bounty
+from bounty.models import BountyAward
+from users.models import User
+
+from lner.models import LightningNode
+from lner.models import Invoice
+from lner.models import InvoiceRequest
+from lner.models import PayAwardJob
+from lner.models import ArchivedInvoice
+from lner import scheduler
+from lner import qos
+from lner import payouts
+from lner import leases
+from lner import archive
+from lner import notify
+
+if lnrpc.grpc is not None:
+    from common.lnrpc_fake import FakeLightningServer
+
+
+@unittest.skipIf(lnrpc.grpc is None, "grpcio is not installed")
+class StreamTest(TestCase):
+    def setUp(self):
+        self.server = FakeLightningServer()
+        self.server.start()
+        client = self.server.client()
+        lnrpc.register_client(client)
+
+        self.node = LightningNode.objects.create(
+            node_name="fake", rpcserver=client.rpcserver, rpc_client="grpc", global_checkpoint=0)
+
+    def tearDown(self):
+        lnrpc.close_all()
+        self.server.stop()
+
+    def add_invoice(self, memo_obj):
+        memo = json_util.serialize_memo(memo_obj)
+        invoice_request = InvoiceRequest.objects.create(lightning_node=self.node, memo=memo)
+        added = lnrpc.addinvoice(memo, self.node.rpcserver, amt=2, expiry=3600)
+        return Invoice.objects.create(
+            lightning_node=self.node,
+            invoice_request=invoice_request,
+            pay_req=added["payment_request"],
+            r_hash=added["r_hash"],
+            add_index=int(added["add_index"]),
+        )
+
+    def test_settled_invoice_is_applied_once(self):
+        # lner.tasks schedules run_many when imported, so it can only be imported once the test DB exists
+        from lner.tasks import Runner
+        from lner.stream import NodeStreamer
+
+        invoice = self.add_invoice(
+            {"title": "Streamed question", "content": "Body of the question", "post_type": Post.QUESTION, "tag_val": "stream"}
+        )
+
+        runner = Runner()
+        runner.pre_run(self.node)
+        streamer = NodeStreamer(self.node.id)
+
+        updates = lnrpc.subscribeinvoices(self.node.rpcserver, add_index=0, timeout=5)
+        stream = iter(updates)
+
+        streamer.on_invoice(runner, self.node, next(stream))  # OPEN addition is ignored
+        invoice.refresh_from_db()
+        self.assertEqual(invoice.checkpoint_value, "no_checkpoint")
+
+        self.server.settle(invoice.add_index)
+        settled = next(stream)
+        updates.cancel()
+
+        streamer.on_invoice(runner, self.node, settled)
+        streamer.on_invoice(runner, self.node, settled)  # replay after resubscribe
+
+        invoice.refresh_from_db()
+        self.assertEqual(invoice.checkpoint_value, "done")
+        self.assertEqual(Post.objects.filter(title="Streamed question").count(), 1)
+
+
+@unittest.skipIf(lnrpc.grpc is None, "grpcio is not installed")
+@override_settings(MOCK_LN_CLIENT=False, LOCAL_VERIFYMESSAGE=True, LOCAL_VERIFYMESSAGE_NEW_AUTHORS=False)
+class VerifyMessageTest(StreamTest):
+    MSG = "hello"
+    SIG = "d6kfezkenigypp1az8jke9j4554frwscskq8659w4nis6bb15grz4co8bpuna5h5k77dk79mmnenhn1ddejhpu8es5c1nhxk58sjp1z7"
+    PUBKEY = "0279be667ef9dcbbac55a06295ce870b07029bfcdb2dce28d959f2815b16f81798"
+
+    def test_new_author_must_be_in_channel_graph(self):
+        self.assertEqual(self.node.verifymessage(self.MSG, self.SIG), {"valid": True, "pubkey": self.PUBKEY})
+        self.assertNotIn("VerifyMessage", self.server.calls)
+
+        # the key is not a node that lnd knows about
+        self.assertFalse(self.node.verifymessage(self.MSG, self.SIG, new_author=True)["valid"])
+
+        self.server.valid_signatures[self.SIG] = self.PUBKEY
+        self.assertEqual(
+            self.node.verifymessage(self.MSG, self.SIG, new_author=True), {"valid": True, "pubkey": self.PUBKEY})
+        self.assertEqual(self.server.calls.count("VerifyMessage"), 2)
+
+    @override_settings(LOCAL_VERIFYMESSAGE_NEW_AUTHORS=True)
+    def test_new_author_verified_locally(self):
+        self.assertEqual(
+            self.node.verifymessage(self.MSG, self.SIG, new_author=True), {"valid": True, "pubkey": self.PUBKEY})
+        self.assertNotIn("VerifyMessage", self.server.calls)
+
+
+@unittest.skipIf(lnrpc.grpc is None, "grpcio is not installed")
+@override_settings(MOCK_LN_CLIENT=False)
+class PendingScanTest(StreamTest):
+    def test_open_invoices_do_not_hold_back_global_checkpoint(self):
+        from lner.tasks import Runner
+
+        invoices = [
+            self.add_invoice(
+                {"title": "Question {}".format(i), "content": "Body of the question", "post_type": Post.QUESTION, "tag_val": "scan"}
+            )
+            for i in range(3)
+        ]
+
+        runner = Runner()
+        runner.pre_run(self.node)
+        runner.run_one_node(self.node)
+        self.assertEqual(self.node.global_checkpoint, 3)
+
+        self.server.settle(invoices[1].add_index)
+        self.server.calls = []
+        runner.pre_run(self.node)
+        runner.run_one_node(self.node)
+
+        # new invoices, one pending-only page, then only the transitioned invoice
+        self.assertEqual(self.server.calls, ["ListInvoices"] * 3)
+        self.assertEqual(
+            [Invoice.objects.get(pk=i.pk).checkpoint_value for i in invoices],
+            ["no_checkpoint", "done", "no_checkpoint"]
+        )
+        self.assertEqual(self.node.settle_checkpoint, 1)
+
+        self.server.settle(invoices[0].add_index)
+        self.server.settle(invoices[2].add_index)
+        self.server.calls = []
+        runner.pre_run(self.node)
+        runner.run_one_node(self.node)
+
+        # both transitioned invoices come from one page over their add_index range
+        self.assertEqual(self.server.calls, ["ListInvoices"] * 3)
+
+        runner.pre_run(self.node)
+        runner.run_one_node(self.node)
+
+        self.assertEqual(Post.objects.filter(tag_val="scan").count(), 3)
+        self.assertEqual(self.node.settle_checkpoint, 3)
+        self.assertEqual(sorted(runner.all_invoices_from_db[self.node].keys()), [])
+
+    def test_checkpoint_lag_spans_pages(self):
+        from lner.tasks import Runner
+        from lner.tasks import GLOBAL_CHECKPOINT_LAG
+
+        for i in range(105):
+            self.add_invoice(
+                {"title": "Question {}".format(i), "content": "Body of the question", "post_type": Post.QUESTION, "tag_val": "lag"}
+            )
+
+        runner = Runner()
+        runner.pre_run(self.node)
+        runner.run_one_node(self.node)
+
+        # the first listinvoices page ends at add_index 100
+        self.node.refresh_from_db()
+        lag = dict((tuple(labels), value) for labels, value in GLOBAL_CHECKPOINT_LAG.snapshot()["samples"])
+        self.assertEqual(lag[("fake",)], 105 - self.node.global_checkpoint)
+
+    def test_missing_invoice_is_canceled(self):
+        from lner.tasks import Runner
+
+        invoices = [
+            self.add_invoice(
+                {"title": "Question {}".format(i), "content": "Body of the question", "post_type": Post.QUESTION, "tag_val": "scan"}
+            )
+            for i in range(3)
+        ]
+
+        runner = Runner()
+        runner.pre_run(self.node)
+        runner.run_one_node(self.node)
+
+        # canceled and deleted by lnd, only one of them could no longer be paid
+        for invoice in invoices[1:]:
+            self.server.cancel(invoice.add_index)
+        del self.server.invoices[1:]
+        Invoice.objects.filter(pk=invoices[1].pk).update(
+            created=timezone.now() - timedelta(seconds=settings.INVOICE_EXPIRY + 60), modified=timezone.now())
+
+        runner.pre_run(self.node)
+        runner.run_one_node(self.node)
+
+        self.assertEqual(
+            [Invoice.objects.get(pk=i.pk).checkpoint_value for i in invoices],
+            ["no_checkpoint", "canceled", "no_checkpoint"]
+        )
+
+    def test_open_invoice_expires(self):
+        from lner.tasks import Runner
+
+        invoice = self.add_invoice(
+            {"title": "Expiring question", "content": "Body of the question", "post_type": Post.QUESTION, "tag_val": "scan"}
+        )
+
+        runner = Runner()
+        runner.pre_run(self.node)
+        runner.run_one_node(self.node)
+
+        # the node keeps the invoice OPEN past its expiry
+        Invoice.objects.filter(pk=invoice.pk).update(
+            created=timezone.now() - timedelta(seconds=settings.INVOICE_EXPIRY + 60), modified=timezone.now())
+        runner.pre_run(self.node)
+        runner.run_one_node(self.node)
+
+        invoice.refresh_from_db()
+        self.assertEqual(invoice.checkpoint_value, "expired")
+
+
+class PreRunTest(TestCase):
+    def setUp(self):
+        self.node = LightningNode.objects.create(node_name="fake", rpcserver="fake:10009", global_checkpoint=0)
+
+    def add_invoice(self, add_index):
+        invoice_request = InvoiceRequest.objects.create(lightning_node=self.node, memo="memo{}".format(add_index))
+        return Invoice.objects.create(
+            lightning_node=self.node,
+            invoice_request=invoice_request,
+            pay_req="lnfake{}".format(add_index),
+            add_index=add_index,
+        )
+
+    def test_index_is_refreshed_incrementally(self):
+        from lner.tasks import Runner
+
+        for add_index in range(1, 21):
+            self.add_invoice(add_index)
+
+        runner = Runner()
+        with self.assertNumQueries(1):
+            runner.pre_run(self.node)
+
+        self.assertEqual(len(runner.all_invoices_from_db[self.node]), 20)
+        self.assertEqual(runner.all_invoices_from_db[self.node][3].memo, "memo3")
+
+        invoice = self.add_invoice(21)
+        runner.pre_run(self.node)
+        self.assertEqual(runner.invoice_count_from_db[self.node], 21)
+        self.assertEqual(runner.all_invoices_from_db[self.node][21].id, invoice.id)
+
+        Invoice.objects.filter(add_index__lte=5).update(checkpoint_value="done", modified=timezone.now())
+        Invoice.objects.filter(pk=invoice.pk).update(checkpoint_value="done", modified=timezone.now())
+        self.node.global_checkpoint = 10
+        runner.pre_run(self.node)
+
+        # pending invoices below the global checkpoint stay in the index
+        self.assertEqual(sorted(runner.all_invoices_from_db[self.node].keys()), list(range(6, 22)))
+        self.assertEqual(runner.all_invoices_from_db[self.node][21].checkpoint_value, "done")
+
+
+class UpvoteBatchTest(TestCase):
+    def setUp(self):
+        self.node = LightningNode.objects.create(node_name="fake", rpcserver="fake:10009", global_checkpoint=0)
+        self.author = User.objects.create(pubkey="author")
+        self.question = Post.objects.create(
+            author=self.author, type=Post.QUESTION, title="Question", content="Body of the question", tag_val="batch")
+        self.answer = Post.objects.create(
+            author=self.author, type=Post.ANSWER, parent=self.question, content="Body of the answer")
+
+    def settled_upvote(self, add_index, post_id):
+        return self.settled_invoice(add_index, {"action": "Upvote", "post_id": post_id, "unixtime": add_index})
+
+    def settled_invoice(self, add_index, memo_obj, settle_index=None):
+        memo = json_util.serialize_memo(memo_obj)
+        invoice_request = InvoiceRequest.objects.create(lightning_node=self.node, memo=memo)
+        Invoice.objects.create(
+            lightning_node=self.node,
+            invoice_request=invoice_request,
+            pay_req="lnfake{}".format(add_index),
+            add_index=add_index,
+        )
+
+        now = int(time.time())
+        return {
+            "memo": memo,
+            "payment_request": "lnfake{}".format(add_index),
+            "add_index": str(add_index),
+            "settle_index": str(settle_index or add_index),
+            "state": "SETTLED",
+            "settled": True,
+            "settle_date": str(now),
+            "creation_date": str(now),
+            "expiry": "3600",
+        }
+
+    def test_upvotes_are_applied_in_one_batch(self):
+        from lner.tasks import Runner
+
+        raw_invoices = [self.settled_upvote(i, self.answer.id) for i in range(1, 6)]
+        raw_invoices += [self.settled_upvote(6, self.question.id), self.settled_upvote(7, 123456)]
+
+        runner = Runner()
+        runner.pre_run(self.node)
+        runner.process_invoices(self.node, raw_invoices)
+
+        self.answer.refresh_from_db()
+        self.question.refresh_from_db()
+        self.author.refresh_from_db()
+        self.assertEqual(Vote.objects.filter(type=Vote.UP).count(), 6)
+        self.assertEqual(self.answer.vote_count, 5 * settings.PAYMENT_AMOUNT)
+        self.assertEqual(self.question.vote_count, settings.PAYMENT_AMOUNT)
+        self.assertEqual(self.question.thread_score, 6 * settings.PAYMENT_AMOUNT)
+        self.assertEqual(self.author.score, 6 * settings.PAYMENT_AMOUNT)
+
+        checkpoints = dict(Invoice.objects.values_list("add_index", "checkpoint_value"))
+        self.assertEqual(checkpoints, {1: "done", 2: "done", 3: "done", 4: "done", 5: "done", 6: "done", 7: "invalid_post"})
+        self.assertEqual(self.node.global_checkpoint, 7)
+        self.assertEqual(self.node.settle_checkpoint, 7)
+
+        # replaying the same invoices does nothing
+        runner.process_invoices(self.node, raw_invoices)
+        self.assertEqual(Vote.objects.filter(type=Vote.UP).count(), 6)
+
+    def settled_post(self, add_index, settle_index):
+        return self.settled_invoice(
+            add_index,
+            {"title": "Question {}".format(add_index), "content": "Body of the question", "post_type": Post.QUESTION, "tag_val": "order"},
+            settle_index=settle_index
+        )
+
+    def test_out_of_order_settles_across_pages(self):
+        from lner.tasks import Runner
+
+        # settled in the order 3, 1, 2 and listed two invoices per page
+        raw_invoices = [self.settled_post(1, 2), self.settled_post(2, 3), self.settled_post(3, 1)]
+
+        runner = Runner()
+        for page in [raw_invoices[:2], raw_invoices[2:]]:
+            runner.pre_run(self.node)
+            runner.process_invoices(self.node, page)
+
+        self.assertEqual(list(Invoice.objects.order_by("add_index").values_list("checkpoint_value", flat=True)), ["done"] * 3)
+        self.assertEqual(Post.objects.filter(tag_val="order").count(), 3)
+        self.assertEqual(self.node.global_checkpoint, 3)
+        self.assertEqual(self.node.settle_checkpoint, 3)
+
+    def test_settle_checkpoint_is_confirmed(self):
+        from lner.tasks import Runner
+
+        # a settle checkpoint that got ahead of an invoice that was never applied
+        self.node.settle_checkpoint = 5
+        self.node.save()
+        raw_invoice = self.settled_post(1, 1)
+
+        runner = Runner()
+        runner.pre_run(self.node)
+        runner.process_invoices(self.node, [raw_invoice])
+
+        self.assertEqual(Post.objects.filter(tag_val="order").count(), 1)
+
+        # processed invoices are skipped without looking at them again
+        runner.pre_run(self.node)
+        with self.assertNumQueries(0):
+            runner.process_invoices(self.node, [raw_invoice], advance_global_checkpoint=False)
+
+    def test_late_invoice_is_looked_up(self):
+        from lner.tasks import Runner
+
+        runner = Runner()
+        first = self.settled_upvote(1, self.answer.id)
+        runner.pre_run(self.node)
+
+        # committed late, its modified time is behind the watermark of pre_run
+        late = self.settled_upvote(2, self.answer.id)
+        Invoice.objects.filter(add_index=2).update(modified=timezone.now() - timedelta(hours=1))
+        runner.pre_run(self.node)
+        self.assertNotIn(2, runner.all_invoices_from_db[self.node])
+
+        runner.process_invoices(self.node, [first, late])
+
+        checkpoints = dict(Invoice.objects.values_list("add_index", "checkpoint_value"))
+        self.assertEqual(checkpoints, {1: "done", 2: "done"})
+        self.assertEqual(self.node.global_checkpoint, 2)
+
+
+class MetricsEndpointTest(UpvoteBatchTest):
+    def test_checkpoints_are_exposed(self):
+        from lner import tasks
+
+        snapshot_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, snapshot_dir)
+
+        raw_invoices = [self.settled_upvote(i, self.answer.id) for i in range(1, 3)]
+        raw_invoices.append(self.settled_upvote(3, 123456))
+        before = dict(
+            (tuple(labels), value)
+            for labels, value in tasks.CHECKPOINTS.snapshot()["samples"]
+        )
+
+        runner = tasks.Runner()
+        runner.pre_run(self.node)
+        runner.process_invoices(self.node, raw_invoices)
+
+        with override_settings(METRICS_SNAPSHOT_DIR=snapshot_dir, METRICS_SNAPSHOT_SECONDS=None):
+            tasks.write_metrics_snapshot()
+            response = self.client.get("/ln/metrics/")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response["Content-Type"].startswith("text/plain"))
+
+        body = response.content.decode("utf-8")
+        done = before.get(("fake", "done"), 0) + 2
+        # only snapshots are rendered, not the registry of the web process
+        self.assertIn('lner_checkpoints_total{{node="fake",checkpoint_value="done"}} {}'.format(done), body)
+        self.assertIn('metrics_snapshot_timestamp_seconds{{source="run_many-{}"}}'.format(tasks.node_leases.worker_id), body)
+
+
+class BenchmarkRunnerTest(TestCase):
+    def test_benchmark_is_rolled_back(self):
+        out = io.StringIO()
+        call_command("benchmark_runner", sizes="40", stdout=out)
+
+        self.assertIn("inv/sec", out.getvalue())
+        self.assertEqual(out.getvalue().splitlines()[1].split()[0], "40")
+        self.assertFalse(LightningNode.objects.filter(node_name__startswith="benchmark-").exists())
+        self.assertFalse(Post.objects.filter(tag_val="benchmark").exists())
+
+
+class PollSchedulerTest(SimpleTestCase):
+    def setUp(self):
+        self.scheduler = scheduler.PollScheduler()
+        self.node = LightningNode(id=1, node_name="fake")
+
+    def test_idle_node_backs_off(self):
+        now = 1000.0
+        self.assertEqual(self.scheduler.due([self.node], now), [self.node])
+
+        intervals = []
+        for _ in range(8):
+            intervals.append(self.scheduler.record(self.node, pending=0, recent_pending=0, settled_total=0, now=now))
+            now += intervals[-1]
+
+        self.assertEqual(intervals, [1, 2, 4, 8, 16, 30, 30, 30])
+        self.assertEqual(self.scheduler.due([self.node], now - 1), [])
+
+        # stale open invoices cap the back off lower
+        self.assertEqual(self.scheduler.record(self.node, pending=3, recent_pending=0, settled_total=0, now=now), 5)
+
+    def test_hot_node_is_polled_sub_second(self):
+        now = 1000.0
+        self.scheduler.record(self.node, pending=0, recent_pending=0, settled_total=0, now=now)
+        self.scheduler.record(self.node, pending=0, recent_pending=0, settled_total=0, now=now + 1)
+
+        interval = self.scheduler.record(self.node, pending=1, recent_pending=1, settled_total=0, now=now + 3)
+        self.assertEqual(interval, scheduler.HOT_POLL_INTERVAL)
+
+        # settling keeps the node hot for a while after the open invoices are gone
+        interval = self.scheduler.record(self.node, pending=0, recent_pending=0, settled_total=5, now=now + 4)
+        self.assertEqual(interval, scheduler.HOT_POLL_INTERVAL)
+        interval = self.scheduler.record(self.node, pending=0, recent_pending=0, settled_total=5, now=now + 5)
+        self.assertEqual(interval, scheduler.HOT_POLL_INTERVAL)
+
+    def test_wake(self):
+        now = 1000.0
+        for i in range(5):
+            now += self.scheduler.record(self.node, pending=0, recent_pending=0, settled_total=0, now=now)
+
+        self.scheduler.wake(self.node.id, now)
+        self.assertEqual(self.scheduler.due([self.node], now), [self.node])
+        self.assertEqual(self.scheduler.schedules[self.node.id].interval, scheduler.HOT_POLL_INTERVAL)
+
+
+class MemoLookupTest(TestCase):
+    def setUp(self):
+        self.node = LightningNode.objects.create(node_name="fake", rpcserver="fake:10009", global_checkpoint=0)
+        self.memo = json_util.serialize_memo({"action": "Upvote", "post_id": 1})
+        invoice_request = InvoiceRequest.objects.create(lightning_node=self.node, memo=self.memo)
+        self.invoice = Invoice.objects.create(
+            lightning_node=self.node, invoice_request=invoice_request, pay_req="lnfake1", add_index=1)
+
+    def test_check_payment_is_one_query(self):
+        with self.assertNumQueries(1):
+            response = self.client.get("/ln/check/", {"memo": self.memo, "node_id": self.node.id})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()[0]["pay_req"], "lnfake1")
+
+        response = self.client.get("/ln/check/", {"memo": self.memo + "x", "node_id": self.node.id})
+        self.assertEqual(response.status_code, 404)
+
+    def test_wait_returns_on_timeout_or_changed_checkpoint(self):
+        args = {"memo": self.memo, "node_id": self.node.id, "timeout": 0.2}
+
+        start_time = time.time()
+        response = self.client.get("/ln/waitcheck/", args)
+        self.assertEqual(response.json()[0]["checkpoint_value"], "no_checkpoint")
+        self.assertGreaterEqual(time.time() - start_time, 0.2)
+
+        Invoice.objects.filter(pk=self.invoice.pk).update(checkpoint_value="done")
+        with self.assertNumQueries(1):
+            response = self.client.get("/ln/waitcheck/", args)
+
+        self.assertEqual(response.json()[0]["checkpoint_value"], "done")
+
+    def test_waiter_is_woken_by_checkpoint_change(self):
+        with notify.CheckpointWaiter(self.invoice.id) as waiter:
+            threading.Timer(0.05, notify.checkpoint_changed, [[self.invoice.id]]).start()
+            self.assertTrue(waiter.wait(5))
+
+        self.assertEqual(notify._waiters, {})
+
+    def test_addinvoice_reuses_request(self):
+        response = self.client.post("/ln/addinvoice/", {"memo": self.memo, "node_id": self.node.id})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["pay_req"], "lnfake1")
+        self.assertEqual(InvoiceRequest.objects.count(), 1)
+
+    def test_addinvoice_creates_one_invoice(self):
+        memo = json_util.serialize_memo({"action": "Upvote", "post_id": 2})
+        for _ in range(2):
+            response = self.client.post("/ln/addinvoice/", {"memo": memo, "node_id": self.node.id})
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.json()["add_index"], 2)
+
+        self.assertEqual(Invoice.objects.filter(invoice_request__memo=memo).count(), 1)
+
+
+class NodeListETagTest(TestCase):
+    def setUp(self):
+        self.node = LightningNode.objects.create(node_name="test", rpcserver="localhost:10009")
+
+    def test_not_modified(self):
+        response = self.client.get("/ln/list.json")
+        self.assertEqual(response.status_code, 200)
+        etag = response["ETag"]
+
+        response = self.client.get("/ln/list.json", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b"")
+
+        self.node.enabled = False
+        self.node.save()
+        response = self.client.get("/ln/list.json", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+        self.assertFalse(response.json()[0]["enabled"])
+
+    def test_etag_follows_top_node(self):
+        other = LightningNode.objects.create(node_name="other", rpcserver="other:10009")
+        LightningNode.objects.filter(pk=self.node.pk).update(qos_score=500)
+        LightningNode.objects.filter(pk=other.pk).update(qos_score=400)
+        etag = self.client.get("/ln/list.json")["ETag"]
+
+        # a probe moved the scores, the reader still picks the same node
+        LightningNode.objects.filter(pk=self.node.pk).update(qos_score=510)
+        response = self.client.get("/ln/list.json", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        LightningNode.objects.filter(pk=other.pk).update(qos_score=600)
+        response = self.client.get("/ln/list.json", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()[1]["qos_score"], 600)
+
+
+class QosTest(TestCase):
+    def setUp(self):
+        self.fast = LightningNode.objects.create(node_name="fast", rpcserver="fast:10009")
+        self.slow = LightningNode.objects.create(node_name="slow", rpcserver="slow:10009")
+
+    def observe(self, node, seconds, success, count=qos.MIN_SAMPLES):
+        for _ in range(count):
+            qos.observe(node, seconds, success)
+
+        qos.flush()
+        node.refresh_from_db()
+
+    def test_flush_matches_ewma(self):
+        qos.observe(self.fast, 1.0, True)
+        qos.flush()
+        qos.observe(self.fast, 2.0, False)
+        qos.observe(self.fast, 3.0, True)
+        qos.flush()
+
+        self.fast.refresh_from_db()
+        self.assertEqual(self.fast.qos_samples, 3)
+        self.assertAlmostEqual(self.fast.qos_latency, qos.ewma(1.0, [2.0, 3.0]))
+        self.assertAlmostEqual(self.fast.qos_error_rate, qos.ewma(0, [1, 0]))
+
+    def test_measure_records_failures(self):
+        with self.assertRaises(ValueError):
+            with qos.measure(self.fast):
+                raise ValueError("lncli failed")
+
+        qos.flush()
+        self.fast.refresh_from_db()
+        self.assertEqual(self.fast.qos_error_rate, 1)
+
+    def test_scores_follow_latency(self):
+        self.observe(self.fast, 0.1, True)
+        self.observe(self.slow, 2.0, True)
+        qos.update_scores()
+
+        best = LightningNode.objects.filter(enabled=True).order_by("-qos_score").first()
+        self.assertEqual(best, self.fast)
+
+    def test_disable_and_enable_again(self):
+        self.observe(self.fast, 0.1, True)
+        self.observe(self.slow, 5.0, False)
+        qos.update_scores()
+
+        self.slow.refresh_from_db()
+        self.assertFalse(self.slow.enabled)
+        self.assertTrue(self.slow.qos_disabled)
+
+        # invoices the node already issued are still processed
+        from lner.tasks import polled_nodes
+        self.assertEqual(sorted(node.node_name for node in polled_nodes()), ["fast", "slow"])
+
+        self.observe(self.slow, 0.2, True, count=20)
+        qos.update_scores()
+
+        self.slow.refresh_from_db()
+        self.assertTrue(self.slow.enabled)
+        self.assertFalse(self.slow.qos_disabled)
+
+    def test_last_enabled_node_stays_enabled(self):
+        self.fast.enabled = False
+        self.fast.save()
+
+        self.observe(self.slow, 5.0, False)
+        qos.update_scores()
+
+        self.slow.refresh_from_db()
+        self.assertTrue(self.slow.enabled)
+
+    def test_probe_mocked_nodes(self):
+        with override_settings(MOCK_LN_CLIENT=True):
+            for _ in range(qos.MIN_SAMPLES):
+                qos.probe()
+
+        self.fast.refresh_from_db()
+        self.assertEqual(self.fast.qos_samples, qos.MIN_SAMPLES)
+        self.assertEqual(self.fast.qos_error_rate, 0)
+        self.assertGreater(self.fast.qos_score, 0)
+
+
+@override_settings(MOCK_LN_CLIENT=True)
+class PayAwardJobTest(TestCase):
+    def setUp(self):
+        from background_task.models import Task
+
+        self.Task = Task
+        self.node = LightningNode.objects.create(node_name="fake", rpcserver="fake:10009")
+        self.author = User.objects.create(pubkey="FAKE2")  # pubkey of the mocked verifymessage
+        question = Post.objects.create(
+            author=self.author, type=Post.QUESTION, title="Question", content="Body of the question", tag_val="bounty")
+        answer = Post.objects.create(author=self.author, type=Post.ANSWER, parent=question, content="Body of the answer")
+        self.bounty = Bounty.objects.create(post_id=question, amt=123, activation_time=timezone.now())
+        self.award = BountyAward.objects.create(bounty=self.bounty, post=answer)
+
+    def submit(self):
+        args = {"node_id": self.node.id, "award_id": self.award.id, "invoice": "lnfake1", "sig": "fakesig"}
+        response = self.client.post("/ln/payaward/", args)
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_submit_returns_before_payment(self):
+        job = self.submit()
+
+        self.assertEqual(job["status"], PayAwardJob.QUEUED)
+        self.assertEqual(self.Task.objects.filter(queue=payouts.QUEUE).count(), 1)
+        self.bounty.refresh_from_db()
+        self.assertFalse(self.bounty.is_payed)
+
+        # the award has an unfinished job, submitting again does not start another payment
+        self.assertEqual(self.submit()["id"], job["id"])
+        self.assertEqual(PayAwardJob.objects.count(), 1)
+
+    def test_job_pays_award(self):
+        job = self.submit()
+        payouts.run_payaward_job.now(job["id"])
+
+        response = self.client.get("/ln/payawardstatus/", {"job_id": job["id"]})
+        self.assertEqual(response.json()[0]["status"], PayAwardJob.SUCCEEDED)
+        self.bounty.refresh_from_db()
+        self.assertTrue(self.bounty.is_payed)
+
+        # a job runs once
+        payouts.run_payaward_job.now(job["id"])
+        self.assertEqual(PayAwardJob.objects.get(id=job["id"]).status, PayAwardJob.SUCCEEDED)
+
+        payouts.run_payaward_job.now(self.submit()["id"])
+        failed = PayAwardJob.objects.order_by("id").last()
+        self.assertEqual(failed.status, PayAwardJob.FAILED)
+        self.assertEqual(failed.failure_message, "This bounty has already been payed out")
+
+    def test_stale_running_job_fails(self):
+        job = self.submit()
+
+        # the worker claimed the job and crashed during the payment
+        PayAwardJob.objects.filter(id=job["id"]).update(
+            status=PayAwardJob.RUNNING, started=timezone.now() - timedelta(seconds=60))
+        self.assertEqual(self.submit()["status"], PayAwardJob.RUNNING)
+
+        PayAwardJob.objects.filter(id=job["id"]).update(
+            started=timezone.now() - timedelta(seconds=settings.PAYOUT_JOB_TIMEOUT + 60))
+        response = self.client.get("/ln/payawardstatus/", {"job_id": job["id"]})
+        self.assertEqual(response.json()[0]["status"], PayAwardJob.FAILED)
+        self.assertEqual(response.json()[0]["failure_message"], payouts.STALE_MESSAGE)
+
+        # the user may submit again
+        retry = self.submit()
+        self.assertNotEqual(retry["id"], job["id"])
+        self.assertEqual(retry["status"], PayAwardJob.QUEUED)
+
+    def test_status_waits_for_job(self):
+        job = self.submit()
+        args = {"job_id": job["id"], "timeout": 0.2}
+
+        start_time = time.time()
+        response = self.client.get("/ln/payawardstatus/", args)
+        self.assertEqual(response.json()[0]["status"], PayAwardJob.QUEUED)
+        self.assertGreaterEqual(time.time() - start_time, 0.2)
+
+        PayAwardJob.objects.filter(id=job["id"]).update(status=PayAwardJob.FAILED, failure_message="failed")
+        with self.assertNumQueries(1):
+            response = self.client.get("/ln/payawardstatus/", args)
+
+        self.assertEqual(response.json()[0]["status"], PayAwardJob.FAILED)
+
+
+class LeaseTest(UpvoteBatchTest):
+    def setUp(self):
+        super().setUp()
+        self.nodes = [self.node] + [
+            LightningNode.objects.create(node_name="node{}".format(i), rpcserver="node{}:10009".format(i), global_checkpoint=0)
+            for i in range(3)
+        ]
+
+    def owned(self, manager, now):
+        return set(node.id for node in manager.owned_nodes(self.nodes, now=now))
+
+    def test_workers_share_nodes(self):
+        now = timezone.now()
+        first = leases.LeaseManager("first")
+        second = leases.LeaseManager("second")
+
+        self.assertEqual(len(self.owned(first, now)), 4)
+        self.assertEqual(self.owned(second, now), set())
+
+        # first gives up half of its nodes at the next heartbeat, second takes them at its own
+        now += timedelta(seconds=leases.HEARTBEAT_SECONDS)
+        first_nodes = self.owned(first, now)
+        second_nodes = self.owned(second, now)
+        self.assertEqual(len(first_nodes), 2)
+        self.assertEqual(len(second_nodes), 2)
+        self.assertFalse(first_nodes & second_nodes)
+
+    def test_expired_leases_are_taken_over(self):
+        now = timezone.now()
+        first = leases.LeaseManager("first")
+        second = leases.LeaseManager("second")
+        self.owned(first, now)
+
+        # first stops heartbeating
+        now += timedelta(seconds=leases.LEASE_SECONDS + 1)
+        self.assertEqual(len(self.owned(second, now)), 4)
+
+    def test_single_node_lease(self):
+        first = leases.LeaseManager("first")
+        second = leases.LeaseManager("second")
+
+        self.assertTrue(first.hold(self.node.id))
+        self.assertTrue(first.hold(self.node.id))  # renewed
+        self.assertFalse(second.hold(self.node.id))
+
+        first.release(self.node.id)
+        self.assertTrue(second.hold(self.node.id))
+
+    def test_checkpoint_is_compare_and_set(self):
+        stale = LightningNode.objects.get(pk=self.node.pk)
+        leases.set_global_checkpoint(self.node, 5)
+
+        with self.assertRaises(leases.LeaseLost):
+            leases.set_global_checkpoint(stale, 7)
+
+        self.node.refresh_from_db()
+        self.assertEqual(self.node.global_checkpoint, 5)
+
+    def test_upvotes_are_applied_once(self):
+        from lner.tasks import Runner
+
+        raw_invoices = [self.settled_upvote(i, self.answer.id) for i in range(1, 4)]
+
+        # both workers loaded the node and its invoices before either one applied them
+        nodes = [LightningNode.objects.get(pk=self.node.pk) for _ in range(2)]
+        runners = [Runner(), Runner()]
+        for runner, node in zip(runners, nodes):
+            runner.pre_run(node)
+
+        runners[0].process_invoices(nodes[0], raw_invoices)
+        with self.assertRaises(leases.LeaseLost):
+            runners[1].process_invoices(nodes[1], raw_invoices)
+
+        self.answer.refresh_from_db()
+        self.assertEqual(Vote.objects.filter(type=Vote.UP).count(), 3)
+        self.assertEqual(self.answer.vote_count, 3 * settings.PAYMENT_AMOUNT)
+
+    def test_actions_are_applied_once(self):
+        from lner.tasks import Runner
+
+        raw_invoices = [
+            self.settled_invoice(1, {"action": "Bounty", "post_id": self.question.id, "amt": 10, "unixtime": 1}),
+            self.settled_invoice(2, {"title": "Paid question", "content": "Body of the question", "post_type": Post.QUESTION, "tag_val": "claim"}),
+        ]
+
+        nodes = [LightningNode.objects.get(pk=self.node.pk) for _ in range(2)]
+        runners = [Runner(), Runner()]
+        for runner, node in zip(runners, nodes):
+            runner.pre_run(node)
+
+        runners[0].process_invoices(nodes[0], raw_invoices)
+        with self.assertRaises(leases.LeaseLost):
+            runners[1].process_invoices(nodes[1], raw_invoices)
+
+        self.assertEqual(Bounty.objects.filter(post_id=self.question).count(), 1)
+        self.assertEqual(Post.objects.filter(title="Paid question").count(), 1)
+        self.assertEqual(
+            [invoice.checkpoint_value for invoice in runners[1].all_invoices_from_db[nodes[1]].values()],
+            ["done", "done"]
+        )
+
+
+class ArchiveTest(UpvoteBatchTest):
+    def test_expired_invoices_are_archived(self):
+        from lner.tasks import Runner
+
+        raw_invoices = [self.settled_upvote(i, self.answer.id) for i in range(1, 6)]
+        InvoiceRequest.objects.create(lightning_node=self.node, memo="no invoice")
+        Invoice.objects.create(lightning_node=self.node, pay_req="lnpending", add_index=6)
+
+        runner = Runner()
+        runner.pre_run(self.node)
+        runner.process_invoices(self.node, raw_invoices)
+
+        # nothing passed retention yet
+        self.assertEqual(archive.archive_invoices(), 0)
+
+        later = timezone.now() + settings.INVOICE_RETENTION + timedelta(seconds=1)
+        self.assertEqual(archive.archive_invoices(now=later, chunk_size=2), 5)
+
+        # the invoice above the global checkpoint stays
+        self.assertEqual(list(Invoice.objects.values_list("add_index", flat=True)), [6])
+        self.assertEqual(InvoiceRequest.objects.count(), 0)
+
+        archived = ArchivedInvoice.objects.get(add_index=1)
+        self.assertEqual(archived.checkpoint_value, "done")
+        self.assertEqual(archived.performed_action_id, self.answer.id)
+        self.assertEqual(archived.memo, raw_invoices[0]["memo"])
 
-# Create your tests here.
+        with self.assertNumQueries(1):
+            runner.pre_run(self.node)
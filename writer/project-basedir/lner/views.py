@@ -1,10 +1,12 @@
-import time
 import re
 import json
+import hashlib
+import time
 
 from django.shortcuts import get_object_or_404
 from django.http import Http404
 from django.conf import settings
+from django.db import transaction
 from django.db.models import Max
 
 from rest_framework.views import APIView
@@ -14,26 +16,30 @@ from rest_framework import viewsets
 from rest_framework.decorators import api_view, permission_classes
 from rest_framework import permissions
 from rest_framework import mixins
+from rest_framework import renderers
 
 from lner.models import LightningNode
 from lner.models import Invoice
 from lner.models import InvoiceRequest
 from lner.models import VerifyMessageResult
-from lner.models import PayAwardResult
-
-from bounty.models import Bounty, BountyAward
+from lner.models import PayAwardJob
+from lner.models import memo_digest
+from lner import notify
+from lner import qos
+from lner import payouts
 
 from lner.serializers import LightningNodeSerializer
 from lner.serializers import InvoiceSerializer
 from lner.serializers import InvoiceRequestSerializer
 from lner.serializers import CheckPaymentSerializer
 from lner.serializers import VerifyMessageResponseSerializer
-from lner.serializers import PayAwardResponseSerializer
+from lner.serializers import PayAwardJobSerializer
 
 from common import log
-from common import lnclient
 from common import validators
 from common import json_util
+from common import metrics
+from common.singleflight import SingleFlight
 
 from common.const import MEMO_RE
 
@@ -48,6 +54,36 @@ class LightningNodeViewSet(viewsets.ModelViewSet):
     queryset = LightningNode.objects.all()
     serializer_class = LightningNodeSerializer
 
+    # Node list fields that the reader uses as they are, qos_score is left to etag()
+    ETAG_FIELDS = ["id", "node_name", "node_key", "rpcserver", "enabled", "is_tor", "connect_ip", "connect_tor"]
+
+    def list(self, request, format=None):
+        """
+        The reader caches the node list and revalidates it with If-None-Match, see ln.get_nodes_list
+        """
+        serializer = self.get_serializer(self.get_queryset(), many=True)
+        etag = self.etag(serializer.data)
+
+        if etag in request.META.get("HTTP_IF_NONE_MATCH", "").split(", "):
+            response = Response(status=status.HTTP_304_NOT_MODIFIED)
+        else:
+            response = Response(serializer.data)
+
+        response["ETag"] = etag
+        return response
+
+    @staticmethod
+    def etag(nodes):
+        """
+        qos_score changes with every probe, the reader only uses it to pick the node with the top score,
+        so the ETag covers which node that is instead of the scores
+        """
+        key = {
+            "nodes": [{field: node[field] for field in LightningNodeViewSet.ETAG_FIELDS} for node in nodes],
+            "top_node_id": max(nodes, key=lambda node: node["qos_score"])["id"] if len(nodes) > 0 else None,
+        }
+        return '"{}"'.format(hashlib.sha256(json.dumps(key, sort_keys=True).encode("utf-8")).hexdigest())
+
 
 class CreateInvoiceError(Exception):
     pass
@@ -60,26 +96,47 @@ class CreateInvoiceViewSet(viewsets.ModelViewSet):
     queryset = []
     serializer_class = InvoiceRequestSerializer
 
-    MAX_RETRIES = 3
-    RETRY_SLEEP_SECONDS = 1
+    # One addinvoice per (node id, memo digest) at a time, concurrent requests for the same memo share its result
+    addinvoice_flight = SingleFlight()
 
-    def create(self, request, format=None, retry_addinvoice=False, retry_num=0):
+    def create(self, request, format=None):
         memo = request.POST["memo"]
+        node = LightningNode.objects.get(id=request.POST["node_id"])
 
-        if retry_num >= CreateInvoiceViewSet.MAX_RETRIES:
-            raise CreateInvoiceError(
-                "Retry count exceeded: {}".format(retry_num)
+        try:
+            return Response(
+                CreateInvoiceViewSet.addinvoice_flight.do(
+                    (node.id, memo_digest(memo)),
+                    lambda: self.get_or_add_invoice(node, memo)
+                )
+            )
+        finally:
+            qos.flush()  # after the transaction, so the node row is not locked while invoice requests wait
+
+    def get_or_add_invoice(self, node, memo):
+        """
+        Return the invoice of memo on node, calling addinvoice on the node if it does not exist yet
+
+        Requests in other processes are serialized by locking the InvoiceRequest row until the Invoice is saved,
+        so they wait for the invoice instead of creating a duplicate.
+        """
+        with transaction.atomic():
+            request_obj, created = InvoiceRequest.objects.get_or_create(
+                lightning_node=node,
+                memo_digest=memo_digest(memo),
+                defaults={"memo": memo}
             )
+            if not created:
+                request_obj = InvoiceRequest.objects.select_for_update().get(pk=request_obj.pk)
 
-        node = LightningNode.objects.get(id=request.POST["node_id"])
-        request_obj, created = InvoiceRequest.objects.get_or_create(
-            lightning_node=node,
-            memo=memo
-        )
+            invoice_obj = Invoice.objects.filter(invoice_request=request_obj, lightning_node_id=node.id).first()
+            if invoice_obj is not None:
+                logger.info("Fetched invoice from DB: {}".format(invoice_obj))
+                invoice_obj.node_id = node.id
+                return InvoiceSerializer(invoice_obj).data
 
-        if created or retry_addinvoice:
             logger.info("New invoice request created: {}".format(request_obj))
-            # InvoiceRequest just got created? do:
+            # InvoiceRequest has no invoice yet? do:
             #  1. addinvoice RPC to the node
             #  2. create Invoice
 
@@ -99,26 +156,17 @@ class CreateInvoiceViewSet(viewsets.ModelViewSet):
                 serializer = InvoiceSerializer(data=invoice_stdout, many=False)  # re-serialize
                 is_valid = serializer.is_valid(raise_exception=False)  # validate data going into the database
 
-                invoice_obj = Invoice(
-                    invoice_request=request_obj,
-                    lightning_node=node,
-                    pay_req=serializer.validated_data.get("pay_req"),
-                    r_hash=serializer.validated_data.get("r_hash"),
-                    add_index=serializer.validated_data.get("add_index")
-                )
-                invoice_obj.save()
-                return Response(serializer.validated_data)
-
             else:
                 # TODO: surface addinvoice timeout and other exceptions back to the user
                 # Bonties can specify amount in the memo, everithing else defaults to settings.PAYMENT_AMOUNT
                 deserialized_memo = json_util.deserialize_memo(memo)
-                invoice_stdout = lnclient.addinvoice(
-                    memo,
-                    node.rpcserver,
-                    amt=deserialized_memo.get("amt", settings.PAYMENT_AMOUNT),
-                    expiry=settings.INVOICE_EXPIRY,
-                )
+                with qos.measure(node):
+                    invoice_stdout = node.get_lnclient().addinvoice(
+                        memo,
+                        node.rpcserver,
+                        amt=deserialized_memo.get("amt", settings.PAYMENT_AMOUNT),
+                        expiry=settings.INVOICE_EXPIRY,
+                    )
                 logger.info("Finished addinvoice on the node")
 
                 invoice_stdout["node_id"] = node.id
@@ -135,42 +183,19 @@ class CreateInvoiceViewSet(viewsets.ModelViewSet):
                     logger.error(msg)
                     raise CreateInvoiceError(msg)
 
-                invoice_obj = Invoice(
-                    invoice_request=request_obj,
-                    lightning_node=node,
-                    pay_req=serializer.validated_data.get("pay_req"),
-                    r_hash=serializer.validated_data.get("r_hash"),
-                    add_index=serializer.validated_data.get("add_index")
-                )
-                logger.info("New invoice created! {}".format(invoice_obj))
-
-                invoice_obj.save()
-                logger.info("Saved results of addinvoice to DB")
-
-                return Response(serializer.validated_data)
+            invoice_obj = Invoice(
+                invoice_request=request_obj,
+                lightning_node=node,
+                pay_req=serializer.validated_data.get("pay_req"),
+                r_hash=serializer.validated_data.get("r_hash"),
+                add_index=serializer.validated_data.get("add_index")
+            )
+            logger.info("New invoice created! {}".format(invoice_obj))
 
-        else:
-            logger.info("Good it already exists: {}".format(request_obj))
-            try:
-                invoice_obj = Invoice.objects.get(invoice_request=request_obj, lightning_node_id=node.id)
-            except Invoice.DoesNotExist:
-                logger.info("Re-trying to create new invoice")
-                retry_num += 1
-                time.sleep(CreateInvoiceViewSet.RETRY_SLEEP_SECONDS)
-                return self.create(request, format=format, retry_addinvoice=True, retry_num=retry_num)
-
-            logger.info("Fetched invoice from DB: {}".format(invoice_obj))
-            invoice_obj.node_id = node.id
-            serializer = InvoiceSerializer(invoice_obj)
-
-            if serializer.is_valid:
-                logger.info("Invoice is valid")
-            else:
-                msg = "Invoice is NOT valid, errors: {}".format(serializer.errors)
-                logger.error(msg)
-                raise CreateInvoiceError(msg)
+            invoice_obj.save()
+            logger.info("Saved results of addinvoice to DB")
 
-            return Response(serializer.data)
+            return serializer.validated_data
 
 
 class CheckPaymentViewSet(viewsets.ModelViewSet):
@@ -187,12 +212,45 @@ class CheckPaymentViewSet(viewsets.ModelViewSet):
 
         assert re.match(MEMO_RE, memo), "Got invalid memo {}".format(memo)
 
-        invoice_request = get_object_or_404(InvoiceRequest, memo=memo, lightning_node_id=node_id)
-        invoice = get_object_or_404(Invoice, invoice_request=invoice_request, lightning_node_id=node_id)
+        invoice = get_object_or_404(
+            Invoice.objects.select_related("invoice_request"),
+            invoice_request__lightning_node_id=node_id,
+            invoice_request__memo_digest=memo_digest(memo),
+            lightning_node_id=node_id,
+        )
 
         return [invoice]
 
 
+class WaitPaymentViewSet(CheckPaymentViewSet):
+    """
+    Same as check, but wait until the checkpoint differs from the "checkpoint_value" argument or "timeout" seconds pass
+    """
+
+    def get_queryset(self):
+        invoice = super(WaitPaymentViewSet, self).get_queryset()[0]
+
+        seen_checkpoint_value = self.request.query_params.get("checkpoint_value", "no_checkpoint")
+        try:
+            timeout = min(float(self.request.query_params.get("timeout", 0)), settings.LONG_POLL_MAX_SECONDS)
+        except ValueError:
+            timeout = 0
+
+        if invoice.checkpoint_value != seen_checkpoint_value or timeout <= 0:
+            return [invoice]
+
+        deadline = time.time() + timeout
+        with notify.CheckpointWaiter(invoice.id) as waiter:
+            while True:
+                invoice.refresh_from_db(fields=["checkpoint_value", "performed_action_type", "performed_action_id"])
+                time_left = deadline - time.time()
+                if invoice.checkpoint_value != seen_checkpoint_value or time_left <= 0:
+                    break
+
+                waiter.wait(time_left)
+
+        return [invoice]
+
 
 class VerifyMessageViewSet(viewsets.ModelViewSet):
     """
@@ -213,7 +271,7 @@ class VerifyMessageViewSet(viewsets.ModelViewSet):
 
         node = LightningNode.objects.filter(enabled=True).order_by("-qos_score").first()
 
-        result_json = lnclient.verifymessage(msg=memo, sig=sig, rpcserver=node.rpcserver, mock=settings.MOCK_LN_CLIENT)
+        result_json = node.verifymessage(msg=memo, sig=sig)
         pubkey = result_json["pubkey"]
         valid = result_json["valid"]
 
@@ -222,133 +280,84 @@ class VerifyMessageViewSet(viewsets.ModelViewSet):
         return [verify_message_result]
 
 
-def payment_fail(msg):
-    logger.error(msg)
-    return [PayAwardResult(payment_successful=False, failure_message=msg)]
-
-
 class PayAwardViewSet(viewsets.ModelViewSet):
     """
-    Check message against a signature
+    Submit the payout of a bounty award, it runs in the background, see lner.payouts
     """
 
     queryset = []
-    serializer_class = PayAwardResponseSerializer
+    serializer_class = PayAwardJobSerializer
 
-    def get_queryset(self):
-        node_id = self.request.query_params.get("node_id")
-        award_id = self.request.query_params.get("award_id")
-        invoice = self.request.query_params.get("invoice")
-        sig = self.request.query_params.get("sig")
+    def create(self, request, format=None):
+        award_id = request.POST.get("award_id")
+        invoice = request.POST.get("invoice")
+        sig = request.POST.get("sig")
 
         assert invoice is not None, "Missing a required field: invoice"
         assert sig is not None, "Missing a required field: sig"
 
         sig = validators.pre_validate_signature(sig)
 
-        node_id = self.request.query_params.get("node_id")
+        node_id = request.POST.get("node_id")
         logger.info("Looking up node id: {}".format(node_id))
 
-        # Lookup node
         node = get_object_or_404(LightningNode.objects, id=node_id)
-        if not node.enabled:
-            return payment_fail("Node is not enabled, try a different node")
-
-        sig_verify_json = lnclient.verifymessage(msg=invoice, sig=sig, rpcserver=node.rpcserver, mock=settings.MOCK_LN_CLIENT)
-        logger.info("Attempting to pay award for: {}".format(sig_verify_json))
+        job = payouts.submit(node, award_id=award_id, invoice=invoice, sig=sig)
 
-        valid = sig_verify_json["valid"]
-        sig_pubkey = sig_verify_json["pubkey"]
+        return Response(PayAwardJobSerializer(job).data)
 
-        if not valid:
-            return payment_fail("Signature is invalid")
 
-        # Lookup Award
-        award = BountyAward.objects.get(id=award_id)
-
-        # Check award recipient
-        award_pubkey = award.post.author.pubkey
-        if award_pubkey != sig_pubkey:
-            return payment_fail("Incorrect signature, this award will be payed out only to {}".format(award_pubkey))
-
-        # Calculate award amount
-        # TODO: put into a shard function get_bounty_sats
-        bounty_sats = 0
+class PayAwardStatusViewSet(viewsets.ModelViewSet):
+    """
+    Status of a payout job, waits until the job is finished or "timeout" seconds pass
+    """
 
-        bounties_to_pay = []
-        for b in Bounty.objects.filter(post_id=award.post.parent.id, is_active=True, is_payed=False):
-            bounties_to_pay.append(b)
-            bounty_sats += b.amt
+    queryset = []
+    serializer_class = PayAwardJobSerializer
 
-        logger.info("Need to pay award in the amount of: {} sat".format(bounty_sats))
+    # Payouts are rare, finished jobs are found by re-reading the job
+    POLL_SECONDS = 0.5
 
-        # Decode invoice and lookup amount
-        decodepayreq_out = lnclient.decodepayreq(payreq=invoice, rpcserver=node.rpcserver, mock=settings.MOCK_LN_CLIENT)
-        if decodepayreq_out["success"] is not True:
-            if decodepayreq_out["failure_type"] == "timeout":
-                return payment_fail("LND decodepayreq timed out")
-            else:
-                # TODO: from stdouterr remove anything that looks like an IP address
-                # E.g. [lncli] rpc error: code = Unknown desc = caveat "ipaddr 172.1.1.1" not satisfied: macaroon locked to different IP address
-                return payment_fail("LND decodepayreq failed. LND error message was: {}".format(decodepayreq_out["stdouterr"]))
-
-        payreq_decoded = json.loads(decodepayreq_out["stdouterr"])
-
-        num_satoshis = payreq_decoded["num_satoshis"]
-        num_msat = payreq_decoded["num_msat"]
-        logger.info("User requested: num_satoshis={} and num_msat={} ".format(num_satoshis, num_msat))
-
-        if int(bounty_sats) == 0:
-            return payment_fail("This bounty has already been payed out")
-
-        # Check invoice amount
-        if not settings.MOCK_LN_CLIENT:
-            if int(bounty_sats) != int(num_satoshis):
-                return payment_fail(
-                    (
-                        "Invoice num_satoshis amount is incorrect, "
-                        "we expect to send you {} sats, yet the invoice says {}"
-                    ).format(bounty_sats, num_satoshis)
-                )
+    def get_queryset(self):
+        job = get_object_or_404(PayAwardJob.objects, id=self.request.query_params.get("job_id"))
+        payouts.fail_if_stale(job)
 
-            if int(bounty_sats) != int(int(num_msat) / 1000):
-                return payment_fail(
-                    (
-                        "Invoice num_satoshis amount is incorrect, "
-                        "we expect to send you {} sats, yet your invoice says {} msats which is {} sats"
-                    ).format(
-                        bounty_sats,
-                        num_msat,
-                        int(int(num_msat) / 1000)
-                    )
-                )
+        try:
+            timeout = min(float(self.request.query_params.get("timeout", 0)), settings.LONG_POLL_MAX_SECONDS)
+        except ValueError:
+            timeout = 0
 
-        logger.info("Entered critical section")
+        deadline = time.time() + timeout
+        while not job.is_finished() and time.time() < deadline:
+            time.sleep(min(PayAwardStatusViewSet.POLL_SECONDS, max(deadline - time.time(), 0)))
+            job.refresh_from_db(fields=["status", "failure_message"])
 
-        # ! TODO (2020-05-19): Check for recent payments on all nodes, in case we crash in the middle of critical section
+        return [job]
 
-        logger.info("about to pay")
 
-        pay_result = lnclient.payinvoice(payreq=invoice, rpcserver=node.rpcserver, mock=settings.MOCK_LN_CLIENT)
-        logger.info("pay_result: {}".format(pay_result))
+class MetricsRenderer(renderers.BaseRenderer):
+    media_type = "text/plain"
+    format = "txt"
+    charset = "utf-8"
 
-        if pay_result["success"] is not True:
-            if pay_result["failure_type"] == "timeout":
-                return payment_fail("LND payinvoice timed out")
-            else:
-                # TODO: from stdouterr remove anything that looks like an IP address
-                # E.g. [lncli] rpc error: code = Unknown desc = caveat "ipaddr 172.1.1.1" not satisfied: macaroon locked to different IP address
-                return payment_fail("LND payinvoice failed. LND error message was: {}".format(pay_result["stdouterr"]))
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if isinstance(data, str):
+            return data
 
-        logger.info("payed, about to update db")
+        return json.dumps(data)  # error responses, e.g. {"detail": "..."}
 
-        for b in bounties_to_pay:
-            b.is_payed = True
-            b.is_active = False
-            b.save()
 
-        logger.info("updated db")
+class MetricsViewSet(viewsets.ViewSet):
+    """
+    Invoice pipeline metrics in the Prometheus text format, merged from the snapshots of run_many, stream_invoices
+    and the web workers. The registry of the worker that serves the request is in its own snapshot.
+    """
 
-        logger.info("Exited critical section")
+    renderer_classes = [MetricsRenderer]
 
-        return [PayAwardResult(payment_successful=True)]
+    def list(self, request, format=None):
+        snapshots = metrics.read_snapshots(settings.METRICS_SNAPSHOT_DIR, max_age=settings.METRICS_SNAPSHOT_MAX_AGE)
+        return Response(
+            metrics.render(metrics.merge_snapshots(snapshots)),
+            content_type="text/plain; version=0.0.4; charset=utf-8"
+        )
@@ -27,6 +27,7 @@ from common import general_util
 from common import html_util
 from common import json_util
 from common import validators
+from common.lru import LRUCache
 
 try:
     # writer
@@ -51,6 +52,24 @@ import zlib
 from common.log import logger
 
 
+# Vote and accept urls carry the time rounded down to the bucket, so they stay the same for an hour and
+# pages with vote buttons can be cached. MemoStartView stamps the current time before an invoice is made.
+MEMO_BUCKET_SECONDS = 3600
+memo_urls = LRUCache(maxsize=10000)  # LRUCache[Tuple[str, int, int], str] keyed by action, post id and bucket
+
+
+def bucketed_memo_url(action, post_id, url_name):
+    bucket = int(time.time()) // MEMO_BUCKET_SECONDS * MEMO_BUCKET_SECONDS
+    key = (action, post_id, bucket)
+
+    url = memo_urls.get(key)
+    if url is None:
+        memo = json_util.serialize_memo(dict(action=action, post_id=post_id, unixtime=bucket))
+        url = memo_urls.put(key, reverse(url_name, kwargs=dict(memo=memo)))
+
+    return url
+
+
 class Tag(models.Model):
     name = models.TextField(max_length=50, db_index=True)
     count = models.IntegerField(default=0)
@@ -370,26 +389,10 @@ class Post(models.Model):
         return url if self.is_toplevel else "%s#%s" % (url, self.id)
 
     def get_vote_url(self):
-        obj = dict(
-            action="Upvote",
-            post_id=self.id,
-            unixtime=int(time.time())
-        )
-        memo = json_util.serialize_memo(obj)
-        url = reverse("vote-publish", kwargs=dict(memo=memo))
-
-        return url
+        return bucketed_memo_url("Upvote", self.id, "vote-start")
 
     def get_accept_url(self):
-        obj = dict(
-            action="Accept",
-            post_id=self.id,
-            unixtime=int(time.time())
-        )
-        memo = json_util.serialize_memo(obj)
-        url = reverse("accept-preview", kwargs=dict(memo=memo))
-
-        return url
+        return bucketed_memo_url("Accept", self.id, "accept-start")
 
     def get_accept_publish_url(self, memo):
         url = reverse("accept-publish", kwargs=dict(memo=memo))